@@ -0,0 +1,146 @@
+"""
+Loader for the binary dataset format written by `wrangle_kg(..., binary=True)`.
+The splits are memory-mapped arrays of entity and relation IDs, so loading a dataset does not parse
+or tokenize anything, and batches are gathered with a few array operations.
+"""
+
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from .wrangle_KG import _gather_csr
+
+
+def _load_vocab(path: str) -> list[str]:
+    """
+    Internal function.
+    Load a vocabulary written by `write_binary_vocab`. The index of each word is its ID.
+    """
+    with open(path, "r", encoding="utf-8") as infile:
+        return [line.rstrip("\n") for line in infile]
+
+
+def _pad_csr(offsets: np.ndarray, indices: np.ndarray) -> torch.Tensor:
+    """
+    Internal function.
+    Convert CSR rows to a tensor with one row each, padded with 0
+    """
+    counts = np.diff(offsets)
+    padded = torch.zeros(len(counts), max(int(counts.max(initial=0)), 1), dtype=torch.long)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    columns = np.arange(len(indices)) - np.repeat(offsets[:-1], counts)
+    padded[torch.from_numpy(rows), torch.from_numpy(columns)] = torch.from_numpy(
+        indices.astype(np.int64))
+
+    return padded
+
+
+class BinaryKGSplit(Dataset):
+    """
+    One split (train, val or test) of a binary dataset.
+    Items are data point indices, and `collate_fn` gathers a batch of them from the arrays.
+
+    Parameters
+    ----------
+    - `split_dir`: directory of the split's arrays, written by `write_binary_graph`
+    """
+    def __init__(self, split_dir: str):
+        def load(name):
+            return np.load(os.path.join(split_dir, name + ".npy"), mmap_mode="r")
+
+        self.e1 = load("e1")
+        self.rel = load("rel")
+        self.e2 = load("e2")
+        self.rel_eval = load("rel_eval")
+        self.label = load("label")
+        self.e2_multi1_offsets = load("e2_multi1_offsets")
+        self.e2_multi1_indices = load("e2_multi1_indices")
+        self.e2_multi2_offsets = load("e2_multi2_offsets")
+        self.e2_multi2_indices = load("e2_multi2_indices")
+
+    def __len__(self) -> int:
+        return len(self.e1)
+
+    def __getitem__(self, index: int) -> int:
+        return index
+
+    def collate_fn(self, indices: list[int]) -> dict:
+        """
+        Gather a batch with the keys of the graph4nlp KG completion collate function, except that
+        the e2_multi1 targets are given in CSR form as e2_offsets and e2_indices instead of as a
+        dense binary tensor
+        """
+        rows = np.asarray(indices, dtype=np.int64)
+
+        def ids(array):
+            return torch.from_numpy(array[rows].astype(np.int64)).unsqueeze(1)
+
+        e1 = ids(self.e1)
+        rel = ids(self.rel)
+        e2_offsets, e2_indices = _gather_csr(self.e2_multi1_offsets, self.e2_multi1_indices, rows)
+        e2_multi2 = _pad_csr(*_gather_csr(self.e2_multi2_offsets, self.e2_multi2_indices, rows))
+
+        return {
+            "e1": e1,
+            "rel": rel,
+            "e1_tensor": e1,
+            "rel_tensor": rel,
+            "e2_tensor": ids(self.e2),
+            "rel_eval_tensor": ids(self.rel_eval),
+            "e2_multi1": _pad_csr(e2_offsets, e2_indices),
+            "e2_multi2": e2_multi2,
+            "e2_offsets": torch.from_numpy(e2_offsets),
+            "e2_indices": torch.from_numpy(e2_indices.astype(np.int64)),
+            "label": torch.from_numpy(self.label[rows].astype(np.int64)),
+        }
+
+    def triples(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Expand the e2_multi1 sets of the split into (e1, rel, e2) triples.
+        Returns the e1, rel and e2 ID arrays.
+        """
+        counts = np.diff(self.e2_multi1_offsets)
+        e1 = np.repeat(np.asarray(self.e1, dtype=np.int64), counts)
+        rel = np.repeat(np.asarray(self.rel, dtype=np.int64), counts)
+
+        return e1, rel, np.asarray(self.e2_multi1_indices, dtype=np.int64)
+
+
+class BinaryKGDataset:
+    """
+    A dataset in the binary format, with the train, val and test splits of a KinshipDataset
+
+    Parameters
+    ----------
+    - `data_dir`: directory the dataset was wrangled in. The binary files are in its binary
+                  subdirectory
+    """
+    def __init__(self, data_dir: str):
+        self.binary_dir = os.path.join(data_dir, "binary")
+        self.entities = _load_vocab(os.path.join(self.binary_dir, "entities.txt"))
+        self.relations = _load_vocab(os.path.join(self.binary_dir, "relations.txt"))
+        self.train = BinaryKGSplit(os.path.join(self.binary_dir, "train"))
+        self.val = BinaryKGSplit(os.path.join(self.binary_dir, "val"))
+        self.test = BinaryKGSplit(os.path.join(self.binary_dir, "test"))
+
+    @property
+    def num_entities(self) -> int:
+        return len(self.entities)
+
+    @property
+    def num_relations(self) -> int:
+        return len(self.relations)
+
+    def graph_input_paths(self) -> list[str]:
+        """
+        Paths of the files the KG graph is built from, used to key the graph cache
+        """
+        train_dir = os.path.join(self.binary_dir, "train")
+        return [os.path.join(self.binary_dir, "entities.txt"),
+                os.path.join(self.binary_dir, "relations.txt"),
+                os.path.join(train_dir, "e1.npy"),
+                os.path.join(train_dir, "rel.npy"),
+                os.path.join(train_dir, "e2_multi1_offsets.npy"),
+                os.path.join(train_dir, "e2_multi1_indices.npy")]
@@ -11,7 +11,7 @@ from graph4nlp.pytorch.inference_wrapper.classifier_inference_wrapper import (
 )
 from graph4nlp.pytorch.modules.utils.config_utils import get_yaml_config
 
-from kg_completion import KGC
+from kg_completion import KGC, load_kg_graph
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "2"
 
@@ -121,8 +121,9 @@ def ranking_and_hits_this(cfg, model, dev_rank_batcher, vocab, name, kg_graph=No
 
 
 def main(cfg, model_path):
+    dataset_dir = "examples/pytorch/kg_completion/data/{}".format(cfg["dataset"])
     dataset = KinshipDataset(
-        root_dir="examples/pytorch/kg_completion/data/{}".format(cfg["dataset"]),
+        root_dir=dataset_dir,
         topology_subdir="kgc",
     )
     # data = []
@@ -131,10 +132,9 @@ def main(cfg, model_path):
     num_entities = len(dataset.vocab_model.in_word_vocab)
     num_relations = len(dataset.vocab_model.out_word_vocab)
 
-    graph_path = "examples/pytorch/kg_completion/data/{}/processed/kgc/" "KG_graph.pt".format(
-        cfg["dataset"]
-    )
-    KG_graph = torch.load(graph_path)
+    # The graph is cached by `kg_completion` when training with preprocess: true
+    KG_graph = load_kg_graph(dataset, os.path.join(dataset_dir, "processed", "kgc"),
+                             num_entities, build=False)
 
     if cfg["cuda"] is True:
         KG_graph = KG_graph.to("cuda")
@@ -1,22 +1,93 @@
+import hashlib
+import json
 import os
 import sys
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
+from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader
 
 # TODO(lucas): Is there a better way to import this?
 _graph4nlp_module_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'lib', 'graph4nlp')
 sys.path.append(_graph4nlp_module_dir)
+from graph4nlp.pytorch.data.data import GraphData
 from graph4nlp.pytorch.modules.utils.config_utils import get_yaml_config
 from graph4nlp.pytorch.datasets.kinship import KinshipDataset
 from graph4nlp.pytorch.modules.utils.logger import Logger
 
+from .binary_dataset import BinaryKGDataset
 from .model import Complex, ConvE, Distmult, GCNComplex, GCNDistMult,GGNNComplex, GGNNDistMult
+from .sampling import (NEGATIVE_SAMPLING_MODES, NeighborSampler, negative_sampling_loss,
+                       sample_negatives)
 
 import sklearn.metrics
 
+def sparse_targets(e2_multi: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Convert padded target entity IDs to CSR form: the targets of row i are
+    `indices[offsets[i]:offsets[i + 1]]`
+
+    Parameters
+    ----------
+    - `e2_multi`: target entity IDs of each row, padded with 0 (e.g., e2_multi1)
+    """
+    mask = e2_multi != 0
+    offsets = torch.zeros(e2_multi.shape[0] + 1, dtype=torch.long, device=e2_multi.device)
+    offsets[1:] = torch.cumsum(mask.sum(1), 0)
+    return offsets, e2_multi[mask]
+
+def _sparse_collate(data_list) -> dict:
+    """
+    Internal function.
+    Collate a training batch of a JSON dataset with the keys used for training, with the e2_multi1
+    targets in CSR form as e2_offsets and e2_indices. Unlike the graph4nlp collate function, no
+    dense (batch size, number of entities) binary targets are built.
+    """
+    e1 = np.array([item.e1_np for item in data_list])
+    rel = np.array([item.rel_np for item in data_list])
+    # NOTE(lucas): ID 0 is padding, which `sparse_targets` also leaves out
+    targets = [torch.as_tensor(item.e2_multi1_np, dtype=torch.long).reshape(-1)
+               for item in data_list]
+    targets = [target[target != 0] for target in targets]
+    e2_offsets = torch.zeros(len(targets) + 1, dtype=torch.long)
+    e2_offsets[1:] = torch.cumsum(torch.tensor([len(target) for target in targets]), 0)
+
+    return {
+        "e1": e1,
+        "rel": rel,
+        "e1_tensor": torch.LongTensor(e1),
+        "rel_tensor": torch.LongTensor(rel),
+        "e2_multi1": pad_sequence(targets, batch_first=True),
+        "e2_offsets": e2_offsets,
+        "e2_indices": torch.cat(targets),
+    }
+
+def smoothed_bce_loss(logits: torch.Tensor, offsets: torch.Tensor, indices: torch.Tensor,
+                      label_smoothing: float) -> torch.Tensor:
+    """
+    Mean BCE of logits against label-smoothed multi-label targets, with the targets in CSR form.
+    Equal to BCEWithLogits against `(1 - label_smoothing) * y + 1 / N` for the dense binary
+    targets y, but the smoothing is applied analytically so no dense targets are built.
+
+    Parameters
+    ----------
+    - `logits`: scores of each row against all N entities
+    - `offsets`, `indices`: targets of each row in CSR form, from `sparse_targets`
+    - `label_smoothing`: label smoothing factor
+    """
+    # NOTE(lucas): BCE(z, t) = softplus(z) - t * z, and t is 1 / N everywhere plus
+    # (1 - label_smoothing) at the targets
+    logits = logits.float()
+    num_rows, num_entities = logits.shape
+    rows = torch.repeat_interleave(torch.arange(num_rows, device=logits.device), offsets.diff())
+    target_logits = logits[rows, indices].sum()
+    total = (nn.functional.softplus(logits).sum() - logits.sum() / num_entities
+             - (1.0 - label_smoothing) * target_logits)
+
+    return total / logits.numel()
+
 def ranking_and_hits_this(cfg, model, dev_rank_batcher, vocab, name, kg_graph=None, logger=None, labels=False):
     print("")
     print("-" * 50)
@@ -30,37 +101,30 @@ def ranking_and_hits_this(cfg, model, dev_rank_batcher, vocab, name, kg_graph=No
         logger.write("-" * 50)
         logger.write("")
 
-    hits_left = []
-    hits_right = []
-    hits = []
-    ranks = []
     ranks_left = []
     ranks_right = []
-    for _ in range(10):
-        hits_left.append([])
-        hits_right.append([])
-        hits.append([])
+    true_labels = []
+    pred_labels = []
 
     confidence_cutoff = 0.5
 
-    for i, str2var in enumerate(dev_rank_batcher):
+    # The weights do not change during evaluation, so propagate the entity embeddings
+    # once and reuse them for both directions of every batch
+    with torch.no_grad():
+        entity_table = model.encode(kg_graph)
+
+    for str2var in dev_rank_batcher:
         e1 = str2var["e1_tensor"]
         e2 = str2var["e2_tensor"]
         rel = str2var["rel_tensor"]
         rel_reverse = str2var["rel_eval_tensor"]
-        e2_multi1 = str2var["e2_multi1"].float()
-        e2_multi2 = str2var["e2_multi2"].float()
+        e2_multi1 = str2var["e2_multi1"].long()
+        e2_multi2 = str2var["e2_multi2"].long()
 
         if labels:
             # TODO(lucas): Change labels to be strings by default
-            true_labels_int = [int(i) for i in str2var["label"]]
-            true_labels = []
-            pred_labels = []
-            for label in true_labels_int:
-                if label == 1:
-                    true_labels.append("normal")
-                else:
-                    true_labels.append("suspicious")
+            true_labels += ["normal" if int(label) == 1 else "suspicious"
+                            for label in str2var["label"]]
 
         if cfg["cuda"]:
             e1 = e1.to("cuda")
@@ -70,66 +134,51 @@ def ranking_and_hits_this(cfg, model, dev_rank_batcher, vocab, name, kg_graph=No
             e2_multi1 = e2_multi1.to("cuda")
             e2_multi2 = e2_multi2.to("cuda")
 
-        pred1 = model(e1, rel, kg_graph)
-        pred2 = model(e2, rel_reverse, kg_graph)
+        pred1 = model.score(e1, rel, entity_table, kg_graph)
+        pred2 = model.score(e2, rel_reverse, entity_table, kg_graph)
         pred1, pred2 = pred1.data, pred2.data
         e1, e2 = e1.data, e2.data
-        e2_multi1, e2_multi2 = e2_multi1.data, e2_multi2.data
-        for i in range(e1.shape[0]):
-            # these filters contain ALL labels
-            filter1 = e2_multi1[i].long()
-            filter2 = e2_multi2[i].long()
-
-            # save the prediction that is relevant
-            target_value1 = pred1[i, e2[i, 0].item()].item()
-            target_value2 = pred2[i, e1[i, 0].item()].item()
-            # zero all known cases (this are not interesting)
-            # this corresponds to the filtered setting
-            pred1[i][filter1] = 0.0
-            pred2[i][filter2] = 0.0
-            # write base the saved values
-            pred1[i][e2[i]] = target_value1
-            pred2[i][e1[i]] = target_value2
-
-			# Map confidence to labels
-            if labels:
-                pred_label = "normal" if target_value1 > confidence_cutoff else "suspicious"
-                pred_labels.append(pred_label)
-
-        # sort and rank
-        max_values, argsort1 = torch.sort(pred1, 1, descending=True)
-        max_values, argsort2 = torch.sort(pred2, 1, descending=True)
-
-        argsort1 = argsort1.cpu().numpy()
-        argsort2 = argsort2.cpu().numpy()
-        for i in range(e1.shape[0]):
-            # find the rank of the target entities
-            rank1 = np.where(argsort1[i] == e2[i, 0].item())[0][0]
-            rank2 = np.where(argsort2[i] == e1[i, 0].item())[0][0]
-            # rank+1, since the lowest rank is rank 1 not rank 0
-            ranks.append(rank1 + 1)
-            ranks_left.append(rank1 + 1)
-            ranks.append(rank2 + 1)
-            ranks_right.append(rank2 + 1)
-
-            # this could be done more elegantly, but here you go
-            for hits_level in range(10):
-                if rank1 <= hits_level:
-                    hits[hits_level].append(1.0)
-                    hits_left[hits_level].append(1.0)
-                else:
-                    hits[hits_level].append(0.0)
-                    hits_left[hits_level].append(0.0)
-
-                if rank2 <= hits_level:
-                    hits[hits_level].append(1.0)
-                    hits_right[hits_level].append(1.0)
-                else:
-                    hits[hits_level].append(0.0)
-                    hits_right[hits_level].append(0.0)
+        rows = torch.arange(e1.shape[0], device=pred1.device)
+
+        # save the prediction that is relevant
+        target_value1 = pred1[rows, e2[:, 0]]
+        target_value2 = pred2[rows, e1[:, 0]]
+        # zero all known cases (this are not interesting)
+        # this corresponds to the filtered setting
+        # these filters contain ALL labels
+        pred1.scatter_(1, e2_multi1, 0.0)
+        pred2.scatter_(1, e2_multi2, 0.0)
+        # write back the saved values
+        pred1[rows, e2[:, 0]] = target_value1
+        pred2[rows, e1[:, 0]] = target_value2
+
+        # rank+1, since the lowest rank is rank 1 not rank 0
+        ranks_left.append((pred1 > target_value1.unsqueeze(1)).sum(1) + 1)
+        ranks_right.append((pred2 > target_value2.unsqueeze(1)).sum(1) + 1)
+
+        # Map confidence to labels
+        if labels:
+            pred_labels += ["normal" if value > confidence_cutoff else "suspicious"
+                            for value in target_value1.tolist()]
 
         # dev_rank_batcher.state.loss = [0]
 
+    ranks_left = torch.cat(ranks_left).double().cpu()
+    ranks_right = torch.cat(ranks_right).double().cpu()
+    ranks = torch.cat([ranks_left, ranks_right])
+
+    # Hits @1 to @10
+    hits_levels = torch.arange(1, 11, dtype=torch.double)
+    hits_left = (ranks_left.unsqueeze(1) <= hits_levels).double().mean(0).tolist()
+    hits_right = (ranks_right.unsqueeze(1) <= hits_levels).double().mean(0).tolist()
+    hits = (ranks.unsqueeze(1) <= hits_levels).double().mean(0).tolist()
+    mr_left = ranks_left.mean().item()
+    mr_right = ranks_right.mean().item()
+    mr = ranks.mean().item()
+    mrr_left = (1.0 / ranks_left).mean().item()
+    mrr_right = (1.0 / ranks_right).mean().item()
+    mrr = (1.0 / ranks).mean().item()
+
     # Accuracy, precision, recall, f1, support, confusion matrix, true/false pos/neg rates
     if labels:
         label_names = ["normal", "suspicious"]
@@ -145,15 +194,15 @@ def ranking_and_hits_this(cfg, model, dev_rank_batcher, vocab, name, kg_graph=No
 
 
     for i in range(10):
-        print("Hits left @{0}: {1}".format(i + 1, np.mean(hits_left[i])))
-        print("Hits right @{0}: {1}".format(i + 1, np.mean(hits_right[i])))
-        print("Hits @{0}: {1}".format(i + 1, np.mean(hits[i])))
-    print("Mean rank left: {0}".format(np.mean(ranks_left)))
-    print("Mean rank right: {0}".format(np.mean(ranks_right)))
-    print("Mean rank: {0}".format(np.mean(ranks)))
-    print("Mean reciprocal rank left: {0}".format(np.mean(1.0 / np.array(ranks_left))))
-    print("Mean reciprocal rank right: {0}".format(np.mean(1.0 / np.array(ranks_right))))
-    print("Mean reciprocal rank: {0}".format(np.mean(1.0 / np.array(ranks))))
+        print("Hits left @{0}: {1}".format(i + 1, hits_left[i]))
+        print("Hits right @{0}: {1}".format(i + 1, hits_right[i]))
+        print("Hits @{0}: {1}".format(i + 1, hits[i]))
+    print("Mean rank left: {0}".format(mr_left))
+    print("Mean rank right: {0}".format(mr_right))
+    print("Mean rank: {0}".format(mr))
+    print("Mean reciprocal rank left: {0}".format(mrr_left))
+    print("Mean reciprocal rank right: {0}".format(mrr_right))
+    print("Mean reciprocal rank: {0}".format(mrr))
 
     if labels:
         print("\n")
@@ -174,15 +223,15 @@ def ranking_and_hits_this(cfg, model, dev_rank_batcher, vocab, name, kg_graph=No
 
     if logger is not None:
         for i in [0, 9]:
-            logger.write("Hits left @{0}: {1}".format(i + 1, np.mean(hits_left[i])))
-            logger.write("Hits right @{0}: {1}".format(i + 1, np.mean(hits_right[i])))
-            logger.write("Hits @{0}: {1}".format(i + 1, np.mean(hits[i])))
-        logger.write("Mean rank left: {0}".format(np.mean(ranks_left)))
-        logger.write("Mean rank right: {0}".format(np.mean(ranks_right)))
-        logger.write("Mean rank: {0}".format(np.mean(ranks)))
-        logger.write("Mean reciprocal rank left: {0}".format(np.mean(1.0 / np.array(ranks_left))))
-        logger.write("Mean reciprocal rank right: {0}".format(np.mean(1.0 / np.array(ranks_right))))
-        logger.write("Mean reciprocal rank: {0}".format(np.mean(1.0 / np.array(ranks))))
+            logger.write("Hits left @{0}: {1}".format(i + 1, hits_left[i]))
+            logger.write("Hits right @{0}: {1}".format(i + 1, hits_right[i]))
+            logger.write("Hits @{0}: {1}".format(i + 1, hits[i]))
+        logger.write("Mean rank left: {0}".format(mr_left))
+        logger.write("Mean rank right: {0}".format(mr_right))
+        logger.write("Mean rank: {0}".format(mr))
+        logger.write("Mean reciprocal rank left: {0}".format(mrr_left))
+        logger.write("Mean reciprocal rank right: {0}".format(mrr_right))
+        logger.write("Mean reciprocal rank: {0}".format(mrr))
 
         if labels:
             logger.write("\n")
@@ -201,7 +250,7 @@ def ranking_and_hits_this(cfg, model, dev_rank_batcher, vocab, name, kg_graph=No
             logger.write(f"False Negative Rate: {fnr}")
 
     # Return accuracy if using labels, else return MRR
-    ret = accuracy if labels else np.mean(1.0 / np.array(ranks))
+    ret = accuracy if labels else mrr
     return ret
 
 class KGC(nn.Module):
@@ -234,15 +283,120 @@ class KGC(nn.Module):
             raise Exception("Unknown model type!")
 
         self.model = model
+        # (key, entity table) of the last entity table computed in eval mode
+        self.entity_cache = None
+
+        # Train with bf16 autocast and compiled scoring
+        self.fast = cfg["fast_training"]
+        if self.fast:
+            self._compile()
 
     def init(self):
         return self.model.init()
 
-    def forward(self, e1_tensor, rel_tensor, KG_graph):
-        return self.model(e1_tensor, rel_tensor, KG_graph)
+    def _compile(self):
+        """
+        Compile the scoring path of the model with torch.compile
+        """
+        if not hasattr(torch, "compile"):
+            print("torch.compile needs torch 2.0 or newer, scoring will not be compiled")
+            return
+
+        # NOTE(lucas): The bound methods are compiled instead of the module, so the state dict
+        # keys do not change. The GNN encoders are left uncompiled.
+        if hasattr(self.model, "encode"):
+            self.model.score = torch.compile(self.model.score, dynamic=True)
+        else:
+            self.model.forward = torch.compile(self.model.forward, dynamic=True)
+
+    def _autocast(self):
+        """
+        bf16 autocast context for training in fast mode, disabled otherwise
+        """
+        device_type = "cuda" if self.cfg["cuda"] else "cpu"
+        return torch.autocast(device_type, dtype=torch.bfloat16, enabled=self.fast and self.training)
+
+    def forward(self, e1_tensor, rel_tensor, KG_graph, logits=False):
+        if not hasattr(self.model, "encode"):
+            with self._autocast():
+                return self.model(e1_tensor, rel_tensor, KG_graph, logits)
+
+        # Only the scoring runs in bf16; the GNN message passing stays in fp32
+        entity_table = self.model.encode(KG_graph)
+        with self._autocast():
+            return self.model.score(e1_tensor, rel_tensor, entity_table, KG_graph, logits)
+
+    def train(self, mode=True):
+        # Free the cached entity table while training
+        if mode:
+            self.entity_cache = None
+        return super(KGC, self).train(mode)
+
+    def encode(self, KG_graph):
+        """
+        Propagate the entity embeddings through the GNN, if the model has one.
+        Returns None for models without a GNN.
+
+        In eval mode, the entity table is cached on the device and reused until the parameters
+        or the graph change (e.g., after an optimizer step or loading a state dict).
+        """
+        if not hasattr(self.model, "encode"):
+            return None
+        if self.training:
+            return self.model.encode(KG_graph)
+
+        # NOTE(lucas): In-place updates to a parameter increase its version counter, and moving
+        # the model to another device changes its data pointer
+        key = (id(KG_graph),) + tuple((param.data_ptr(), param._version)
+                                      for param in self.parameters())
+        if self.entity_cache is None or self.entity_cache[0] != key:
+            self.entity_cache = None
+            with torch.no_grad():
+                self.entity_cache = (key, self.model.encode(KG_graph))
+
+        return self.entity_cache[1]
+
+    def score(self, e1_tensor, rel_tensor, entity_table, KG_graph):
+        """
+        Score (e1, rel) pairs against all entities, reusing an entity table from `encode`
+        """
+        if entity_table is None:
+            return self.model(e1_tensor, rel_tensor, KG_graph)
+        return self.model.score(e1_tensor, rel_tensor, entity_table, KG_graph)
+
+    def sampled_forward(self, e1_tensor, rel_tensor, sampler, logits=False):
+        """
+        Score (e1, rel) pairs against all entities, propagating through the GNN only in a subgraph
+        sampled around the batch by a `NeighborSampler`
+        """
+        subgraph, node_ids, local_e1 = sampler.sample(e1_tensor)
+        entity_table = self.model.encode(subgraph, node_ids)
+        with self._autocast():
+            return self.model.score(local_e1, rel_tensor, entity_table, subgraph, logits)
+
+    def score_candidates(self, e1_tensor, rel_tensor, candidates, KG_graph, sampler=None):
+        """
+        Score (e1, rel) pairs against a row of candidate entity IDs per pair, e.g. for negative
+        sampling. Returns logits. If a `NeighborSampler` is given, the GNN only propagates through
+        a subgraph sampled around the batch.
+        """
+        if not hasattr(self.model, "encode"):
+            with self._autocast():
+                return self.model.score_candidates(e1_tensor, rel_tensor, candidates)
+
+        if sampler is not None:
+            subgraph, node_ids, e1_tensor = sampler.sample(e1_tensor)
+            entity_table = self.model.encode(subgraph, node_ids)
+        else:
+            entity_table = self.model.encode(KG_graph)
+        with self._autocast():
+            return self.model.score_candidates(e1_tensor, rel_tensor, candidates, entity_table)
 
-    def loss(self, pred, e2_multi):
-        return self.model.loss(pred, e2_multi)
+    def loss(self, logits, e2_offsets, e2_indices):
+        """
+        Label-smoothed BCE loss of logits against all entities, with the targets in CSR form
+        """
+        return smoothed_bce_loss(logits, e2_offsets, e2_indices, self.cfg["label_smoothing"])
 
     def inference_forward(self, collate_data, KG_graph):
         e1_tensor = collate_data["e1_tensor"]
@@ -250,7 +404,7 @@ class KGC(nn.Module):
         if self.cfg["cuda"]:
             e1_tensor = e1_tensor.to("cuda")
             rel_tensor = rel_tensor.to("cuda")
-        return self.model(e1_tensor, rel_tensor, KG_graph)
+        return self.score(e1_tensor, rel_tensor, self.encode(KG_graph), KG_graph)
 
     def post_process(self, logits, e2=None):
         max_values, argsort1 = torch.sort(logits, 1, descending=True)
@@ -261,10 +415,201 @@ class KGC(nn.Module):
         # argsort1 = argsort1.cpu().numpy()
         return argsort1[:, 0].item()
 
-def kg_completion(config_path: str, dataset_dir: str, labels=False) -> None:
-    if not os.path.exists("saved_models"):
-        os.mkdir("saved_models")
-    cfg = get_yaml_config(config_path)
+def _words_to_ids(words: list[str], vocab) -> np.ndarray:
+    """
+    Internal function.
+    Map words to their vocabulary IDs, looking up each distinct word once
+    """
+    unique_words, inverse = np.unique(np.array(words), return_inverse=True)
+    unique_ids = np.array([vocab.getIndex(word) for word in unique_words], dtype=np.int64)
+    return unique_ids[inverse]
+
+def build_kg_graph(train_path: str, vocab_model, num_entities: int) -> GraphData:
+    """
+    Build the KG graph from the training triples of a wrangled dataset.
+    Each (e1, rel, e2) triple becomes an edge e1 -> e2 whose token is the ID of rel.
+
+    Parameters
+    ----------
+    - `train_path`: path to the e1rel_to_e2_train.json written by `wrangle_kg`
+    - `vocab_model`: vocabulary of the dataset, used to map entities and relations to IDs
+    - `num_entities`: number of entities (nodes) in the graph
+    """
+    e1_words = []
+    rel_words = []
+    e2_words = []
+    e2_counts = []
+    with open(train_path, "r", encoding="utf-8") as infile:
+        for line in infile:
+            data_point = json.loads(line)
+            e2_multi = data_point["e2_multi1"].split(" ")
+            e1_words.append(data_point["e1"])
+            rel_words.append(data_point["rel"])
+            e2_words += e2_multi
+            e2_counts.append(len(e2_multi))
+
+    # One row per (e1, rel) pair, expanded to one edge per e2
+    e2_counts = np.array(e2_counts, dtype=np.int64)
+    rows = np.repeat(_words_to_ids(e1_words, vocab_model.in_word_vocab), e2_counts)
+    rels = np.repeat(_words_to_ids(rel_words, vocab_model.out_word_vocab), e2_counts)
+    columns = _words_to_ids(e2_words, vocab_model.in_word_vocab)
+
+    return _graph_from_arrays(rows, rels, columns, num_entities)
+
+def _graph_from_arrays(rows: np.ndarray, rels: np.ndarray, columns: np.ndarray,
+                       num_entities: int) -> GraphData:
+    """
+    Internal function.
+    Build a KG graph with an edge rows[i] -> columns[i] with token rels[i] for each i.
+    GraphData holds one edge per (row, column) pair, so a pair linked by several relations gets
+    the token of its last relation, and edges are ordered by the first appearance of their pair.
+    """
+    # NOTE(lucas): GraphData.add_edges skips pairs that are already in the graph, so duplicate
+    # pairs have to be removed first for the tokens to line up with the edges
+    pairs = rows.astype(np.int64) * num_entities + columns
+    _, first = np.unique(pairs, return_index=True)
+    _, last_reversed = np.unique(pairs[::-1], return_index=True)
+    last = len(pairs) - 1 - last_reversed
+    order = np.argsort(first, kind="stable")
+    first = first[order]
+    last = last[order]
+
+    KG_graph = GraphData()
+    KG_graph.add_nodes(num_entities)
+    KG_graph.add_edges(rows[first].tolist(), columns[first].tolist())
+    if KG_graph.get_edge_num() != len(first):
+        raise RuntimeError(f"Expected {len(first)} edges in the KG graph, "
+                           f"got {KG_graph.get_edge_num()}")
+
+    for edge_attributes, rel in zip(KG_graph.edge_attributes, rels[last].tolist()):
+        edge_attributes["token"] = rel
+
+    return KG_graph
+
+# Version of the cached KG graph format
+_KG_GRAPH_VERSION = b"2"
+
+def _kg_graph_key(paths: list[str], vocab_model=None) -> str:
+    """
+    Internal function.
+    Hash the inputs of a KG graph: the files it is built from and, for JSON datasets, the entity
+    and relation vocabularies
+    """
+    # NOTE(lucas): Graphs cached before duplicate (e1, e2) pairs were handled have misplaced
+    # tokens, so the version is part of the key to stop reusing them
+    key = hashlib.sha256(_KG_GRAPH_VERSION)
+    for path in paths:
+        with open(path, "rb") as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), b""):
+                key.update(chunk)
+    if vocab_model is not None:
+        for vocab in (vocab_model.in_word_vocab, vocab_model.out_word_vocab):
+            key.update(json.dumps(sorted(vocab.word2index.items())).encode("utf-8"))
+
+    return key.hexdigest()[:16]
+
+def load_kg_graph(dataset, graph_dir: str, num_entities: int, build: bool=True) -> GraphData:
+    """
+    Load the KG graph of a dataset from a cache directory.
+    Cached graphs are named by a hash of the training triples and vocabulary, so a graph is only
+    rebuilt when those change.
+
+    Parameters
+    ----------
+    - `dataset`: the dataset to load the graph for
+    - `graph_dir`: directory of cached graphs
+    - `num_entities`: number of entities (nodes) in the graph
+    - `build`: build and cache the graph if there is no cached graph for the current training data.
+               If False, a missing graph raises FileNotFoundError
+    """
+    if isinstance(dataset, BinaryKGDataset):
+        key = _kg_graph_key(dataset.graph_input_paths())
+    else:
+        train_path = os.path.join(dataset.raw_dir, dataset.raw_file_names["train"])
+        key = _kg_graph_key([train_path], dataset.vocab_model)
+    graph_path = os.path.join(graph_dir, "KG_graph-{0}.pt".format(key))
+
+    if os.path.exists(graph_path):
+        try:
+            # NOTE(lucas): The graph is not a plain state dict, so it cannot be loaded with
+            # weights_only. Memory-mapping needs torch 2.1 or newer.
+            return torch.load(graph_path, mmap=True, weights_only=False)
+        except TypeError:
+            return torch.load(graph_path)
+
+    if not build:
+        raise FileNotFoundError(f"No KG graph for the current training data at {graph_path}. "
+                                "Set preprocess: true to build it.")
+
+    if isinstance(dataset, BinaryKGDataset):
+        rows, rels, columns = dataset.train.triples()
+        KG_graph = _graph_from_arrays(rows, rels, columns, num_entities)
+    else:
+        KG_graph = build_kg_graph(train_path, dataset.vocab_model, num_entities)
+    # Save to a temporary file first so concurrent runs never load a partially written graph
+    os.makedirs(graph_dir, exist_ok=True)
+    tmp_path = "{0}.{1}.tmp".format(graph_path, os.getpid())
+    torch.save(KG_graph, tmp_path)
+    os.replace(tmp_path, graph_path)
+
+    return KG_graph
+
+def load_dataset(dataset_dir: str, dataset_format: str="json"):
+    """
+    Load a dataset wrangled by `wrangle_kg`
+
+    Parameters
+    ----------
+    - `dataset_dir`: path to the preprocessed dataset
+    - `dataset_format`: one of {"json", "binary"}. "json" loads the e1rel_to_e2 files with
+                        graph4nlp, and "binary" loads the arrays written with `binary=True`
+    """
+    if dataset_format == "binary":
+        return BinaryKGDataset(dataset_dir)
+    if dataset_format == "json":
+        return KinshipDataset(
+            root_dir=dataset_dir,
+            topology_subdir="kgc",
+        )
+    raise ValueError(f"Unknown dataset format: {dataset_format}")
+
+def kg_completion(config, dataset_dir: str, labels=False, dataset=None, KG_graph=None,
+                  checkpoint_path: str=None, model_path: str=None) -> float:
+    """
+    Train and evaluate a KG completion model.
+    Training stops after `cfg["epochs"]` epochs, or early after `cfg["patience"]` validation rounds
+    without improvement if `cfg["patience"]` is positive.
+
+    Parameters
+    ----------
+    - `config`: path to a YAML config file, or a config dict. A dict is copied, not modified
+    - `dataset_dir`: path to the preprocessed dataset
+    - `labels`: whether the test and validation triples are labeled
+    - `dataset`: optional dataset already loaded from `dataset_dir`, e.g. shared by sweep trials
+    - `KG_graph`: optional KG graph of `dataset`, loaded with `load_kg_graph` if not given
+    - `checkpoint_path`: optional path to save the training state to when training stops. If it
+                         exists, training resumes from it, e.g. to give a trial more epochs
+    - `model_path`: optional path to save the best model to, and to load it from if
+                    `cfg["resume"]` is set. Defaults to saved_models/{dataset}_{model name}.model,
+                    where the model name only includes some of the settings, so runs that differ
+                    in other settings, like sweep trials, need their own path
+
+    Returns
+    ---------
+    The best validation result: accuracy if using labels, else MRR
+    """
+    if isinstance(config, str):
+        cfg = get_yaml_config(config)
+    else:
+        cfg = dict(config)
+
+    # NOTE(lucas): Check the mode before loading anything, so a typo does not fail in the first
+    # training batch. A YAML null turns negative sampling off, like "none"
+    negative_sampling = cfg["negative_sampling"] or "none"
+    if negative_sampling != "none" and negative_sampling not in NEGATIVE_SAMPLING_MODES:
+        raise ValueError(f"Unknown negative sampling mode: {negative_sampling}, expected one of "
+                         f"{('none',) + NEGATIVE_SAMPLING_MODES}")
+    cfg["negative_sampling"] = negative_sampling
 
     model_name = "{0}_{1}_{2}_{3}_{4}_{5}_{6}".format(
         cfg["model"],
@@ -275,9 +620,11 @@ def kg_completion(config_path: str, dataset_dir: str, labels=False) -> None:
         cfg["hidden_drop"],
         cfg["feat_drop"]
     )
-    model_path = "saved_models/{0}_{1}.model".format(
-        cfg["dataset"], model_name
-    )
+    if model_path is None:
+        model_path = "saved_models/{0}_{1}.model".format(
+            cfg["dataset"], model_name
+        )
+    os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
 
     torch.manual_seed(cfg["seed"])
 
@@ -285,10 +632,8 @@ def kg_completion(config_path: str, dataset_dir: str, labels=False) -> None:
     np.set_printoptions(precision=3)
     cudnn.benchmark = True
 
-    dataset = KinshipDataset(
-        root_dir=dataset_dir,
-        topology_subdir="kgc",
-    )
+    if dataset is None:
+        dataset = load_dataset(dataset_dir, cfg["dataset_format"])
 
     cfg["out_dir"] = os.path.join(cfg["out_dir"], "{0}_{1}".format(cfg["dataset"], model_name))
 
@@ -299,59 +644,47 @@ def kg_completion(config_path: str, dataset_dir: str, labels=False) -> None:
     )
     logger.write(cfg["out_dir"])
 
+    # The splits of binary datasets collate themselves
+    if isinstance(dataset, BinaryKGDataset):
+        train_collate_fn = dataset.train.collate_fn
+        val_collate_fn = dataset.val.collate_fn
+        test_collate_fn = dataset.test.collate_fn
+        vocab_model = None
+        num_entities = dataset.num_entities
+        num_relations = dataset.num_relations
+    else:
+        train_collate_fn = _sparse_collate
+        val_collate_fn = dataset.collate_fn
+        test_collate_fn = dataset.collate_fn
+        vocab_model = dataset.vocab_model
+        num_entities = len(dataset.vocab_model.in_word_vocab)
+        num_relations = len(dataset.vocab_model.out_word_vocab)
+
     train_dataloader = DataLoader(
         dataset.train,
         batch_size=cfg["batch_size"],
         shuffle=True,
         num_workers=cfg["loader_threads"],
-        collate_fn=dataset.collate_fn,
+        collate_fn=train_collate_fn,
     )
     val_dataloader = DataLoader(
         dataset.val,
         batch_size=cfg["batch_size"],
         shuffle=False,
         num_workers=cfg["loader_threads"],
-        collate_fn=dataset.collate_fn,
+        collate_fn=val_collate_fn,
     )
     test_dataloader = DataLoader(
         dataset.test,
         batch_size=cfg["batch_size"],
         shuffle=False,
         num_workers=cfg["loader_threads"],
-        collate_fn=dataset.collate_fn,
+        collate_fn=test_collate_fn,
     )
 
-    data = []
-    rows = []
-    columns = []
-    num_entities = len(dataset.vocab_model.in_word_vocab)
-    num_relations = len(dataset.vocab_model.out_word_vocab)
-
-    if cfg["preprocess"]:
-        for i, str2var in enumerate(train_dataloader):
-            print("batch number:", i)
-            for j in range(str2var["e1"].shape[0]):
-                for k in range(str2var["e2_multi1"][j].shape[0]):
-                    if str2var["e2_multi1"][j][k] != 0:
-                        data.append(str2var["rel"][j].tolist()[0])
-                        rows.append(str2var["e1"][j].tolist()[0])
-                        columns.append(str2var["e2_multi1"][j][k].tolist())
-                    else:
-                        break
-
-        from graph4nlp.pytorch.data.data import GraphData
-
-        KG_graph = GraphData()
-        KG_graph.add_nodes(num_entities)
-        for e1, rel, e2 in zip(rows, data, columns):
-            KG_graph.add_edge(e1, e2)
-            eid = KG_graph.edge_ids(e1, e2)[0]
-            KG_graph.edge_attributes[eid]["token"] = rel
-
-        torch.save(KG_graph, os.path.join(dataset_dir, "processed", "kgc", "KG_graph.pt"))
-    else:
-        graph_path = os.path.join(dataset_dir, "processed", "kgc", "KG_graph.pt")
-        KG_graph = torch.load(graph_path)
+    if KG_graph is None:
+        graph_dir = os.path.join(dataset_dir, "processed", "kgc")
+        KG_graph = load_kg_graph(dataset, graph_dir, num_entities, build=cfg["preprocess"])
 
     if cfg["cuda"] is True:
         KG_graph = KG_graph.to("cuda")
@@ -378,7 +711,7 @@ def kg_completion(config_path: str, dataset_dir: str, labels=False) -> None:
             cfg,
             model,
             test_dataloader,
-            dataset.vocab_model,
+            vocab_model,
             "test_evaluation",
             kg_graph=KG_graph,
             logger=logger,
@@ -388,7 +721,7 @@ def kg_completion(config_path: str, dataset_dir: str, labels=False) -> None:
             cfg,
             model,
             val_dataloader,
-            dataset.vocab_model,
+            vocab_model,
             "dev_evaluation",
             kg_graph=KG_graph,
             logger=logger,
@@ -404,24 +737,67 @@ def kg_completion(config_path: str, dataset_dir: str, labels=False) -> None:
 
     # Result is accuracy if using labels and MRR if not using labels
     best_result = 0.0
+    # Number of validation rounds since the best result
+    bad_rounds = 0
+    stopped = False
+    trained_epochs = 0
+
+    # Sample the neighborhood of each batch instead of propagating through the whole graph
+    sampler = None
+    if cfg["sampled_training"]:
+        if hasattr(model.model, "encode"):
+            sampler = NeighborSampler(KG_graph, num_entities, cfg["fanouts"])
+        else:
+            print("{0} has no GNN, training on the whole graph".format(cfg["model"]))
 
     opt = torch.optim.Adam(model.parameters(), lr=cfg["lr"], weight_decay=cfg["l2"])
-    for epoch in range(cfg["epochs"]):
+
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path)
+        model.load_state_dict(checkpoint["model"])
+        opt.load_state_dict(checkpoint["optimizer"])
+        trained_epochs = checkpoint["epoch"]
+        best_result = checkpoint["best_result"]
+        bad_rounds = checkpoint["bad_rounds"]
+        stopped = checkpoint["stopped"]
+        logger.write("Resuming from epoch {0}".format(trained_epochs))
+
+    for epoch in range(trained_epochs, cfg["epochs"]):
+        if stopped:
+            break
+
         model.train()
         for str2var in train_dataloader:
             opt.zero_grad()
             e1_tensor = str2var["e1_tensor"]
             rel_tensor = str2var["rel_tensor"]
-            e2_multi = str2var["e2_multi1_binary"].float()
             if cfg["cuda"]:
                 e1_tensor = e1_tensor.to("cuda")
                 rel_tensor = rel_tensor.to("cuda")
-                e2_multi = e2_multi.to("cuda")
-            # label smoothing
-            e2_multi = ((1.0 - cfg["label_smoothing"]) * e2_multi) + (1.0 / e2_multi.size(1))
 
-            pred = model(e1_tensor, rel_tensor, KG_graph)
-            loss = model.loss(pred, e2_multi)
+            if negative_sampling != "none":
+                # Score against the positives and sampled negatives instead of every entity
+                positives = str2var["e2_multi1"].long()
+                if cfg["cuda"]:
+                    positives = positives.to("cuda")
+                negatives = sample_negatives(positives, cfg["num_negatives"], num_entities)
+                candidates = torch.cat([positives, negatives], 1)
+                logits = model.score_candidates(e1_tensor, rel_tensor, candidates, KG_graph,
+                                                sampler)
+                loss = negative_sampling_loss(logits, positives, negatives, negative_sampling,
+                                              cfg["adversarial_temperature"])
+            else:
+                e2_offsets = str2var["e2_offsets"]
+                e2_indices = str2var["e2_indices"]
+                if cfg["cuda"]:
+                    e2_offsets = e2_offsets.to("cuda")
+                    e2_indices = e2_indices.to("cuda")
+
+                if sampler is not None:
+                    logits = model.sampled_forward(e1_tensor, rel_tensor, sampler, logits=True)
+                else:
+                    logits = model(e1_tensor, rel_tensor, KG_graph, logits=True)
+                loss = model.loss(logits, e2_offsets, e2_indices)
             loss.backward()
             opt.step()
 
@@ -434,7 +810,7 @@ def kg_completion(config_path: str, dataset_dir: str, labels=False) -> None:
                     cfg,
                     model,
                     val_dataloader,
-                    dataset.vocab_model,
+                    vocab_model,
                     "dev_evaluation",
                     kg_graph=KG_graph,
                     logger=logger,
@@ -442,18 +818,38 @@ def kg_completion(config_path: str, dataset_dir: str, labels=False) -> None:
                 )
                 if result > best_result:
                     best_result = result
+                    bad_rounds = 0
                     logger.write("Best model")
                     print("saving best model to {0}".format(model_path))
                     torch.save(model.state_dict(), model_path)
+                else:
+                    bad_rounds += 1
+                    if 0 < cfg["patience"] <= bad_rounds:
+                        logger.write("Early stopping after {0} epochs".format(epoch + 1))
+                        stopped = True
             if epoch % 2 == 0:
                 if epoch > 0:
                     ranking_and_hits_this(
                         cfg,
                         model,
                         test_dataloader,
-                        dataset.vocab_model,
+                        vocab_model,
                         "test_evaluation",
                         kg_graph=KG_graph,
                         logger=logger,
                         labels=labels
                     )
+        trained_epochs = epoch + 1
+
+    if checkpoint_path is not None:
+        checkpoint = {
+            "model": model.state_dict(),
+            "optimizer": opt.state_dict(),
+            "epoch": trained_epochs,
+            "best_result": best_result,
+            "bad_rounds": bad_rounds,
+            "stopped": stopped,
+        }
+        torch.save(checkpoint, checkpoint_path)
+
+    return best_result
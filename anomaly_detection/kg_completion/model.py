@@ -3,11 +3,52 @@ from torch.nn import Parameter
 from torch.nn import functional as F
 from torch.nn.init import xavier_normal_
 
+from graph4nlp.pytorch.data.data import to_batch
 from graph4nlp.pytorch.modules.graph_embedding_learning.gcn import GCN
 from graph4nlp.pytorch.modules.graph_embedding_learning.ggnn import GGNN
-from graph4nlp.pytorch.modules.prediction.classification.kg_completion import ComplEx, DistMult
 
 
+def _distmult_logits(e1_embedded, rel_embedded, entity_weight):
+    """
+    Internal function.
+    DistMult scores of (e1, rel) pairs against all entities, before the sigmoid
+    """
+    return torch.mm(e1_embedded * rel_embedded, entity_weight.transpose(1, 0))
+
+def _complex_logits(e1_embedded_real, rel_embedded_real, e1_embedded_img, rel_embedded_img,
+                    entity_weight_real, entity_weight_img):
+    """
+    Internal function.
+    ComplEx scores of (e1, rel) pairs against all entities, before the sigmoid
+    """
+    # complex space bilinear product (equivalent to HolE)
+    realrealreal = torch.mm(e1_embedded_real * rel_embedded_real, entity_weight_real.transpose(1, 0))
+    realimgimg = torch.mm(e1_embedded_real * rel_embedded_img, entity_weight_img.transpose(1, 0))
+    imgrealimg = torch.mm(e1_embedded_img * rel_embedded_real, entity_weight_img.transpose(1, 0))
+    imgimgreal = torch.mm(e1_embedded_img * rel_embedded_img, entity_weight_real.transpose(1, 0))
+
+    return realrealreal + realimgimg + imgrealimg - imgimgreal
+
+def _distmult_candidate_logits(e1_embedded, rel_embedded, candidates_embedded):
+    """
+    Internal function.
+    DistMult scores of (e1, rel) pairs against one row of candidate entities per pair,
+    before the sigmoid
+    """
+    return torch.bmm(candidates_embedded, (e1_embedded * rel_embedded).unsqueeze(2)).squeeze(2)
+
+def _complex_candidate_logits(e1_embedded_real, rel_embedded_real, e1_embedded_img,
+                              rel_embedded_img, candidates_real, candidates_img):
+    """
+    Internal function.
+    ComplEx scores of (e1, rel) pairs against one row of candidate entities per pair,
+    before the sigmoid
+    """
+    return (_distmult_candidate_logits(e1_embedded_real, rel_embedded_real, candidates_real)
+            + _distmult_candidate_logits(e1_embedded_real, rel_embedded_img, candidates_img)
+            + _distmult_candidate_logits(e1_embedded_img, rel_embedded_real, candidates_img)
+            - _distmult_candidate_logits(e1_embedded_img, rel_embedded_img, candidates_real))
+
 
 class Complex(torch.nn.Module):
     def __init__(self, args, num_entities, num_relations):
@@ -26,7 +67,7 @@ class Complex(torch.nn.Module):
         xavier_normal_(self.emb_rel_real.weight.data)
         xavier_normal_(self.emb_rel_img.weight.data)
 
-    def forward(self, sub, rel, kg_graph=None):
+    def forward(self, sub, rel, kg_graph=None, logits=False):
 
         e1_embedded_real = self.emb_e_real(sub).squeeze(1)
         rel_embedded_real = self.emb_rel_real(rel).squeeze(1)
@@ -38,24 +79,27 @@ class Complex(torch.nn.Module):
         e1_embedded_img = self.inp_drop(e1_embedded_img)
         rel_embedded_img = self.inp_drop(rel_embedded_img)
 
-        # complex space bilinear product (equivalent to HolE)
-        realrealreal = torch.mm(
-            e1_embedded_real * rel_embedded_real, self.emb_e_real.weight.transpose(1, 0)
-        )
-        realimgimg = torch.mm(
-            e1_embedded_real * rel_embedded_img, self.emb_e_img.weight.transpose(1, 0)
-        )
-        imgrealimg = torch.mm(
-            e1_embedded_img * rel_embedded_real, self.emb_e_img.weight.transpose(1, 0)
-        )
-        imgimgreal = torch.mm(
-            e1_embedded_img * rel_embedded_img, self.emb_e_real.weight.transpose(1, 0)
-        )
-        pred = realrealreal + realimgimg + imgrealimg - imgimgreal
+        pred = _complex_logits(e1_embedded_real, rel_embedded_real, e1_embedded_img,
+                               rel_embedded_img, self.emb_e_real.weight, self.emb_e_img.weight)
+        if logits:
+            return pred
         pred = torch.sigmoid(pred)
 
         return pred
 
+    def score_candidates(self, sub, rel, candidates, entity_table=None):
+        """
+        Score (sub, rel) pairs against a row of candidate entity IDs per pair. Returns logits.
+        """
+        e1_embedded_real = self.inp_drop(self.emb_e_real(sub).squeeze(1))
+        rel_embedded_real = self.inp_drop(self.emb_rel_real(rel).squeeze(1))
+        e1_embedded_img = self.inp_drop(self.emb_e_img(sub).squeeze(1))
+        rel_embedded_img = self.inp_drop(self.emb_rel_img(rel).squeeze(1))
+
+        return _complex_candidate_logits(e1_embedded_real, rel_embedded_real, e1_embedded_img,
+                                         rel_embedded_img, self.emb_e_real(candidates),
+                                         self.emb_e_img(candidates))
+
 
 class ConvE(torch.nn.Module):
     def __init__(self, args, num_entities, num_relations):
@@ -80,7 +124,10 @@ class ConvE(torch.nn.Module):
         xavier_normal_(self.emb_e.weight.data)
         xavier_normal_(self.emb_rel.weight.data)
 
-    def forward(self, sub, rel, kg_graph=None):
+    def _query(self, sub, rel):
+        """
+        Convolve the (sub, rel) embeddings into the vector that is matched against the entities
+        """
         e1_embedded = self.emb_e(sub).view(-1, 1, self.emb_dim1, self.emb_dim2)
         rel_embedded = self.emb_rel(rel).view(-1, 1, self.emb_dim1, self.emb_dim2)
 
@@ -97,12 +144,29 @@ class ConvE(torch.nn.Module):
         x = self.hidden_drop(x)
         x = self.bn2(x)
         x = F.relu(x)
+
+        return x
+
+    def forward(self, sub, rel, kg_graph=None, logits=False):
+        x = self._query(sub, rel)
         x = torch.mm(x, self.emb_e.weight.transpose(1, 0))
         x += self.b.expand_as(x)
+        if logits:
+            return x
         pred = torch.sigmoid(x)
 
         return pred
 
+    def score_candidates(self, sub, rel, candidates, entity_table=None):
+        """
+        Score (sub, rel) pairs against a row of candidate entity IDs per pair. Returns logits.
+        """
+        x = self._query(sub, rel)
+        x = torch.bmm(self.emb_e(candidates), x.unsqueeze(2)).squeeze(2)
+        x += self.b[candidates]
+
+        return x
+
 class GGNNConvE(torch.nn.Module):
     def __init__(self, args, num_entities, num_relations, num_layers=2):
         super(GGNNConvE, self).__init__()
@@ -208,7 +272,7 @@ class Distmult(torch.nn.Module):
         xavier_normal_(self.emb_e.weight.data)
         xavier_normal_(self.emb_rel.weight.data)
 
-    def forward(self, sub, rel, kg_graph=None):
+    def forward(self, sub, rel, kg_graph=None, logits=False):
         e1_embedded = self.emb_e(sub)
         rel_embedded = self.emb_rel(rel)
         e1_embedded = e1_embedded.squeeze(1)
@@ -217,11 +281,22 @@ class Distmult(torch.nn.Module):
         e1_embedded = self.inp_drop(e1_embedded)
         rel_embedded = self.inp_drop(rel_embedded)
 
-        pred = torch.mm(e1_embedded * rel_embedded, self.emb_e.weight.transpose(1, 0))
+        pred = _distmult_logits(e1_embedded, rel_embedded, self.emb_e.weight)
+        if logits:
+            return pred
         pred = torch.sigmoid(pred)
 
         return pred
 
+    def score_candidates(self, sub, rel, candidates, entity_table=None):
+        """
+        Score (sub, rel) pairs against a row of candidate entity IDs per pair. Returns logits.
+        """
+        e1_embedded = self.inp_drop(self.emb_e(sub).squeeze(1))
+        rel_embedded = self.inp_drop(self.emb_rel(rel).squeeze(1))
+
+        return _distmult_candidate_logits(e1_embedded, rel_embedded, self.emb_e(candidates))
+
 
 class GGNNDistMult(torch.nn.Module):
     def __init__(self, args, num_entities, num_relations, num_layers=2):
@@ -243,27 +318,60 @@ class GGNNDistMult(torch.nn.Module):
         self.direction_option = args["direction_option"]
 
         self.loss = torch.nn.BCELoss()
-        self.distmult = DistMult(args["input_drop"], loss_name="BCELoss")
+        self.inp_drop = torch.nn.Dropout(args["input_drop"])
 
     def init(self):
         xavier_normal_(self.emb_e.weight.data)
         xavier_normal_(self.emb_rel.weight.data)
 
-    def forward(self, sub, rel, kg_graph):
-        X = torch.LongTensor(list(range(self.num_entities))).to(sub.device)
+    def encode(self, kg_graph, node_ids=None):
+        """
+        Propagate the entity embeddings through the GNN. Returns the entity table.
+
+        If `node_ids` is given, `kg_graph` is a sampled subgraph whose node i is entity
+        `node_ids[i]`, and row i of the table is the embedding of that entity.
+        """
+        X = node_ids
+        if X is None:
+            X = torch.arange(self.num_entities, device=self.emb_e.weight.device)
 
         kg_graph.node_features["node_feat"] = self.emb_e(X)
         kg_graph = self.gnn(kg_graph)
 
-        e1_embedded = kg_graph.node_features["node_feat"][sub]
+        return kg_graph.node_features["node_feat"]
+
+    def score(self, sub, rel, entity_table, kg_graph=None, logits=False):
+        """
+        Score (sub, rel) pairs against all entities using the entity table from `encode`.
+        Returns probabilities, or logits if `logits` is True.
+        """
+        e1_embedded = entity_table[sub]
         rel_embedded = self.emb_rel(rel)
         e1_embedded = e1_embedded.squeeze(1)
         rel_embedded = rel_embedded.squeeze(1)
 
-        kg_graph = self.distmult(kg_graph, e1_embedded, rel_embedded, self.emb_e)
-        logits = kg_graph.graph_attributes["logits"]
+        e1_embedded = self.inp_drop(e1_embedded)
+        rel_embedded = self.inp_drop(rel_embedded)
 
-        return logits
+        pred = _distmult_logits(e1_embedded, rel_embedded, self.emb_e.weight)
+        if logits:
+            return pred
+        pred = torch.sigmoid(pred)
+
+        return pred
+
+    def forward(self, sub, rel, kg_graph=None, logits=False):
+        return self.score(sub, rel, self.encode(kg_graph), kg_graph, logits)
+
+    def score_candidates(self, sub, rel, candidates, entity_table):
+        """
+        Score (sub, rel) pairs against a row of candidate entity IDs per pair, using the entity
+        table from `encode` for `sub`. Returns logits.
+        """
+        e1_embedded = self.inp_drop(entity_table[sub].squeeze(1))
+        rel_embedded = self.inp_drop(self.emb_rel(rel).squeeze(1))
+
+        return _distmult_candidate_logits(e1_embedded, rel_embedded, self.emb_e(candidates))
 
 
 class GCNDistMult(torch.nn.Module):
@@ -286,7 +394,7 @@ class GCNDistMult(torch.nn.Module):
         )
 
         self.direction_option = args["direction_option"]
-        self.distmult = DistMult(args["input_drop"], loss_name="BCELoss")
+        self.inp_drop = torch.nn.Dropout(args["input_drop"])
         self.loss = torch.nn.BCELoss()
         # self.loss = KGLoss('SigmoidLoss')
 
@@ -294,21 +402,54 @@ class GCNDistMult(torch.nn.Module):
         xavier_normal_(self.emb_e.weight.data)
         xavier_normal_(self.emb_rel.weight.data)
 
-    def forward(self, sub, rel, kg_graph=None):
-        X = torch.LongTensor(list(range(self.num_entities))).to(sub.device)
+    def encode(self, kg_graph, node_ids=None):
+        """
+        Propagate the entity embeddings through the GNN. Returns the entity table.
+
+        If `node_ids` is given, `kg_graph` is a sampled subgraph whose node i is entity
+        `node_ids[i]`, and row i of the table is the embedding of that entity.
+        """
+        X = node_ids
+        if X is None:
+            X = torch.arange(self.num_entities, device=self.emb_e.weight.device)
 
         kg_graph.node_features["node_feat"] = self.emb_e(X)
         kg_graph = self.gnn(kg_graph)
 
-        e1_embedded = kg_graph.node_features["node_feat"][sub]
+        return kg_graph.node_features["node_feat"]
+
+    def score(self, sub, rel, entity_table, kg_graph=None, logits=False):
+        """
+        Score (sub, rel) pairs against all entities using the entity table from `encode`.
+        Returns probabilities, or logits if `logits` is True.
+        """
+        e1_embedded = entity_table[sub]
         rel_embedded = self.emb_rel(rel)
         e1_embedded = e1_embedded.squeeze(1)
         rel_embedded = rel_embedded.squeeze(1)
 
-        kg_graph = self.distmult(kg_graph, e1_embedded, rel_embedded, self.emb_e)
-        logits = kg_graph.graph_attributes["logits"]
+        e1_embedded = self.inp_drop(e1_embedded)
+        rel_embedded = self.inp_drop(rel_embedded)
 
-        return logits
+        pred = _distmult_logits(e1_embedded, rel_embedded, self.emb_e.weight)
+        if logits:
+            return pred
+        pred = torch.sigmoid(pred)
+
+        return pred
+
+    def forward(self, sub, rel, kg_graph=None, logits=False):
+        return self.score(sub, rel, self.encode(kg_graph), kg_graph, logits)
+
+    def score_candidates(self, sub, rel, candidates, entity_table):
+        """
+        Score (sub, rel) pairs against a row of candidate entity IDs per pair, using the entity
+        table from `encode` for `sub`. Returns logits.
+        """
+        e1_embedded = self.inp_drop(entity_table[sub].squeeze(1))
+        rel_embedded = self.inp_drop(self.emb_rel(rel).squeeze(1))
+
+        return _distmult_candidate_logits(e1_embedded, rel_embedded, self.emb_e(candidates))
 
 class GGNNComplex(torch.nn.Module):
     def __init__(self, args, num_entities, num_relations, num_layers=2):
@@ -334,7 +475,9 @@ class GGNNComplex(torch.nn.Module):
 
         self.direction_option = args["direction_option"]
         self.loss = torch.nn.BCELoss()
-        self.complex = ComplEx(args["input_drop"])
+        # Graph batched from two copies of the KG graph, used to propagate the real and imaginary
+        # embeddings in one pass
+        self.stacked_graph = None
 
     def init(self):
         xavier_normal_(self.emb_e_real.weight.data)
@@ -342,32 +485,68 @@ class GGNNComplex(torch.nn.Module):
         xavier_normal_(self.emb_rel_real.weight.data)
         xavier_normal_(self.emb_rel_img.weight.data)
 
-    def forward(self, sub, rel, kg_graph=None):
-        X = torch.LongTensor(list(range(self.num_entities))).to(sub.device)
+    def encode(self, kg_graph, node_ids=None):
+        """
+        Propagate the real and imaginary entity embeddings through the GNN. Both are stacked into
+        one batched graph, so the GNN runs once. Returns the real and imaginary entity tables.
+
+        If `node_ids` is given, `kg_graph` is a sampled subgraph whose node i is entity
+        `node_ids[i]`, and row i of each table is the embedding of that entity.
+        """
+        X = node_ids
+        if X is None:
+            X = torch.arange(self.num_entities, device=self.emb_e_real.weight.device)
+
+        # Sampled subgraphs change every step, so only the full graph's batch is kept
+        if node_ids is not None:
+            batch_graph = to_batch([kg_graph, kg_graph])
+        else:
+            if self.stacked_graph is None or self.stacked_graph[0] is not kg_graph:
+                self.stacked_graph = (kg_graph, to_batch([kg_graph, kg_graph]))
+            batch_graph = self.stacked_graph[1]
+
+        batch_graph.node_features["node_feat"] = torch.cat([self.emb_e_real(X), self.emb_e_img(X)])
+        batch_graph = self.gnn(batch_graph)
+        node_feat = batch_graph.node_features["node_feat"]
+
+        return node_feat[:X.shape[0]], node_feat[X.shape[0]:]
+
+    def score(self, sub, rel, entity_table, kg_graph=None, logits=False):
+        """
+        Score (sub, rel) pairs against all entities using entity tables from `encode`.
+        Returns probabilities, or logits if `logits` is True.
+        """
+        e1_embedded_real = self.inp_drop(entity_table[0][sub].squeeze(1))
+        e1_embedded_img = self.inp_drop(entity_table[1][sub].squeeze(1))
+
+        rel_embedded_real = self.inp_drop(self.emb_rel_real(rel).squeeze(1))
+        rel_embedded_img = self.inp_drop(self.emb_rel_img(rel).squeeze(1))
+
+        pred = _complex_logits(e1_embedded_real, rel_embedded_real, e1_embedded_img,
+                               rel_embedded_img, self.emb_e_real.weight, self.emb_e_img.weight)
+        if logits:
+            return pred
+        pred = torch.sigmoid(pred)
 
-        kg_graph.node_features["node_feat"] = self.emb_e_real(X)
-        kg_graph = self.gnn(kg_graph)
-        e1_embedded_real = kg_graph.node_features["node_feat"][sub].squeeze(1)
+        return pred
 
-        kg_graph.node_features["node_feat"] = self.emb_e_img(X)
-        kg_graph = self.gnn(kg_graph)
-        e1_embedded_img = kg_graph.node_features["node_feat"][sub].squeeze(1)
+    def forward(self, sub, rel, kg_graph=None, logits=False):
+        return self.score(sub, rel, self.encode(kg_graph), kg_graph, logits)
 
-        rel_embedded_real = self.emb_rel_real(rel).squeeze(1)
-        rel_embedded_img = self.emb_rel_img(rel).squeeze(1)
+    def score_candidates(self, sub, rel, candidates, entity_table):
+        """
+        Score (sub, rel) pairs against a row of candidate entity IDs per pair, using the entity
+        tables from `encode` for `sub`. Returns logits.
+        """
+        e1_embedded_real = self.inp_drop(entity_table[0][sub].squeeze(1))
+        e1_embedded_img = self.inp_drop(entity_table[1][sub].squeeze(1))
 
-        kg_graph = self.complex(
-            kg_graph,
-            e1_embedded_real,
-            rel_embedded_real,
-            e1_embedded_img,
-            rel_embedded_img,
-            self.emb_e_real,
-            self.emb_e_img,
-        )
-        logits = kg_graph.graph_attributes["logits"]
+        rel_embedded_real = self.inp_drop(self.emb_rel_real(rel).squeeze(1))
+        rel_embedded_img = self.inp_drop(self.emb_rel_img(rel).squeeze(1))
 
-        return logits
+        return _complex_candidate_logits(e1_embedded_real, rel_embedded_real, e1_embedded_img,
+                                         rel_embedded_img, self.emb_e_real(candidates),
+                                         self.emb_e_img(candidates))
 
 class GCNComplex(torch.nn.Module):
     def __init__(self, args, num_entities, num_relations, num_layers=2):
@@ -393,7 +572,9 @@ class GCNComplex(torch.nn.Module):
 
         self.direction_option = args["direction_option"]
         self.loss = torch.nn.BCELoss()
-        self.complex = ComplEx(args["input_drop"])
+        # Graph batched from two copies of the KG graph, used to propagate the real and imaginary
+        # embeddings in one pass
+        self.stacked_graph = None
 
     def init(self):
         xavier_normal_(self.emb_e_real.weight.data)
@@ -401,73 +582,65 @@ class GCNComplex(torch.nn.Module):
         xavier_normal_(self.emb_rel_real.weight.data)
         xavier_normal_(self.emb_rel_img.weight.data)
 
-    def forward(self, sub, rel, kg_graph=None):
-        X = torch.LongTensor(list(range(self.num_entities))).to(sub.device)
-
-        kg_graph.node_features["node_feat"] = self.emb_e_real(X)
-        kg_graph = self.gnn(kg_graph)
-        e1_embedded_real = kg_graph.node_features["node_feat"][sub].squeeze(1)
-
-        kg_graph.node_features["node_feat"] = self.emb_e_img(X)
-        kg_graph = self.gnn(kg_graph)
-        e1_embedded_img = kg_graph.node_features["node_feat"][sub].squeeze(1)
-
-        rel_embedded_real = self.emb_rel_real(rel).squeeze(1)
-        rel_embedded_img = self.emb_rel_img(rel).squeeze(1)
-
-        kg_graph = self.complex(
-            kg_graph,
-            e1_embedded_real,
-            rel_embedded_real,
-            e1_embedded_img,
-            rel_embedded_img,
-            self.emb_e_real,
-            self.emb_e_img,
-        )
-        logits = kg_graph.graph_attributes["logits"]
-
-        return logits
-
-class GCNDistMult(torch.nn.Module):
-    def __init__(self, args, num_entities, num_relations, num_layers=2):
-        super(GCNDistMult, self).__init__()
-        self.emb_e = torch.nn.Embedding(num_entities, args["embedding_dim"], padding_idx=0)
-        self.emb_rel = torch.nn.Embedding(num_relations, args["embedding_dim"], padding_idx=0)
-
-        self.num_entities = num_entities
-        self.num_relations = num_relations
-
-        self.num_layers = num_layers
-        self.gnn = GCN(
-            self.num_layers,
-            args["embedding_dim"],
-            args["embedding_dim"],
-            args["embedding_dim"],
-            args["direction_option"],
-            feat_drop=args["input_drop"],
-        )
-
-        self.direction_option = args["direction_option"]
-        self.distmult = DistMult(args["input_drop"], loss_name="BCELoss")
-        self.loss = torch.nn.BCELoss()
-        # self.loss = KGLoss('SigmoidLoss')
-
-    def init(self):
-        xavier_normal_(self.emb_e.weight.data)
-        xavier_normal_(self.emb_rel.weight.data)
+    def encode(self, kg_graph, node_ids=None):
+        """
+        Propagate the real and imaginary entity embeddings through the GNN. Both are stacked into
+        one batched graph, so the GNN runs once. Returns the real and imaginary entity tables.
+
+        If `node_ids` is given, `kg_graph` is a sampled subgraph whose node i is entity
+        `node_ids[i]`, and row i of each table is the embedding of that entity.
+        """
+        X = node_ids
+        if X is None:
+            X = torch.arange(self.num_entities, device=self.emb_e_real.weight.device)
+
+        # Sampled subgraphs change every step, so only the full graph's batch is kept
+        if node_ids is not None:
+            batch_graph = to_batch([kg_graph, kg_graph])
+        else:
+            if self.stacked_graph is None or self.stacked_graph[0] is not kg_graph:
+                self.stacked_graph = (kg_graph, to_batch([kg_graph, kg_graph]))
+            batch_graph = self.stacked_graph[1]
+
+        batch_graph.node_features["node_feat"] = torch.cat([self.emb_e_real(X), self.emb_e_img(X)])
+        batch_graph = self.gnn(batch_graph)
+        node_feat = batch_graph.node_features["node_feat"]
+
+        return node_feat[:X.shape[0]], node_feat[X.shape[0]:]
+
+    def score(self, sub, rel, entity_table, kg_graph=None, logits=False):
+        """
+        Score (sub, rel) pairs against all entities using entity tables from `encode`.
+        Returns probabilities, or logits if `logits` is True.
+        """
+        e1_embedded_real = self.inp_drop(entity_table[0][sub].squeeze(1))
+        e1_embedded_img = self.inp_drop(entity_table[1][sub].squeeze(1))
+
+        rel_embedded_real = self.inp_drop(self.emb_rel_real(rel).squeeze(1))
+        rel_embedded_img = self.inp_drop(self.emb_rel_img(rel).squeeze(1))
+
+        pred = _complex_logits(e1_embedded_real, rel_embedded_real, e1_embedded_img,
+                               rel_embedded_img, self.emb_e_real.weight, self.emb_e_img.weight)
+        if logits:
+            return pred
+        pred = torch.sigmoid(pred)
 
-    def forward(self, sub, rel, kg_graph=None):
-        X = torch.LongTensor(list(range(self.num_entities))).to(sub.device)
+        return pred
 
-        kg_graph.node_features["node_feat"] = self.emb_e(X)
-        kg_graph = self.gnn(kg_graph)
+    def forward(self, sub, rel, kg_graph=None, logits=False):
+        return self.score(sub, rel, self.encode(kg_graph), kg_graph, logits)
 
-        e1_embedded = kg_graph.node_features["node_feat"][sub]
-        rel_embedded = self.emb_rel(rel)
-        e1_embedded = e1_embedded.squeeze(1)
-        rel_embedded = rel_embedded.squeeze(1)
+    def score_candidates(self, sub, rel, candidates, entity_table):
+        """
+        Score (sub, rel) pairs against a row of candidate entity IDs per pair, using the entity
+        tables from `encode` for `sub`. Returns logits.
+        """
+        e1_embedded_real = self.inp_drop(entity_table[0][sub].squeeze(1))
+        e1_embedded_img = self.inp_drop(entity_table[1][sub].squeeze(1))
 
-        kg_graph = self.distmult(kg_graph, e1_embedded, rel_embedded, self.emb_e)
-        logits = kg_graph.graph_attributes["logits"]
+        rel_embedded_real = self.inp_drop(self.emb_rel_real(rel).squeeze(1))
+        rel_embedded_img = self.inp_drop(self.emb_rel_img(rel).squeeze(1))
 
-        return logits
+        return _complex_candidate_logits(e1_embedded_real, rel_embedded_real, e1_embedded_img,
+                                         rel_embedded_img, self.emb_e_real(candidates),
+                                         self.emb_e_img(candidates))
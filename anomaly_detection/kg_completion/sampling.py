@@ -0,0 +1,185 @@
+"""
+Sampling for training on large knowledge graphs.
+Neighborhood sampling propagates each batch through the k-hop neighborhood of its entities
+instead of the whole KG graph, with a limit on the number of neighbors sampled per entity at each
+hop. Negative sampling scores each (e1, rel) pair against its positives and a few sampled entities
+instead of every entity.
+"""
+
+import torch
+from torch.nn import functional as F
+
+from graph4nlp.pytorch.data.data import GraphData
+
+# Modes of `negative_sampling_loss`
+NEGATIVE_SAMPLING_MODES = ("uniform", "self_adversarial")
+
+
+def _expand_ranges(starts: torch.Tensor, counts: torch.Tensor) -> torch.Tensor:
+    """
+    Internal function.
+    Concatenate the ranges [start, start + count) for each start and count
+    """
+    if counts.numel() == 0:
+        return counts.new_empty(0)
+
+    offsets = torch.cumsum(counts, 0) - counts
+    positions = torch.arange(int(counts.sum()), device=counts.device)
+    return torch.repeat_interleave(starts - offsets, counts) + positions
+
+
+class NeighborSampler:
+    """
+    Samples the subgraph needed to compute GNN embeddings for a batch of entities.
+
+    Edges are followed in both directions, since the bidirectional GNNs also aggregate over
+    incoming edges. The subgraph keeps the direction of the sampled edges.
+
+    Parameters
+    ----------
+    - `kg_graph`: the full KG graph
+    - `num_entities`: number of entities (nodes) in `kg_graph`
+    - `fanouts`: maximum number of neighbors to sample per entity at each hop. The number of hops
+                 should match the number of GNN layers. A fanout of -1 keeps all neighbors
+    """
+    def __init__(self, kg_graph: GraphData, num_entities: int, fanouts: list[int]):
+        self.num_entities = num_entities
+        self.fanouts = list(fanouts)
+
+        edges = kg_graph.get_all_edges()
+        self.src = torch.tensor([edge[0] for edge in edges], dtype=torch.long)
+        self.tgt = torch.tensor([edge[1] for edge in edges], dtype=torch.long)
+
+        # Undirected adjacency in CSR form: the neighbors of node n and the IDs of the edges
+        # connecting them are at positions indptr[n]:indptr[n + 1]
+        nodes = torch.cat([self.src, self.tgt])
+        order = torch.argsort(nodes, stable=True)
+        edge_ids = torch.arange(len(edges))
+        self.neighbors = torch.cat([self.tgt, self.src])[order]
+        self.edge_ids = torch.cat([edge_ids, edge_ids])[order]
+        self.indptr = torch.zeros(num_entities + 1, dtype=torch.long)
+        self.indptr[1:] = torch.cumsum(torch.bincount(nodes, minlength=num_entities), 0)
+
+    def _sample_hop(self, frontier: torch.Tensor, fanout: int) -> torch.Tensor:
+        """
+        Sample up to `fanout` neighbor positions in the adjacency for each node in the frontier
+        """
+        starts = self.indptr[frontier]
+        degrees = self.indptr[frontier + 1] - starts
+        if fanout < 0:
+            return _expand_ranges(starts, degrees)
+
+        # Keep every neighbor of nodes with few neighbors
+        keep_all = degrees <= fanout
+        positions = _expand_ranges(starts[keep_all], degrees[keep_all])
+
+        # NOTE(lucas): Neighbors of high-degree nodes (e.g., type entities) are sampled with
+        # replacement so the work per node is bounded by the fanout, not the degree. Duplicates
+        # are dropped when the edges are merged.
+        starts = starts[~keep_all].repeat_interleave(fanout)
+        degrees = degrees[~keep_all].repeat_interleave(fanout)
+        sampled = starts + (torch.rand(degrees.shape) * degrees).long()
+
+        return torch.cat([positions, sampled])
+
+    def sample(self, seeds: torch.Tensor) -> tuple[GraphData, torch.Tensor, torch.Tensor]:
+        """
+        Sample the computation graph for a batch of entities
+
+        Parameters
+        ----------
+        - `seeds`: entity IDs of the batch, of any shape
+
+        Returns
+        ---------
+        - the sampled subgraph, whose node i is entity `node_ids[i]`
+        - `node_ids`: the entity IDs of the subgraph nodes, on the same device as `seeds`
+        - `local_seeds`: the subgraph node index of each seed, with the same shape as `seeds`
+        """
+        device = seeds.device
+        seeds = seeds.cpu()
+
+        visited = torch.zeros(self.num_entities, dtype=torch.bool)
+        frontier = torch.unique(seeds)
+        visited[frontier] = True
+        node_ids = [frontier]
+        edge_ids = []
+        for fanout in self.fanouts:
+            if frontier.numel() == 0:
+                break
+            positions = self._sample_hop(frontier, fanout)
+            edge_ids.append(self.edge_ids[positions])
+
+            neighbors = torch.unique(self.neighbors[positions])
+            frontier = neighbors[~visited[neighbors]]
+            visited[frontier] = True
+            node_ids.append(frontier)
+
+        node_ids = torch.cat(node_ids)
+        edge_ids = torch.unique(torch.cat(edge_ids)) if edge_ids else torch.empty(0, dtype=torch.long)
+
+        # Map entity IDs to subgraph node indices
+        local = torch.full((self.num_entities,), -1, dtype=torch.long)
+        local[node_ids] = torch.arange(node_ids.numel())
+
+        subgraph = GraphData()
+        subgraph.add_nodes(node_ids.numel())
+        if edge_ids.numel() > 0:
+            subgraph.add_edges(local[self.src[edge_ids]].tolist(),
+                               local[self.tgt[edge_ids]].tolist())
+
+        return subgraph.to(device), node_ids.to(device), local[seeds].to(device)
+
+
+def sample_negatives(positives: torch.Tensor, num_negatives: int,
+                     num_entities: int) -> torch.Tensor:
+    """
+    Sample negative entities uniformly for each (e1, rel) pair of a batch
+
+    Parameters
+    ----------
+    - `positives`: entity IDs of the positives of each pair, padded with 0 (e.g., e2_multi1)
+    - `num_negatives`: number of negatives per pair
+    - `num_entities`: number of entities. ID 0 is padding and is never sampled
+
+    Returns
+    ---------
+    A (batch size, `num_negatives`) tensor of entity IDs
+    """
+    return torch.randint(1, num_entities, (positives.shape[0], num_negatives),
+                         device=positives.device)
+
+def negative_sampling_loss(logits: torch.Tensor, positives: torch.Tensor, negatives: torch.Tensor,
+                           mode: str="uniform", temperature: float=1.0) -> torch.Tensor:
+    """
+    Loss of scores against the positives and sampled negatives of each (e1, rel) pair.
+    Padding positives are ignored, and so are sampled negatives that are positives of their pair.
+
+    Parameters
+    ----------
+    - `logits`: scores of each pair against its positives followed by its negatives
+    - `positives`: entity IDs of the positives of each pair, padded with 0
+    - `negatives`: entity IDs of the negatives of each pair, from `sample_negatives`
+    - `mode`: one of {"uniform", "self_adversarial"}. "uniform" weights all negatives equally, and
+              "self_adversarial" weights each negative of a pair by the softmax of the scores of
+              the negatives, so that hard negatives count more
+    - `temperature`: temperature of the softmax for "self_adversarial"
+    """
+    logits = logits.float()
+    pos_logits = logits[:, :positives.shape[1]]
+    neg_logits = logits[:, positives.shape[1]:]
+    pos_mask = (positives != 0).float()
+    neg_mask = (negatives.unsqueeze(2) != positives.unsqueeze(1)).all(2).float()
+
+    pos_loss = -(F.logsigmoid(pos_logits) * pos_mask).sum(1) / pos_mask.sum(1).clamp(min=1.0)
+    if mode == "uniform":
+        neg_weights = neg_mask / neg_mask.sum(1, keepdim=True).clamp(min=1.0)
+    elif mode == "self_adversarial":
+        # NOTE(lucas): The weights are not trained, only the scores they weight
+        neg_weights = torch.softmax((temperature * neg_logits).masked_fill(neg_mask == 0, -1e9), 1)
+        neg_weights = (neg_weights * neg_mask).detach()
+    else:
+        raise ValueError(f"Unknown negative sampling mode: {mode}")
+    neg_loss = -(F.logsigmoid(-neg_logits) * neg_weights).sum(1)
+
+    return (pos_loss + neg_loss).mean()
@@ -0,0 +1,162 @@
+"""
+Run many `kg_completion` trials in parallel, e.g. for a hyperparameter sweep.
+The dataset and KG graph are loaded once and shared by every trial, and configs are passed in
+memory instead of through the config file on disk. Sweeps can stop poor trials early with
+successive halving.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from .binary_dataset import BinaryKGDataset
+from .kg_completion import kg_completion, load_dataset, load_kg_graph
+
+# Dataset and KG graph shared by the trials run in a worker process
+_dataset = None
+_kg_graph = None
+
+
+def _init_trial_worker(dataset, kg_graph, num_threads: int) -> None:
+    """
+    Internal function.
+    Set up a worker process with the shared dataset and KG graph
+    """
+    global _dataset, _kg_graph
+    _dataset = dataset
+    _kg_graph = kg_graph
+    # NOTE(lucas): Every worker would otherwise use a thread per core
+    torch.set_num_threads(num_threads)
+
+
+def _run_trial(trial: tuple) -> float:
+    """
+    Internal function.
+    Run one trial in a worker process, returning its best validation result.
+    The best model of the trial is saved in its results directory, so trials do not overwrite
+    each other's models.
+    """
+    cfg, dataset_dir, labels, checkpoint_path = trial
+    return kg_completion(cfg, dataset_dir, labels, dataset=_dataset, KG_graph=_kg_graph,
+                         checkpoint_path=checkpoint_path,
+                         model_path=os.path.join(cfg["out_dir"], "best.model"))
+
+
+def _prepare_trials(configs: list[dict]) -> list[dict]:
+    """
+    Internal function.
+    Copy the configs of a sweep, giving each trial its own results directory
+    """
+    trials = []
+    for i, cfg in enumerate(configs):
+        cfg = dict(cfg)
+        cfg["out_dir"] = os.path.join(cfg["out_dir"], f"trial_{i:03d}")
+        # The pool already uses every core, so load batches in the trial process
+        cfg["loader_threads"] = 0
+        trials.append(cfg)
+
+    return trials
+
+
+def _make_executor(configs: list[dict], dataset_dir: str, num_workers: int) -> ProcessPoolExecutor:
+    """
+    Internal function.
+    Load the dataset and KG graph, and start a process pool whose workers share them
+    """
+    dataset = load_dataset(dataset_dir, configs[0]["dataset_format"])
+    if isinstance(dataset, BinaryKGDataset):
+        num_entities = dataset.num_entities
+    else:
+        num_entities = len(dataset.vocab_model.in_word_vocab)
+    kg_graph = load_kg_graph(dataset, os.path.join(dataset_dir, "processed", "kgc"), num_entities,
+                             build=configs[0]["preprocess"])
+
+    # NOTE(lucas): CUDA cannot be used in forked processes
+    context = None
+    if any(cfg["cuda"] is True for cfg in configs):
+        context = multiprocessing.get_context("spawn")
+
+    num_threads = max(1, os.cpu_count() // num_workers)
+    return ProcessPoolExecutor(num_workers, mp_context=context, initializer=_init_trial_worker,
+                               initargs=(dataset, kg_graph, num_threads))
+
+
+def run_sweep(configs: list[dict], dataset_dir: str, num_workers: int=None,
+              labels: bool=False) -> list[float]:
+    """
+    Run a `kg_completion` trial for each config in a process pool.
+    Trial i writes its results to `<out_dir>/trial_<i>`, where `out_dir` is from its config.
+
+    Parameters
+    ----------
+    - `configs`: config dicts, one per trial. All trials must use the same dataset
+    - `dataset_dir`: path to the preprocessed dataset
+    - `num_workers`: number of trials to run at once. Defaults to the number of cores
+    - `labels`: whether the test and validation triples are labeled
+
+    Returns
+    ---------
+    The best validation result of each trial
+    """
+    if not configs:
+        return []
+
+    num_workers = min(num_workers or os.cpu_count(), len(configs))
+    trials = [(cfg, dataset_dir, labels, None) for cfg in _prepare_trials(configs)]
+    with _make_executor(configs, dataset_dir, num_workers) as executor:
+        return list(executor.map(_run_trial, trials))
+
+
+def run_successive_halving(configs: list[dict], dataset_dir: str, min_epochs: int=8, eta: int=3,
+                           num_workers: int=None, labels: bool=False) -> list[float]:
+    """
+    Run a sweep with successive halving. All trials are trained for `min_epochs` epochs, then
+    the best 1/`eta` of them are trained `eta` times as long, and so on until the remaining trials
+    reach the `epochs` of their configs. Trials resume from a checkpoint in their results directory
+    instead of starting over, and trials stopped early by `patience` are not trained further.
+
+    Parameters
+    ----------
+    - `configs`: config dicts, one per trial. All trials must use the same dataset and epochs
+    - `dataset_dir`: path to the preprocessed dataset
+    - `min_epochs`: number of epochs every trial is trained for. Results are only available after
+                    validation, which runs every 2 epochs, so this should allow a few rounds
+    - `eta`: fraction of trials kept and factor the epochs grow by at each round
+    - `num_workers`: number of trials to run at once. Defaults to the number of cores
+    - `labels`: whether the test and validation triples are labeled
+
+    Returns
+    ---------
+    The best validation result of each trial, from the last round it was trained in
+    """
+    if not configs:
+        return []
+
+    num_workers = min(num_workers or os.cpu_count(), len(configs))
+    max_epochs = configs[0]["epochs"]
+    trials = _prepare_trials(configs)
+    results = [0.0] * len(trials)
+    active = list(range(len(trials)))
+    epochs = min(min_epochs, max_epochs)
+    with _make_executor(configs, dataset_dir, num_workers) as executor:
+        while True:
+            round_trials = []
+            for i in active:
+                cfg = dict(trials[i], epochs=epochs)
+                checkpoint_path = os.path.join(cfg["out_dir"], "checkpoint.pt")
+                os.makedirs(cfg["out_dir"], exist_ok=True)
+                round_trials.append((cfg, dataset_dir, labels, checkpoint_path))
+            for i, result in zip(active, executor.map(_run_trial, round_trials)):
+                results[i] = result
+
+            if epochs >= max_epochs:
+                break
+
+            # Keep the best trials for the next round
+            active.sort(key=lambda i: results[i], reverse=True)
+            active = active[:max(1, len(active) // eta)]
+            epochs = min(epochs * eta, max_epochs)
+
+    return results
@@ -1,12 +1,146 @@
 from __future__ import print_function
 import json
 import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
-def write_training_graph(cases, graph, path):
-    with open(path, "w") as f:
-        for key in graph:
-            e1, rel = key
+# NOTE(lucas): Entities and relations are interned to integer IDs as they are read. A relation key
+# is 2 * (relation ID) for a relation and 2 * (relation ID) + 1 for its reverse, and an
+# (entity, relation key) pair is stored as entity * (number of relation keys) + relation key.
+
+# Number of lines written at once by the JSON writers
+_WRITE_CHUNK_SIZE = 65536
+
+
+def _read_split(path, labels, ent_ids, rel_ids):
+    """
+    Internal function.
+    Read the triples of a split, interning entities and relations to IDs.
+    Returns the e1, rel and e2 ID arrays, and the labels if `labels` is True (else None).
+    """
+    e1_ids = array("q")
+    rel_ids_ = array("q")
+    e2_ids = array("q")
+    split_labels = [] if labels else None
+    with open(path, "r", encoding="utf-8") as infile:
+        for line in infile:
+            if labels:
+                e1, rel, e2, label = line.rstrip().split('\t')
+                split_labels.append(label)
+            else:
+                e1, rel, e2 = line.split('\t')
+
+            e1_ids.append(ent_ids.setdefault(e1.strip(), len(ent_ids)))
+            rel_ids_.append(rel_ids.setdefault(rel.strip(), len(rel_ids)))
+            e2_ids.append(ent_ids.setdefault(e2.strip(), len(ent_ids)))
+
+    return (np.frombuffer(e1_ids, dtype=np.int64), np.frombuffer(rel_ids_, dtype=np.int64),
+            np.frombuffer(e2_ids, dtype=np.int64), split_labels)
+
+
+def _parse_split(path, labels):
+    """
+    Internal function.
+    Read a split with its own vocabularies, so splits can be read in parallel.
+    Returns the entities and relations of the split in the order they were read, followed by the
+    outputs of `_read_split`.
+    """
+    ent_ids = {}
+    rel_ids = {}
+    e1, rel, e2, split_labels = _read_split(path, labels, ent_ids, rel_ids)
+    return list(ent_ids), list(rel_ids), e1, rel, e2, split_labels
+
+
+def _merge_vocab(words, ids):
+    """
+    Internal function.
+    Intern the words of a split vocabulary into a shared vocabulary.
+    Returns the shared ID of each split ID.
+    """
+    return np.array([ids.setdefault(word, len(ids)) for word in words], dtype=np.int64)
+
+
+def _group_neighbors(e1, rel, e2, num_rel_keys):
+    """
+    Internal function.
+    Group the distinct neighbors of each (entity, relation key) pair of the triples and their
+    reverses, e.g. (Mike, fatherOf) -> {John} and (John, fatherOf_reverse) -> {Mike}.
+
+    Returns
+    ---------
+    - the pair keys, sorted
+    - CSR offsets of the neighbors of each key
+    - the neighbors
+    - the position at which each key first appears, to write keys in the order they were read
+    """
+    num_triples = len(e1)
+    heads = np.concatenate([e1, e2])
+    tails = np.concatenate([e2, e1])
+    keys = heads * num_rel_keys + np.concatenate([2 * rel, 2 * rel + 1])
+    positions = np.concatenate([2 * np.arange(num_triples), 2 * np.arange(num_triples) + 1])
+    if num_triples == 0:
+        return keys, np.zeros(1, dtype=np.int64), tails, positions
+
+    order = np.lexsort((tails, keys))
+    keys = keys[order]
+    tails = tails[order]
+    positions = positions[order]
+
+    key_starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    first_seen = np.minimum.reduceat(positions, key_starts)
+
+    # Drop duplicate neighbors of a key
+    distinct = np.r_[True, (keys[1:] != keys[:-1]) | (tails[1:] != tails[:-1])]
+    keys = keys[distinct]
+    tails = tails[distinct]
+    key_starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    offsets = np.append(key_starts, len(keys))
+
+    return keys[key_starts], offsets, tails, first_seen
+
+
+def _gather_csr(offsets, indices, rows):
+    """
+    Internal function.
+    Gather rows of a CSR array. Returns the offsets and indices of the gathered rows.
+    """
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    batch_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=batch_offsets[1:])
+    positions = np.repeat(starts - batch_offsets[:-1], counts) + np.arange(batch_offsets[-1])
+
+    return batch_offsets, indices[positions]
+
+
+def _write_lines(lines, path):
+    """
+    Internal function.
+    Write lines to a file in chunks of `_WRITE_CHUNK_SIZE`
+    """
+    with open(path, "w", buffering=1 << 20) as f:
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) == _WRITE_CHUNK_SIZE:
+                f.write("".join(chunk))
+                chunk = []
+        f.write("".join(chunk))
+
+
+def write_training_graph(graph, entities, rel_keys, path):
+    """
+    Write each (e1, rel) pair of a graph from `_group_neighbors` with all of its neighbors,
+    in the order the pairs were read
+    """
+    keys, offsets, neighbors, first_seen = graph
+    offsets = offsets.tolist()
+    neighbors = neighbors.tolist()
+
+    def lines():
+        for i in np.argsort(first_seen, kind="stable").tolist():
+            e1, rel_key = divmod(int(keys[i]), len(rel_keys))
             # (Mike, fatherOf, John)
             # (John, fatherOf, Tom)
             # (John, fatherOf_reverse, Mike)
@@ -14,128 +148,221 @@ def write_training_graph(cases, graph, path):
 
             # (John, fatherOf) -> Tom
             # (John, fatherOf_reverse, Mike)
-            entities1 = " ".join(list(graph[key]))
+            entities1 = " ".join(entities[e] for e in neighbors[offsets[i]:offsets[i + 1]])
 
             data_point = {}
-            data_point["e1"] = e1
+            data_point["e1"] = entities[e1]
             data_point["e2"] = "None"
-            data_point["rel"] = rel
+            data_point["rel"] = rel_keys[rel_key]
             data_point["rel_eval"] = "None"
             data_point["e2_multi1"] = entities1
             data_point["e2_multi2"] = "None"
             data_point["label"] = 1
 
-            f.write(json.dumps(data_point) + "\n")
+            yield json.dumps(data_point) + "\n"
+
+    _write_lines(lines(), path)
 
 
-def write_evaluation_graph(cases, graph, path):
-    with open(path, "w") as f:
-        n1 = 0
-        n2 = 0
-        for e1, rel, e2, label in cases:
+def _evaluation_rows(graph, e1, rel, e2, num_rel_keys):
+    """
+    Internal function.
+    Find the rows of the (e1, rel) and (e2, rel_reverse) pairs of each triple in a graph
+    """
+    keys = graph[0]
+    rows1 = np.searchsorted(keys, e1 * num_rel_keys + 2 * rel)
+    rows2 = np.searchsorted(keys, e2 * num_rel_keys + 2 * rel + 1)
+    return rows1, rows2
+
+
+def write_evaluation_graph(e1, rel, e2, split_labels, graph, entities, rel_keys, path):
+    """
+    Write each triple of a split with the neighbors of (e1, rel) and (e2, rel_reverse) in a graph
+    from `_group_neighbors`
+    """
+    _, offsets, neighbors, _ = graph
+    rows1, rows2 = _evaluation_rows(graph, e1, rel, e2, len(rel_keys))
+    offsets = offsets.tolist()
+    neighbors = neighbors.tolist()
+
+    def lines():
+        for i, (row1, row2) in enumerate(zip(rows1.tolist(), rows2.tolist())):
             # (Mike, fatherOf) -> John
             # (John, fatherOf, Tom)
-            rel_reverse = rel + "_reverse"
-            entities1 = " ".join(list(graph[(e1, rel)]))
-            entities2 = " ".join(list(graph[(e2, rel_reverse)]))
-
-            n1 += len(entities1.split(" "))
-            n2 += len(entities2.split(" "))
+            entities1 = " ".join(entities[e] for e in neighbors[offsets[row1]:offsets[row1 + 1]])
+            entities2 = " ".join(entities[e] for e in neighbors[offsets[row2]:offsets[row2 + 1]])
 
             data_point = {}
-            data_point["e1"] = e1
-            data_point["e2"] = e2
-            data_point["rel"] = rel
-            data_point["rel_eval"] = rel_reverse
+            data_point["e1"] = entities[e1[i]]
+            data_point["e2"] = entities[e2[i]]
+            data_point["rel"] = rel_keys[2 * rel[i]]
+            data_point["rel_eval"] = rel_keys[2 * rel[i] + 1]
             data_point["e2_multi1"] = entities1
             data_point["e2_multi2"] = entities2
-            data_point["label"] = label
+            data_point["label"] = split_labels[i] if split_labels is not None else None
+
+            yield json.dumps(data_point) + "\n"
+
+    _write_lines(lines(), path)
+
+
+def write_binary_vocab(words, path):
+    """
+    Write a vocabulary with one word per line, where the line number is the ID of the word.
+    ID 0 is reserved for padding, so word i of `words` has ID i + 1.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("<pad>\n")
+        for word in words:
+            f.write(word + "\n")
+
+
+def _save_arrays(path, arrays):
+    """
+    Internal function.
+    Save named arrays to <name>.npy files in a directory
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), values)
+
+
+def write_binary_graph(graph, num_rel_keys, path):
+    """
+    Write the data of `write_training_graph` as arrays of IDs that can be memory-mapped:
+    e1.npy, rel.npy, e2.npy, rel_eval.npy and label.npy with one entry per data point, and the
+    e2_multi1/e2_multi2 sets as CSR offsets and indices arrays. IDs are shifted by 1 for the
+    padding ID 0, missing values are 0, and missing labels are -1.
+    """
+    keys, offsets, neighbors, _ = graph
+    e1, rel = np.divmod(keys, num_rel_keys)
+    zeros = np.zeros(len(keys), dtype=np.int32)
+    _save_arrays(path, {
+        "e1": (e1 + 1).astype(np.int32),
+        "rel": (rel + 1).astype(np.int32),
+        "e2": zeros,
+        "rel_eval": zeros,
+        "label": np.ones(len(keys), dtype=np.int8),
+        "e2_multi1_offsets": offsets.astype(np.int64),
+        "e2_multi1_indices": (neighbors + 1).astype(np.int32),
+        "e2_multi2_offsets": np.zeros(len(keys) + 1, dtype=np.int64),
+        "e2_multi2_indices": np.zeros(0, dtype=np.int32),
+    })
+
 
-            f.write(json.dumps(data_point) + "\n")
+def write_binary_evaluation_graph(e1, rel, e2, split_labels, graph, num_rel_keys, path):
+    """
+    Write the data of `write_evaluation_graph` in the format of `write_binary_graph`
+    """
+    _, offsets, neighbors, _ = graph
+    rows1, rows2 = _evaluation_rows(graph, e1, rel, e2, num_rel_keys)
+    e2_multi1_offsets, e2_multi1_indices = _gather_csr(offsets, neighbors, rows1)
+    e2_multi2_offsets, e2_multi2_indices = _gather_csr(offsets, neighbors, rows2)
+    if split_labels is not None:
+        label = np.array([int(label) for label in split_labels], dtype=np.int8)
+    else:
+        label = np.full(len(e1), -1, dtype=np.int8)
 
+    _save_arrays(path, {
+        "e1": (e1 + 1).astype(np.int32),
+        "rel": (2 * rel + 1).astype(np.int32),
+        "e2": (e2 + 1).astype(np.int32),
+        "rel_eval": (2 * rel + 2).astype(np.int32),
+        "label": label,
+        "e2_multi1_offsets": e2_multi1_offsets,
+        "e2_multi1_indices": (e2_multi1_indices + 1).astype(np.int32),
+        "e2_multi2_offsets": e2_multi2_offsets,
+        "e2_multi2_indices": (e2_multi2_indices + 1).astype(np.int32),
+    })
 
-def wrangle_kg(data_dir, labels=False):
+
+def _run_tasks(executor, tasks):
+    """
+    Internal function.
+    Run (function, args) tasks in an executor, or in this process if `executor` is None.
+    Returns the result of each task.
+    """
+    if executor is None:
+        return [function(*args) for function, args in tasks]
+
+    futures = [executor.submit(function, *args) for function, args in tasks]
+    return [future.result() for future in futures]
+
+
+def wrangle_kg(data_dir, labels=False, binary=False, num_workers=None):
+    """
+    Write the e1rel_to_e2 files of the train.txt, valid.txt and test.txt splits of a dataset,
+    and optionally the binary dataset format.
+    The splits are read in parallel, and the output files are written in parallel.
+
+    Parameters
+    ----------
+    - `data_dir`: directory of the splits, where the outputs are written
+    - `labels`: whether the triples of the splits are labeled
+    - `binary`: whether to also write the binary dataset format
+    - `num_workers`: number of processes. Defaults to one per output file (up to the number of
+                     cores), and 0 runs everything in this process
+    """
     np.random.RandomState(234234)
 
     files = ["train.txt", "valid.txt", "test.txt"]
-    data = []
-    label_graph = {}
-    train_graph = {}
-    test_cases = {}
-    for file in files:
-        test_cases[file] = []
-        train_graph[file] = {}
-        with open(os.path.join(data_dir, file), "r", encoding="utf-8") as infile:
-            data = infile.readlines() + data
-
-        with open(os.path.join(data_dir, file), "r", encoding="utf-8") as infile:
-            for line in infile:
-                if labels:
-                    e1, rel, e2, label = line.rstrip().split('\t')
-                else:
-                    e1, rel, e2 = line.split('\t')
-                    label = None
-
-                e1 = e1.strip()
-                e2 = e2.strip()
-                rel = rel.strip()
-                rel_reverse = rel + "_reverse"
-
-                # data
-                # (Mike, fatherOf, John)
-                # (John, fatherOf, Tom)
-
-                if (e1, rel) not in label_graph:
-                    label_graph[(e1, rel)] = set()
-
-                if (e2, rel_reverse) not in label_graph:
-                    label_graph[(e2, rel_reverse)] = set()
-
-                if (e1, rel) not in train_graph[file]:
-                    train_graph[file][(e1, rel)] = set()
-                if (e2, rel_reverse) not in train_graph[file]:
-                    train_graph[file][(e2, rel_reverse)] = set()
-
-                # labels
-                # (Mike, fatherOf, John)
-                # (John, fatherOf, Tom)
-                # (John, fatherOf_reverse, Mike)
-                # (Tom, fatherOf_reverse, Mike)
-                label_graph[(e1, rel)].add(e2)
-
-                label_graph[(e2, rel_reverse)].add(e1)
-
-                # test cases
-                # (Mike, fatherOf, John)
-                # (John, fatherOf, Tom)
-                test_cases[file].append([e1, rel, e2, label])
-
-                # data
-                # (Mike, fatherOf, John)
-                # (John, fatherOf, Tom)
-                # (John, fatherOf_reverse, Mike)
-                # (Tom, fatherOf_reverse, John)
-                train_graph[file][(e1, rel)].add(e2)
-                train_graph[file][(e2, rel_reverse)].add(e1)
-
-    all_cases = test_cases["train.txt"] + test_cases["valid.txt"] + test_cases["test.txt"]
-    write_training_graph(
-        test_cases["train.txt"],
-        train_graph["train.txt"],
-        os.path.join(data_dir, "e1rel_to_e2_train.json")
-    )
-    write_evaluation_graph(
-        test_cases["valid.txt"],
-        label_graph,
-        os.path.join(data_dir, "e1rel_to_e2_ranking_dev.json")
-    )
-    write_evaluation_graph(
-        test_cases["test.txt"],
-        label_graph,
-        os.path.join(data_dir, "e1rel_to_e2_ranking_test.json")
-    )
-    write_training_graph(
-        all_cases,
-        label_graph,
-        os.path.join(data_dir, "e1rel_to_e2_full.json")
-    )
+    if num_workers is None:
+        num_workers = min(7 if binary else 4, os.cpu_count())
+    executor = ProcessPoolExecutor(num_workers) if num_workers > 0 else None
+    try:
+        parsed = _run_tasks(executor, [(_parse_split, (os.path.join(data_dir, file), labels))
+                                       for file in files])
+
+        # Merge the split vocabularies in file order, so IDs are the same as reading the splits
+        # one after another
+        ent_ids = {}
+        rel_ids = {}
+        splits = {}
+        for file, (split_entities, split_relations, e1, rel, e2, split_labels) in zip(files, parsed):
+            ent_map = _merge_vocab(split_entities, ent_ids)
+            rel_map = _merge_vocab(split_relations, rel_ids)
+            splits[file] = (ent_map[e1], rel_map[rel], ent_map[e2], split_labels)
+        del parsed
+
+        entities = list(ent_ids)
+        rel_keys = [name for rel in rel_ids for name in (rel, rel + "_reverse")]
+        num_rel_keys = len(rel_keys)
+        del ent_ids, rel_ids
+
+        # Neighbors of the training triples, and of the triples of all splits
+        train_e1, train_rel, train_e2, _ = splits["train.txt"]
+        train_graph = _group_neighbors(train_e1, train_rel, train_e2, num_rel_keys)
+        label_graph = _group_neighbors(*[np.concatenate([splits[file][i] for file in files])
+                                         for i in range(3)], num_rel_keys)
+
+        tasks = [
+            (write_training_graph, (train_graph, entities, rel_keys,
+                                    os.path.join(data_dir, "e1rel_to_e2_train.json"))),
+            (write_evaluation_graph, (*splits["valid.txt"], label_graph, entities, rel_keys,
+                                      os.path.join(data_dir, "e1rel_to_e2_ranking_dev.json"))),
+            (write_evaluation_graph, (*splits["test.txt"], label_graph, entities, rel_keys,
+                                      os.path.join(data_dir, "e1rel_to_e2_ranking_test.json"))),
+            (write_training_graph, (label_graph, entities, rel_keys,
+                                    os.path.join(data_dir, "e1rel_to_e2_full.json"))),
+        ]
+
+        # Also write the splits as arrays for the binary dataset format
+        if binary:
+            binary_dir = os.path.join(data_dir, "binary")
+            os.makedirs(binary_dir, exist_ok=True)
+            write_binary_vocab(entities, os.path.join(binary_dir, "entities.txt"))
+            write_binary_vocab(rel_keys, os.path.join(binary_dir, "relations.txt"))
+
+            tasks += [
+                (write_binary_graph, (train_graph, num_rel_keys,
+                                      os.path.join(binary_dir, "train"))),
+                (write_binary_evaluation_graph, (*splits["valid.txt"], label_graph, num_rel_keys,
+                                                 os.path.join(binary_dir, "val"))),
+                (write_binary_evaluation_graph, (*splits["test.txt"], label_graph, num_rel_keys,
+                                                 os.path.join(binary_dir, "test"))),
+            ]
+
+        _run_tasks(executor, tasks)
+    finally:
+        if executor is not None:
+            executor.shutdown()
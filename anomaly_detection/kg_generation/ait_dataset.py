@@ -9,9 +9,35 @@ The testing set also contains some normal activity.
 """
 
 import calendar
+import functools
+import hashlib
+import json
 import os
+import re
 import shutil
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Callable
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+from .log_io import (check_compression, is_compressed, open_binary, open_text,
+                     strip_compression_suffix)
+
+# Dates of the training set, before the attacks on 03/04/2020 and 03/05/2020
+TRAINING_DATES = ["02/29/2020", "03/01/2020", "03/02/2020", "03/03/2020"]
+
+# Log types with syslog timestamps
+_SYSLOG_TYPES = ("auth", "daemon", "mail", "messages", "syslog", "user")
+
+# Exclusion lists up to this size are checked with substring searches instead of a compiled
+# matcher
+_MAX_SUBSTRING_WORDS = 24
 
 
 # TODO(lucas): Put os wrappers in separate file to be shared
@@ -101,6 +127,110 @@ def get_date(log_type: str, line: str) -> str:
 
     return date
 
+def _day_tokens(day: int) -> tuple[str, str]:
+    """
+    Internal function.
+    Return a day of the month as it can appear in a timestamp, with and without zero padding
+    """
+    return str(day), f"{day:02d}"
+
+def make_date_filter(log_type: str, dates: list[str]) -> Callable[[str], bool]:
+    """
+    Make a function that checks whether the timestamp of a log line is on one of the given dates.
+    This gives the same result as `get_date(log_type, line) in dates`, but the dates are converted
+    to the raw date tokens of the log type once, so each line is only sliced and looked up in a set.
+    Lines whose timestamp cannot be found are not on any date.
+
+    Parameters
+    ----------
+    - `log_type`: type of log file, see `get_date`
+    - `dates`: dates in the format m/d/Y (e.g., 03/01/2020)
+
+    Returns
+    ---------
+    A function that takes a log line and returns whether it is on one of the dates
+    """
+    dates = [datetime.strptime(date, "%m/%d/%Y") for date in dates]
+
+    if log_type == "access":
+        # Timestamp format: [d/AM/Y:timestamp]
+        tokens = {f"{date.day:02d}/{calendar.month_abbr[date.month]}/{date.year}"
+                  for date in dates}
+
+        def is_valid_date(line):
+            start = line.find("[") + 1
+            return line[start:start+11] in tokens
+
+    elif log_type == "error":
+        # Timestamp format: [AD AM d timestamp Y]
+        tokens = {(calendar.month_abbr[date.month], day, str(date.year))
+                  for date in dates for day in _day_tokens(date.day)}
+
+        def is_valid_date(line):
+            timestamp = line[line.find("[")+5:line.find("]")].split()
+            return len(timestamp) > 3 and (timestamp[0], timestamp[1], timestamp[3]) in tokens
+
+    elif log_type == "audit":
+        # Timestamp format: msg=audit(timestamp:)
+        # NOTE(lucas): Timestamps are seconds since the epoch, converted to dates in local time,
+        # so compare them to the range of each date instead
+        ranges = [(date.timestamp(), (date + timedelta(days=1)).timestamp()) for date in dates]
+
+        def is_valid_date(line):
+            try:
+                timestamp = float(line[line.find("audit(")+6:line.find(":")])
+            except ValueError:
+                return False
+            return any(start <= timestamp < end for start, end in ranges)
+
+    elif log_type == "mainlog":
+        # Timestamp format: Y-m-d timestamp
+        tokens = {date.strftime("%Y-%m-%d") for date in dates}
+
+        def is_valid_date(line):
+            return line[:line.find(" ")][:10] in tokens
+
+    elif log_type == "fast":
+        # Timestamp format: m/d/Y-timestamp
+        tokens = {date.strftime("%m/%d/%Y") for date in dates}
+
+        def is_valid_date(line):
+            return line[:line.find("-")] in tokens
+
+    elif log_type in _SYSLOG_TYPES:
+        # Timestamp format: AM d timestamp
+        # NOTE(lucas): Syslog timestamps have no year, and get_date assumes 2020
+        tokens = {(calendar.month_abbr[date.month], day)
+                  for date in dates if date.year == 2020 for day in _day_tokens(date.day)}
+
+        def is_valid_date(line):
+            return tuple(line.split(None, 2)[:2]) in tokens
+
+    else:
+        def is_valid_date(line):
+            return False
+
+    return is_valid_date
+
+def get_log_type(file: str) -> str:
+    """
+    Find the log type of a file from its name
+
+    Parameters
+    ----------
+    - `file`: path to the log file
+    """
+    # To find the log type, return the name found between the last slash and the last period
+    # If the log file contains the server name (e.g., mail.cup.com-access),
+    # remove the last period and everything before
+    # Also, remove the "com-" part
+    log_type = strip_compression_suffix(file)
+    log_type = log_type[log_type.rfind(os.sep)+1:]
+    log_type = log_type.replace(".log", "").replace(".info", "")
+    log_type = log_type[log_type.rfind(".")+1:]
+    log_type = log_type.replace("com-", "")
+    return log_type
+
 def parent_dir(path: str) -> str:
     """
     Return the path to the parent directory of a file
@@ -199,7 +329,125 @@ def exclude_line(line: str, exclusion_list: list[str]) -> bool:
             break
     return exclude
 
-def extract_training_set(root_dir: str, data_file_list: list, exclusion_list: list[str]) -> None:
+def _trie_pattern(words: list[str]) -> str:
+    """
+    Internal function.
+    Build a regex that matches any of the words, with the words merged into a trie so that
+    common prefixes are only matched once (e.g., "audit(?:d|spd)" instead of "auditd|audispd")
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        # NOTE(lucas): Only whether a word is found matters, so once a word ends, longer words
+        # with it as a prefix do not need to be matched
+        if "" in node:
+            return ""
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items())]
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+
+    return build(trie)
+
+def _make_word_matcher(words: list[str]) -> Callable[[str], bool]:
+    """
+    Internal function.
+    Build an Aho-Corasick automaton that determines whether a line contains any of the words
+    """
+    automaton = ahocorasick.Automaton()
+    for word in words:
+        automaton.add_word(word, word)
+    automaton.make_automaton()
+    matches = automaton.iter
+    return lambda line: next(matches(line), None) is not None
+
+def make_exclusion_filter(exclusion_list: list[str],
+                          patterns: list[str]=None) -> Callable[[str], bool]:
+    """
+    Make a function that determines whether a line should be excluded.
+    Short lists of words are checked with substring searches. Longer lists are compiled once into
+    an Aho-Corasick automaton if the optional pyahocorasick package is installed, and otherwise
+    into a regex together with the patterns. Either way, each line is scanned once for all words,
+    though the cost per line still grows with the number of words
+    (see `benchmarks/bench_exclude_line.py`). For words only, this gives the same result as
+    `exclude_line(line, exclusion_list)`.
+
+    Parameters
+    ----------
+    - `exclusion_list`: list of words used to exclude log lines
+    - `patterns`: list of regex patterns used to exclude log lines
+
+    Returns
+    ---------
+    A function that takes a log line and returns whether it should be excluded
+    """
+    # NOTE(lucas): str.find is faster than either compiled matcher for up to about 24 words
+    if not patterns and len(exclusion_list) <= _MAX_SUBSTRING_WORDS:
+        words = tuple(exclusion_list)
+
+        def is_excluded(line):
+            for word in words:
+                if word in line:
+                    return True
+            return False
+
+        return is_excluded
+
+    alternatives = list(patterns or [])
+    has_word = None
+    if ahocorasick is not None and len(exclusion_list) > _MAX_SUBSTRING_WORDS:
+        has_word = _make_word_matcher(exclusion_list)
+    elif exclusion_list:
+        alternatives.insert(0, _trie_pattern(exclusion_list))
+
+    if not alternatives:
+        return has_word or (lambda line: False)
+
+    search = re.compile("|".join(f"(?:{pattern})" for pattern in alternatives)).search
+    if has_word is None:
+        return lambda line: search(line) is not None
+    return lambda line: has_word(line) or search(line) is not None
+
+def make_log_type_exclusion_filter(log_type: str, exclusion_list: list[str],
+                                   exclusion_rules: dict[str, list[str]]=None
+                                   ) -> Callable[[str], bool]:
+    """
+    Make the exclusion filter of a log type, with the words used for every log type and the regex
+    patterns of the log type
+
+    Parameters
+    ----------
+    - `log_type`: type of log file, see `get_date`
+    - `exclusion_list`: list of words used to exclude log lines of every type
+    - `exclusion_rules`: regex patterns used to exclude log lines, by log type.
+                         The patterns of the "*" key are used for every log type
+    """
+    exclusion_rules = exclusion_rules or {}
+    patterns = exclusion_rules.get("*", []) + exclusion_rules.get(log_type, [])
+    return make_exclusion_filter(exclusion_list, patterns)
+
+def filter_training_lines(lines: list[str], is_valid_date: Callable[[str], bool],
+                          is_excluded: Callable[[str], bool]) -> list[str]:
+    """
+    Keep the lines of a block that are on a training date and are not excluded
+
+    Parameters
+    ----------
+    - `lines`: block of log lines
+    - `is_valid_date`: function from `make_date_filter`
+    - `is_excluded`: function from `make_exclusion_filter`
+    """
+    return [line for line in lines if is_valid_date(line) and not is_excluded(line)]
+
+def extract_training_set(root_dir: str, data_file_list: list, exclusion_list: list[str],
+                         chunk_size: int=1 << 20,
+                         exclusion_rules: dict[str, list[str]]=None,
+                         compression: str=None) -> None:
     """
     Extract training over a 1-day period
     Attacks occur on 03/04/2020 and 03/05/2020
@@ -209,43 +457,47 @@ def extract_training_set(root_dir: str, data_file_list: list, exclusion_list: li
     - `root_dir`: root data directory
     - `data_file_list`: list of all file names to be processed, without the root directory
     - `exclusion_list`: list of words used to exclude log lines
+    - `chunk_size`: approximate number of bytes of lines to filter at once.
+                    If 0, lines are filtered one at a time
+    - `exclusion_rules`: regex patterns used to exclude log lines, by log type.
+                         See `make_log_type_exclusion_filter`
+    - `compression`: optional format to compress the extracted files with, one of {"gz", "zst"}.
+                     Compressed data files are read directly. See `output_file_name`
     """
+    check_compression(compression, data_file_list)
     for file in data_file_list:
-        if file.endswith("zip"):
-            continue
-
         # NOTE(lucas): input and output paths should be relative to data root directory
         data_file_to_open = os.path.join(root_dir, "data", file)
-        out_file_to_open = os.path.join(root_dir, "train", file)
+        out_file_to_open = os.path.join(root_dir, "train", output_file_name(file, compression))
         # If there is not already a folder for output, create one
         # (make sure not to make the target output file into a directory)
         if not os.path.exists(parent_dir(out_file_to_open)):
             os.makedirs(parent_dir(out_file_to_open))
 
-        with open(data_file_to_open, "r", encoding="utf-8") as in_file, \
-             open(out_file_to_open, "w", encoding="utf-8") as out_file:
+        with open_text(data_file_to_open, "r") as in_file, \
+             open_text(out_file_to_open, "w") as out_file:
             print(f"Extracting training data from {file}...", end=' ', flush=True)
 
-            # To find the log type, return the name found between the last slash and the last period
-            # If the log file contains the server name (e.g., mail.cup.com-access),
-            # remove the last period and everything before
-            # Also, remove the "com-" part
-            log_type = file[file.rfind(os.sep)+1:]
-            log_type = log_type.replace(".log", "").replace(".info", "")
-            log_type = log_type[log_type.rfind(".")+1:]
-            log_type = log_type.replace("com-", "")
-            valid_dates = ["02/29/2020", "03/01/2020", "03/02/2020", "03/03/2020"]
-            for line in in_file:
-                if get_date(log_type, line) in valid_dates and not \
-                   exclude_line(line, exclusion_list):
-                    out_file.write(line)
+            log_type = get_log_type(file)
+            is_valid_date = make_date_filter(log_type, TRAINING_DATES)
+            is_excluded = make_log_type_exclusion_filter(log_type, exclusion_list,
+                                                         exclusion_rules)
+            if chunk_size > 0:
+                for lines in iter(lambda: in_file.readlines(chunk_size), []):
+                    out_file.writelines(filter_training_lines(lines, is_valid_date, is_excluded))
+            else:
+                for line in in_file:
+                    if is_valid_date(line) and not is_excluded(line):
+                        out_file.write(line)
 
             print("Done")
 
     print("Training data extracted")
 
 
-def extract_testing_set(root_dir: str, data_file_list: list[str], exclusion_list: list[str]) ->None:
+def extract_testing_set(root_dir: str, data_file_list: list[str], exclusion_list: list[str],
+                        exclusion_rules: dict[str, list[str]]=None,
+                        compression: str=None) -> None:
     """
     Extract all attack data by looping through each line of each file and comparing to the same
     label file
@@ -255,67 +507,403 @@ def extract_testing_set(root_dir: str, data_file_list: list[str], exclusion_list
     ---------
     - `root_dir`: root directory for raw data
     - `data_file_list`: list of all file names to be processed, without the root directory
+    - `exclusion_list`: list of words used to exclude log lines
+    - `exclusion_rules`: regex patterns used to exclude log lines, by log type.
+                         See `make_log_type_exclusion_filter`
+    - `compression`: optional format to compress the extracted files with, one of {"gz", "zst"}.
+                     Compressed data and label files are read directly. See `output_file_name`
     """
+    check_compression(compression, data_file_list)
     for file in data_file_list:
-        if file.endswith("zip"):
-            continue
-
         # NOTE(lucas): Input and output files should be relative to root data directory
         in_label_file_to_open = os.path.join(root_dir, "labels", file)
         in_data_file_to_open = os.path.join(root_dir, "data", file)
-        out_data_file_to_open = os.path.join(root_dir, "test", file)
+        out_data_file_to_open = os.path.join(root_dir, "test", output_file_name(file, compression))
         # If there is not already a folder for output, create one
         # (make sure not to make the target output file into a directory)
         if not os.path.exists(parent_dir(out_data_file_to_open)):
             os.makedirs(parent_dir(out_data_file_to_open))
 
-        with open(in_label_file_to_open,  "r", encoding="utf-8") as in_label_file, \
-             open(in_data_file_to_open,   "r", encoding="utf-8") as in_data_file, \
-             open(out_data_file_to_open,  "w", encoding="utf-8") as out_data_file:
+        with open_text(in_label_file_to_open,  "r") as in_label_file, \
+             open_text(in_data_file_to_open,   "r") as in_data_file, \
+             open_text(out_data_file_to_open,  "w") as out_data_file:
             print(f"Extracting attack data from {file}...", end=' ', flush=True)
 
+            is_excluded = make_log_type_exclusion_filter(get_log_type(file), exclusion_list,
+                                                         exclusion_rules)
             for label_line, data_line in zip(in_label_file, in_data_file):
-                if label_line.strip() != "0,0" and not exclude_line(data_line, exclusion_list):
+                if label_line.strip() != "0,0" and not is_excluded(data_line):
                     out_data_file.write(data_line.rstrip() + "\t\t0\n")
             print("Done")
 
     print("Attack data extracted")
 
 
-def inject_testing_set(raw_data_dir: str, data_file_list: list[str], lines: int) -> None:
+def inject_testing_set(raw_data_dir: str, data_file_list: list[str], lines: int,
+                       compression: str=None) -> None:
     """
-    Put the last few lines of each file in the training set into the testing set
+    Move the last few lines of each file in the training set into the testing set
 
     Parameters
     ----------
     - `data_file_list`: list of all file names to be processed, without the root directory
-    - `lines`: the number of lines to copy from each training file to each testing file
+    - `lines`: the number of lines to move from each training file to each testing file
+    - `compression`: format the training and testing files were compressed with, as given to
+                     `extract_training_set` and `extract_testing_set`
     """
     print("Injecting training data into test set...", end=' ', flush=True)
     for file in data_file_list:
-        if file.endswith("zip"):
-            continue
+        _inject_file(raw_data_dir, output_file_name(file, compression), lines)
+
+    print("Done")
+
+
+def _tail_offset(infile, lines: int, block_size: int=1 << 16) -> int:
+    """
+    Internal function.
+    Find the byte offset at which the last `lines` lines of a binary file start, by reading
+    blocks backwards from the end of the file. Returns 0 if the file has fewer lines.
+    """
+    end = infile.seek(0, os.SEEK_END)
+    if end == 0:
+        return 0
+
+    # A newline at the end of the file ends the last line instead of starting a new one
+    infile.seek(end - 1)
+    if infile.read(1) == b"\n":
+        end -= 1
+
+    newlines = 0
+    while end > 0:
+        start = max(0, end - block_size)
+        infile.seek(start)
+        block = infile.read(end - start)
+        position = len(block)
+        while True:
+            position = block.rfind(b"\n", 0, position)
+            if position < 0:
+                break
+            newlines += 1
+            if newlines == lines:
+                return start + position + 1
+        end = start
+
+    return 0
+
+def _inject_file(raw_data_dir: str, file: str, lines: int) -> None:
+    """
+    Internal function.
+    Move the last few lines of a file in the training set into the testing set.
+    Only the tail of the training file is read, and the file is truncated in place.
+    """
+    if lines <= 0:
+        return
 
-        # NOTE(lucas): output files should be relative to root data directory
-        train_file_to_open = os.path.join(raw_data_dir, "train", file)
-        test_file_to_open  = os.path.join(raw_data_dir, "test", file)
+    # NOTE(lucas): output files should be relative to root data directory
+    train_file_to_open = os.path.join(raw_data_dir, "train", file)
+    test_file_to_open  = os.path.join(raw_data_dir, "test", file)
 
-        with open(train_file_to_open, "r+", encoding="utf-8") as in_file, \
-             open(test_file_to_open,  "a",  encoding="utf-8") as out_data_file:
-            train_lines = in_file.readlines()
+    if is_compressed(file):
+        _inject_compressed_file(train_file_to_open, test_file_to_open, lines)
+        return
 
-            # Append an "observed during training" label to each line from the training set
-            lines_to_write = train_lines[-lines:]
-            for line in lines_to_write:
-                out_data_file.write(line.rstrip() + "\t\t4\n")
+    with open(train_file_to_open, "r+b") as in_file, \
+         open(test_file_to_open,  "a",  encoding="utf-8") as out_data_file:
+        offset = _tail_offset(in_file, lines)
+        in_file.seek(offset)
+        lines_to_write = _decode_lines(in_file.read().splitlines(keepends=True))
 
-            # Delete the last n lines from training file to prevent duplication
-            in_file.writelines(train_lines[:-lines])
+        # Append an "observed during training" label to each line from the training set
+        out_data_file.writelines(line.rstrip() + "\t\t4\n" for line in lines_to_write)
 
-    print("Done")
+        # Delete the last n lines from training file to prevent duplication
+        in_file.truncate(offset)
+
+def _inject_compressed_file(train_path: str, test_path: str, lines: int) -> None:
+    """
+    Internal function.
+    Move the last few lines of a compressed training file into the testing set. Compressed files
+    cannot be read from the end or truncated, so the training file is streamed to a new file,
+    keeping only its last `lines` lines in memory.
+    """
+    suffix = train_path[len(strip_compression_suffix(train_path)):]
+    tmp_path = strip_compression_suffix(train_path) + ".tmp" + suffix
+    tail = deque()
+    with open_text(train_path, "r") as in_file, open_text(tmp_path, "w") as out_file:
+        for line in in_file:
+            tail.append(line)
+            if len(tail) > lines:
+                out_file.write(tail.popleft())
+
+    # Append an "observed during training" label to each line from the training set
+    with open_text(test_path, "a") as out_data_file:
+        out_data_file.writelines(line.rstrip() + "\t\t4\n" for line in tail)
+    os.replace(tmp_path, train_path)
+
+
+def output_file_name(file: str, compression: str=None) -> str:
+    """
+    Name of the training and testing files extracted from a data file. Compressed data files are
+    extracted to uncompressed files unless `compression` is given, and zip archives are named like
+    the logs `unzip` unpacks them to (e.g., audit.zip -> audit.log or audit.log.zst)
+
+    Parameters
+    ----------
+    - `file`: data file name, without the root directory
+    - `compression`: optional format to compress the extracted files with, one of {"gz", "zst"}
+    """
+    if file.endswith(".zip"):
+        file = file[:-len(".zip")] + ".log"
+    file = strip_compression_suffix(file)
+    if compression:
+        file += "." + compression
+    return file
+
+def _fingerprint(path: str, end: int, block_size: int=1 << 16) -> str:
+    """
+    Internal function.
+    Hash the first and last blocks of the first `end` bytes of a file, to check cheaply that the
+    part of a file that was already processed has not changed
+    """
+    digest = hashlib.sha256(str(end).encode())
+    with open(path, "rb") as infile:
+        digest.update(infile.read(min(block_size, end)))
+        if end > block_size:
+            infile.seek(max(block_size, end - block_size))
+            digest.update(infile.read(end - infile.tell()))
+    return digest.hexdigest()
+
+def _ends_with_newline(path: str, end: int) -> bool:
+    """
+    Internal function.
+    Determine whether the first `end` bytes of a file end with a complete line
+    """
+    if end == 0:
+        return True
+    with open(path, "rb") as infile:
+        infile.seek(end - 1)
+        return infile.read(1) == b"\n"
 
+def _decode_lines(lines: list[bytes]) -> list[str]:
+    """
+    Internal function.
+    Decode lines read in binary mode, translating Windows line endings as text mode would
+    """
+    return [(line[:-2] + b"\n" if line.endswith(b"\r\n") else line).decode("utf-8")
+            for line in lines]
+
+def _source_state(path: str) -> dict:
+    """
+    Internal function.
+    Size and modification time of an input file, to detect changes
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def _outputs_unchanged(entry: dict, outputs: dict) -> bool:
+    """
+    Internal function.
+    Determine whether the output files are as the extraction recorded in a manifest entry left them
+    """
+    return all(os.path.exists(path) and os.path.getsize(path) == entry[name + "_end"]
+               for name, path in outputs.items())
+
+def _is_unchanged(entry: dict, settings: dict, sources: dict, outputs: dict) -> bool:
+    """
+    Internal function.
+    Determine whether the extraction recorded in a manifest entry is up to date
+    """
+    if entry is None or entry["settings"] != settings:
+        return False
+
+    for name, path in sources.items():
+        state = _source_state(path)
+        if entry[name]["size"] != state["size"] or entry[name]["mtime"] != state["mtime"]:
+            return False
+
+    return _outputs_unchanged(entry, outputs)
+
+def _can_resume(entry: dict, settings: dict, sources: dict, outputs: dict) -> bool:
+    """
+    Internal function.
+    Determine whether the extraction recorded in a manifest entry can be continued by appending,
+    i.e., the settings are the same, the input files only grew, and the output files are as they
+    were left
+    """
+    if entry is None or entry["settings"] != settings:
+        return False
+    if any(is_compressed(path) for path in list(sources.values()) + list(outputs.values())):
+        return False
+    if entry["data"]["lines"] != entry["labels"]["lines"]:
+        # NOTE(lucas): Data lines past the end of the label file were only used for training,
+        # so new label lines would be paired with the wrong data lines
+        return False
+
+    for name, path in sources.items():
+        state = entry[name]
+        if not os.path.exists(path) or os.path.getsize(path) < state["offset"] or \
+           not _ends_with_newline(path, state["offset"]) or \
+           _fingerprint(path, state["offset"]) != state["hash"]:
+            return False
+
+    return _outputs_unchanged(entry, outputs)
+
+def extract_file(root_dir: str, file: str, exclusion_list: list[str], inject_lines: int=5,
+                 chunk_size: int=1 << 20, exclusion_rules: dict[str, list[str]]=None,
+                 compression: str=None, manifest_entry: dict=None) -> tuple[str, dict, str]:
+    """
+    Extract the training and testing data of one file in a single pass.
+    Each line of the data file is read once with its line in the label file, and written to the
+    training set, the testing set, both or neither, as `extract_training_set` and
+    `extract_testing_set` would. The last lines of the training data are then moved into the
+    testing data, as `inject_testing_set` is meant to.
+    Compressed data and label files (zip, gzip or zstd) are read without unpacking them to disk.
+
+    If `manifest_entry` is given, a file that has not changed since it was extracted is skipped,
+    and a file that only had lines appended to it is extracted from where the last extraction
+    stopped, appending to the outputs. Otherwise, the file is extracted from scratch.
+
+    Parameters
+    ----------
+    - `root_dir`: root data directory
+    - `file`: file name to be processed, without the root directory
+    - `exclusion_list`: list of words used to exclude log lines
+    - `inject_lines`: the number of lines to move from the training file to the testing file
+    - `chunk_size`: approximate number of bytes of lines to process at once
+    - `exclusion_rules`: regex patterns used to exclude log lines, by log type.
+                         See `make_log_type_exclusion_filter`
+    - `compression`: optional format to compress the extracted files with, one of {"gz", "zst"}
+    - `manifest_entry`: entry of the file in the manifest of the last extraction
+
+    Returns
+    ---------
+    - the file name, to report progress
+    - the manifest entry of the file after this extraction
+    - what was done, one of {"extracted", "appended", "unchanged"}
+    """
+    # NOTE(lucas): input and output paths should be relative to data root directory
+    in_data_file_to_open = os.path.join(root_dir, "data", file)
+    in_label_file_to_open = os.path.join(root_dir, "labels", file)
+    out_file = output_file_name(file, compression)
+    out_train_file_to_open = os.path.join(root_dir, "train", out_file)
+    out_test_file_to_open = os.path.join(root_dir, "test", out_file)
+    # If there is not already a folder for output, create one
+    # (make sure not to make the target output file into a directory)
+    os.makedirs(parent_dir(out_train_file_to_open), exist_ok=True)
+    os.makedirs(parent_dir(out_test_file_to_open), exist_ok=True)
+
+    sources = {"data": in_data_file_to_open, "labels": in_label_file_to_open}
+    outputs = {"train": out_train_file_to_open, "test": out_test_file_to_open}
+    settings = {"exclusion_list": list(exclusion_list),
+                "exclusion_rules": exclusion_rules or {},
+                "inject_lines": inject_lines,
+                "compression": compression}
+
+    if _is_unchanged(manifest_entry, settings, sources, outputs):
+        return file, manifest_entry, "unchanged"
+
+    if _can_resume(manifest_entry, settings, sources, outputs):
+        status = "appended"
+        entry = manifest_entry
+        # Remove the injected lines, which are injected again at the end of the new lines
+        os.truncate(out_test_file_to_open, entry["test_size"])
+        train_mode = test_mode = "a"
+    else:
+        status = "extracted"
+        entry = {"data": {"offset": 0, "lines": 0}, "labels": {"offset": 0, "lines": 0},
+                 "held": []}
+        train_mode = test_mode = "w"
+    entry = dict(entry, settings=settings)
+
+    log_type = get_log_type(file)
+    is_valid_date = make_date_filter(log_type, TRAINING_DATES)
+    is_excluded = make_log_type_exclusion_filter(log_type, exclusion_list, exclusion_rules)
+
+    # NOTE(lucas): The last training lines are held back instead of written, to be moved to the
+    # testing set once the file is done
+    held_lines = deque(entry["held"])
+    data_lines_read = entry["data"]["lines"]
+    label_lines_read = entry["labels"]["lines"]
+    with open_binary(in_data_file_to_open,  "rb") as in_data_file, \
+         open_binary(in_label_file_to_open, "rb") as in_label_file, \
+         open_text(out_train_file_to_open, train_mode) as out_train_file, \
+         open_text(out_test_file_to_open,  test_mode) as out_test_file:
+        if entry["data"]["offset"] > 0:
+            in_data_file.seek(entry["data"]["offset"])
+            in_label_file.seek(entry["labels"]["offset"])
+
+        for data_lines in iter(lambda: in_data_file.readlines(chunk_size), []):
+            # NOTE(lucas): The testing set only uses data lines that have a label line
+            label_lines = list(islice(in_label_file, len(data_lines)))
+            data_lines = _decode_lines(data_lines)
+            label_lines = _decode_lines(label_lines)
+            data_lines_read += len(data_lines)
+            label_lines_read += len(label_lines)
+
+            train_lines = []
+            test_lines = []
+            for i, line in enumerate(data_lines):
+                if is_excluded(line):
+                    continue
+                if is_valid_date(line):
+                    held_lines.append(line)
+                    if len(held_lines) > inject_lines:
+                        train_lines.append(held_lines.popleft())
+                if i < len(label_lines) and label_lines[i].strip() != "0,0":
+                    test_lines.append(line.rstrip() + "\t\t0\n")
+
+            out_train_file.writelines(train_lines)
+            out_test_file.writelines(test_lines)
+
+        # NOTE(lucas): Offsets are only used to resume uncompressed files
+        resumable = not any(is_compressed(path) for path in list(sources.values()) +
+                            list(outputs.values()))
+        data_offset = in_data_file.tell() if resumable else None
+        label_offset = in_label_file.tell() if resumable else None
+        out_test_file.flush()
+        test_size = os.path.getsize(out_test_file_to_open) if resumable else None
+
+        # Append an "observed during training" label to each line moved from the training set
+        out_test_file.writelines(line.rstrip() + "\t\t4\n" for line in held_lines)
+
+    entry["held"] = list(held_lines)
+    entry["test_size"] = test_size
+    for name, path in sources.items():
+        entry[name] = _source_state(path)
+    entry["data"].update(offset=data_offset, lines=data_lines_read)
+    entry["labels"].update(offset=label_offset, lines=label_lines_read)
+    for name, path in sources.items():
+        entry[name]["hash"] = _fingerprint(path, entry[name]["offset"]) if resumable else None
+    for name, path in outputs.items():
+        entry[name + "_end"] = os.path.getsize(path)
+
+    return file, entry, status
+
+
+def _load_manifest(path: str) -> dict:
+    """
+    Internal function.
+    Load the manifest of the last extraction, which maps data file names to their manifest entries
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as infile:
+        return json.load(infile)
 
-def extract_dataset(raw_data_dir: str, exclude_errors: bool=True) -> None:
+def _save_manifest(manifest: dict, path: str) -> None:
+    """
+    Internal function.
+    Save the manifest of an extraction. The manifest is replaced at once, so an interrupted save
+    does not leave a partial manifest
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as outfile:
+        json.dump(manifest, outfile, indent=1)
+    os.replace(tmp_path, path)
+
+def extract_dataset(raw_data_dir: str, exclude_errors: bool=True, num_workers: int=None,
+                    exclusion_rules: dict[str, list[str]]=None, compression: str=None,
+                    incremental: bool=True) -> None:
     """
     Extract a smaller version of the AIT log dataset,
     optionally excluding log lines or zipped files
@@ -324,6 +912,13 @@ def extract_dataset(raw_data_dir: str, exclude_errors: bool=True) -> None:
     ----------
     - `raw_data_dir`: directory containing raw log files
     - `exclude_errors`: exclude log lines containing error/warning/status messages from dataset
+    - `num_workers`: number of files to extract at once. Defaults to the number of cores
+    - `exclusion_rules`: regex patterns used to exclude log lines, by log type, in addition to
+                         the error messages. See `make_log_type_exclusion_filter`
+    - `compression`: optional format to compress the extracted files with, one of {"gz", "zst"}
+    - `incremental`: only extract new and changed files, using the manifest of the last extraction
+                     (manifest.json in `raw_data_dir`). Files that only had lines appended to them
+                     are extracted from where the last extraction stopped
     """
     # List of strings to look for to determine whether
     # a log line should be excluded from the dataset
@@ -334,9 +929,34 @@ def extract_dataset(raw_data_dir: str, exclude_errors: bool=True) -> None:
     data_file_list = gather_files(os.path.join(raw_data_dir, "data"))
     # extract_archives(data_file_list, "data/")
     # extract_archives(label_file_list, "labels/")
-    extract_training_set(raw_data_dir, data_file_list, exclusion_list)
-    extract_testing_set(raw_data_dir, data_file_list, exclusion_list)
-    inject_testing_set(raw_data_dir, data_file_list, 5)
+
+    # NOTE(lucas): Archives are read directly. If an archive was already unpacked next to itself,
+    # only read the unpacked file so both do not write the same output
+    unpacked = {file for file in data_file_list if not is_compressed(file)}
+    data_file_list = [file for file in data_file_list
+                      if not is_compressed(file) or output_file_name(file) not in unpacked]
+
+    # Fail before starting the workers if a file cannot be opened or compressed
+    check_compression(compression, data_file_list)
+
+    manifest_path = os.path.join(raw_data_dir, "manifest.json")
+    manifest = _load_manifest(manifest_path) if incremental else {}
+
+    # Extract each file in one pass, spreading the files over processes
+    extract = functools.partial(extract_file, raw_data_dir, exclusion_list=exclusion_list,
+                                inject_lines=5, exclusion_rules=exclusion_rules,
+                                compression=compression)
+    new_manifest = {}
+    with ProcessPoolExecutor(num_workers) as executor:
+        futures = [executor.submit(extract, file, manifest_entry=manifest.get(file))
+                   for file in data_file_list]
+        for future in futures:
+            file, entry, status = future.result()
+            new_manifest[file] = entry
+            print(f"{status.capitalize()} {file}")
+
+    _save_manifest(new_manifest, manifest_path)
+    print("Dataset extracted")
 
     # Delete unzipped files
     # for file in data_file_list:
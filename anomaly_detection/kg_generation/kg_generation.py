@@ -8,14 +8,22 @@ import fileinput
 import json
 import logging
 import os
+import shutil
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 from drain3 import TemplateMiner
+from drain3.file_persistence import FilePersistence
+from drain3.memory_buffer_persistence import MemoryBufferPersistence
+from drain3.persistence_handler import PersistenceHandler
 from drain3.template_miner_config import TemplateMinerConfig
 
 import numpy as np
 
+from .log_io import (check_compression, is_compressed, open_binary, open_text,
+                     strip_compression_suffix)
+
 
 # TODO(lucas): Put os wrappers in separate file to be shared
 # (For some reason, this function did not work when placed in a separate file)
@@ -94,11 +102,112 @@ def remove_duplicate_lines(path: str):
     # Successfully removed duplicates and closed files, now delete backup file
     os.remove(path + ".bak")
 
+def _make_template_miner(persistence_handler: PersistenceHandler = None) -> TemplateMiner:
+    """
+    Create a Drain3 template miner configured with `config/drain3.ini`
+
+    Parameters
+    ----------
+    - `persistence_handler`: optional handler that the miner loads its initial state from
+    """
+    config = TemplateMinerConfig()
+    config.load(join_path("config", "drain3.ini"))
+    config.profiling_enabled = True
+    return TemplateMiner(persistence_handler, config=config)
+
+def _is_labeled(out_file: str, labels: bool) -> bool:
+    """
+    Determine whether the lines parsed into `out_file` end in a label.
+    Only lines from the test/val sets are labeled.
+
+    Parameters
+    ----------
+    - `out_file`: the file to which the parse results are written
+    - `labels`: whether the testing data is labeled
+    """
+    return labels and (file_in_dataset(out_file, "test") or file_in_dataset(out_file, "val"))
+
+def split_log_line(line: str, labeled: bool) -> tuple[str, str]:
+    """
+    Split a raw log line into the log message to be parsed and its label.
+    The message is the part of the line after the first ": ", without the log header.
+
+    Parameters
+    ----------
+    - `line`: raw log line
+    - `labeled`: whether the line ends in a label
+
+    Returns
+    ---------
+    The log message and the label, which is empty if the line is not labeled
+    """
+    line = line.rstrip()
+    # NOTE(lucas): Temporarily lift label if it comes from test/val set
+    # so it does not appear in template. Then put it back
+    label = ""
+    if labeled:
+        _, *_, label = line.split()
+        line = line.rsplit(None, 1)[0]
+    line = line.rstrip()
+
+    # TODO(lucas): See about removing this to preserve timestamp/additional information
+    return line.partition(": ")[2], label
+
+def parse_line(template_miner: TemplateMiner, line: str, frozen: bool=False,
+               match_only: bool=False) -> dict:
+    """
+    Parse a log message into its template and parameters, as `parse_log` does for each line of a
+    file. Messages are usually split off their log line with `split_log_line` first.
+
+    Parameters
+    ----------
+    - `template_miner`: the template miner to parse with
+    - `line`: log message to parse
+    - `frozen`: match the message against the existing templates first, only adding it to the
+                miner if no template matches
+    - `match_only`: only match the message against the existing templates, never changing them.
+                    If no template matches, the result has no template or parameters
+
+    Returns
+    ---------
+    The Drain3 parse result (change type, cluster ID and size, mined template and cluster count)
+    with the parameters of the message under "params". `parse_log` adds the line's label under
+    "label" before writing it
+    """
+    cluster = None
+    if frozen or match_only:
+        cluster = template_miner.match(line, full_search_strategy="fallback")
+
+    if cluster is None and match_only:
+        return {"change_type": "none",
+                "cluster_id": None,
+                "cluster_size": 0,
+                "template_mined": None,
+                "cluster_count": len(template_miner.drain.clusters),
+                "params": []}
+    if cluster is None:
+        result = template_miner.add_log_message(line)
+    else:
+        result = {"change_type": "none",
+                  "cluster_id": cluster.cluster_id,
+                  "cluster_size": cluster.size,
+                  "template_mined": cluster.get_template(),
+                  "cluster_count": len(template_miner.drain.clusters)}
+
+    result["params"] = template_miner.extract_parameters(
+            result["template_mined"],
+            line,
+            exact_matching=True)
+
+    return result
+
 def parse_log(in_log_file: str,
               out_file: str,
               batch_size: int = 10000,
               logger: logging.Logger = None,
-              labels=False) -> None:
+              labels=False,
+              template_miner: TemplateMiner = None,
+              match_only: bool = False) -> None:
     """
     Parse a log file, writing the templates and extracted parameters to a JSON file.
 
@@ -108,42 +217,28 @@ def parse_log(in_log_file: str,
     - `out_file`: the file to which to write the results
     - `logger`: optional logger to print progress messages to terminal
     - `label_file`: path to label file if lines include labels
+    - `template_miner`: template miner to continue parsing with (see `load_template_miner`).
+                        If not given, a fresh template miner is created for this file
+    - `match_only`: only match lines against the templates already learned by `template_miner`
+                    instead of learning from them
     """
-
-    config = TemplateMinerConfig()
-    config.load(join_path("config", "drain3.ini"))
-    config.profiling_enabled = True
-    template_miner = TemplateMiner(config=config)
+    if template_miner is None:
+        template_miner = _make_template_miner()
 
     line_count = 0
 
     print(in_log_file)
     print(out_file)
 
-    with open(in_log_file, "r", encoding="utf-8") as infile, \
-        open(out_file, "w", encoding="utf-8") as outfile:
+    labeled = _is_labeled(out_file, labels)
+    with open_text(in_log_file, "r") as infile, \
+        open_text(out_file, "w") as outfile:
         start_time = time.time()
         batch_start_time = start_time
 
         for line in infile:
-            line = line.rstrip()
-            # NOTE(lucas): Temporarily lift label if it comes from test/val set
-            # so it does not appear in template. Then put it back
-            label = ""
-            if labels and (file_in_dataset(outfile.name, "test") or \
-                           file_in_dataset(outfile.name, "val")):
-                _, *_, label = line.split()
-                line = line.rsplit(None, 1)[0]
-            line = line.rstrip()
-
-            # TODO(lucas): See about removing this to preserve timestamp/additional information
-            line = line.partition(": ")[2]
-
-            result = template_miner.add_log_message(line)
-            result["params"] = template_miner.extract_parameters(
-                    result["template_mined"],
-                    line,
-                    exact_matching=True)
+            line, label = split_log_line(line, labeled)
+            result = parse_line(template_miner, line, match_only=match_only)
             result["label"] = label
 
             line_count += 1
@@ -153,8 +248,6 @@ def parse_log(in_log_file: str,
                 logger.info(f"Processing line: {line_count}, rate {rate:.1f} lines/sec, "
                             f"{len(template_miner.drain.clusters)} clusters so far.")
                 batch_start_time = time.time()
-            if result["change_type"] != "none":
-                json.dumps(result)
 
             outfile.write(json.dumps(result) + "\n")
 
@@ -170,17 +263,340 @@ def parse_log(in_log_file: str,
 
     template_miner.profiler.report(0)
 
-def extract_relations_templates(template_dir: str, out_path: str, label_path: str=None) -> None:
+    # Snapshot the learned templates so the next file or run can start from them
+    if template_miner.persistence_handler is not None and not match_only:
+        template_miner.save_state("end of file")
+
+def load_template_miner(state_path: str = None) -> TemplateMiner:
     """
-    Extract relations from parsed log files using templates,
-    and write the resulting triples to a file.
+    Create a template miner that can be shared between log files. If `state_path` is given, the
+    miner is warm-started from the snapshot at that path if it exists, and snapshots of its state
+    are saved there as it learns (see the [SNAPSHOT] section of `config/drain3.ini`).
 
     Parameters
     ----------
-    - `template_dir`: the directory containing log template files
-    - `out_file`: the file to which to write the extracted triples
-    - `labels`: whether log lines contain labels (i.e., number that indicates suspicion).
-                Only affects test/val datasets
+    - `state_path`: optional path to the snapshot file
+    """
+    persistence_handler = FilePersistence(state_path) if state_path else None
+    return _make_template_miner(persistence_handler)
+
+def _file_shards(path: str, shard_size: int) -> list[tuple[int, int]]:
+    """
+    Split a file into byte ranges of roughly `shard_size` bytes that start and end on line
+    boundaries. Compressed files cannot be read from an offset, so they are one shard.
+
+    Parameters
+    ----------
+    - `path`: path to file
+    - `shard_size`: approximate size of each shard in bytes
+    """
+    file_size = os.path.getsize(path)
+    if is_compressed(path):
+        return [(0, file_size)]
+
+    bounds = [0]
+    with open(path, "rb") as infile:
+        while bounds[-1] + shard_size < file_size:
+            # Move the boundary forward to the start of the next line
+            infile.seek(bounds[-1] + shard_size)
+            infile.readline()
+            if infile.tell() >= file_size:
+                break
+            bounds.append(infile.tell())
+    bounds.append(file_size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _read_shard(path: str, start: int, end: int):
+    """
+    Generator over the lines of a file in the byte range [start, end)
+
+    Parameters
+    ----------
+    - `path`: path to file
+    - `start`: byte offset of the first line
+    - `end`: byte offset after the last line
+    """
+    if is_compressed(path):
+        with open_text(path, "r") as infile:
+            yield from infile
+        return
+
+    with open(path, "rb") as infile:
+        infile.seek(start)
+        while infile.tell() < end:
+            line = infile.readline()
+            if not line:
+                break
+            yield line.decode("utf-8")
+
+def _mine_shard(shard: tuple) -> list[str]:
+    """
+    Mine templates from one shard of a log file with a fresh template miner.
+    Runs in a worker process.
+
+    Parameters
+    ----------
+    - `shard`: tuple of (log file path, start offset, end offset, whether lines are labeled)
+
+    Returns
+    ---------
+    The templates of the mined clusters, in the order they were created
+    """
+    path, start, end, labeled = shard
+    template_miner = _make_template_miner()
+    for line in _read_shard(path, start, end):
+        line, _ = split_log_line(line, labeled)
+        template_miner.add_log_message(line)
+
+    clusters = sorted(template_miner.drain.clusters, key=lambda cluster: cluster.cluster_id)
+    return [cluster.get_template() for cluster in clusters]
+
+# Merged template miner state shared with the workers that parse shards
+_merged_state = None
+
+def _init_parse_worker(state: bytes) -> None:
+    """
+    Store the merged template miner state in a worker process
+
+    Parameters
+    ----------
+    - `state`: template miner state saved by Drain3
+    """
+    global _merged_state
+    _merged_state = state
+
+def _parse_shard(shard: tuple) -> tuple[int, list[tuple[int, str, str]]]:
+    """
+    Parse one shard of a log file against the merged templates, writing the results to a part
+    file. Runs in a worker process.
+
+    Lines are only matched against the merged templates, never added to them. Unless the shard
+    only matches lines, a line that matches no template is left as an empty line in the part file
+    and returned, to be parsed with the shared template miner once all shards are done.
+
+    Parameters
+    ----------
+    - `shard`: tuple of (log file path, start offset, end offset, whether lines are labeled,
+               whether to only match lines, part file path)
+
+    Returns
+    ---------
+    The number of lines parsed and a list of (line index, line, label) of the unmatched lines
+    """
+    path, start, end, labeled, match_only, part_file = shard
+
+    persistence = MemoryBufferPersistence()
+    persistence.state = _merged_state
+    template_miner = _make_template_miner(persistence)
+    template_miner.persistence_handler = None
+
+    line_count = 0
+    unmatched = []
+    with open(part_file, "w", encoding="utf-8") as outfile:
+        for line in _read_shard(path, start, end):
+            line, label = split_log_line(line, labeled)
+            result = parse_line(template_miner, line, match_only=True)
+            if result["cluster_id"] is None and not match_only:
+                # NOTE(lucas): Adding the line to this worker's copy of the templates would give
+                # it a cluster ID that does not exist in the shared template miner
+                unmatched.append((line_count, line, label))
+                outfile.write("\n")
+            else:
+                result["label"] = label
+                outfile.write(json.dumps(result) + "\n")
+            line_count += 1
+
+    return line_count, unmatched
+
+def _write_part_file(outfile, part_file: str, parsed: dict[int, dict], shard: tuple,
+                     template_miner: TemplateMiner, changed_ids: set) -> None:
+    """
+    Internal function.
+    Copy a part file written by `_parse_shard` to the result file, filling in the results of its
+    unmatched lines. Results of clusters whose template changed after the line was parsed are
+    resolved again against the final template, re-reading the lines from the shard.
+    """
+    with open(part_file, "rb") as infile:
+        if not parsed and not changed_ids:
+            shutil.copyfileobj(infile, outfile)
+            return
+
+        path, start, end, labeled = shard[:4]
+        lines = _read_shard(path, start, end) if changed_ids else None
+        for i, part_line in enumerate(infile):
+            log_line = next(lines) if lines is not None else None
+            if i in parsed:
+                result = parsed[i]
+            elif changed_ids:
+                result = json.loads(part_line)
+            else:
+                outfile.write(part_line)
+                continue
+
+            if result["cluster_id"] in changed_ids:
+                cluster = template_miner.drain.id_to_cluster.get(result["cluster_id"])
+                if cluster is not None:
+                    message, _ = split_log_line(log_line, labeled)
+                    result["template_mined"] = cluster.get_template()
+                    result["cluster_size"] = cluster.size
+                    result["params"] = template_miner.extract_parameters(
+                            result["template_mined"],
+                            message,
+                            exact_matching=True)
+            outfile.write((json.dumps(result) + "\n").encode("utf-8"))
+
+def parse_logs_parallel(log_files: list[tuple[str, str]],
+                        num_workers: int,
+                        shard_size: int = 64 * 1024 * 1024,
+                        logger: logging.Logger = None,
+                        labels=False,
+                        template_miner: TemplateMiner = None,
+                        match_only: bool = False) -> None:
+    """
+    Parse log files across a pool of processes, writing the same JSON results as `parse_log`.
+    Large files are split into shards of about `shard_size` bytes.
+
+    Parsing happens in two passes. First, each worker mines templates from its shards. The
+    templates are then merged into one template miner in shard order, so the merged template set
+    does not depend on how shards were scheduled. Second, each worker parses its shards by
+    matching lines against the merged templates. The few lines that match no merged template are
+    then parsed with the merged template miner, in shard order. If that changes a template, the
+    lines of its cluster are resolved again, so every result has the final template of its
+    cluster. Results are therefore not equal to those of `parse_log`, where each line keeps the
+    template its cluster had when the line was parsed, and cluster IDs are numbered differently.
+
+    Parameters
+    ----------
+    - `log_files`: list of (log file, result file) pairs
+    - `num_workers`: number of worker processes
+    - `shard_size`: approximate size of each shard in bytes
+    - `logger`: optional logger to print progress messages to terminal
+    - `labels`: whether the testing data is labeled
+    - `template_miner`: template miner to merge the mined templates into (see
+                        `load_template_miner`). A fresh template miner is used if not given
+    - `match_only`: only match lines from the test/val sets against the merged templates
+                    instead of learning from them
+    """
+    shards = []
+    out_files = []
+    for in_log_file, out_file in log_files:
+        labeled = _is_labeled(out_file, labels)
+        shard_match_only = match_only and not file_in_dataset(out_file, "train")
+        for start, end in _file_shards(in_log_file, shard_size):
+            shards.append((in_log_file, start, end, labeled, shard_match_only))
+            out_files.append(out_file)
+
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        shard_templates = list(executor.map(_mine_shard, [shard[:4] for shard in shards
+                                                          if not shard[4]]))
+
+    if template_miner is None:
+        template_miner = _make_template_miner()
+
+    # NOTE(lucas): Detach the persistence handler while merging so that a snapshot is not saved
+    # for every merged template
+    persistence_handler = template_miner.persistence_handler
+    template_miner.persistence_handler = None
+    for templates in shard_templates:
+        for template in templates:
+            template_miner.add_log_message(template)
+
+    persistence = MemoryBufferPersistence()
+    template_miner.persistence_handler = persistence
+    template_miner.save_state("merged templates from workers")
+    template_miner.persistence_handler = None
+    if logger:
+        logger.info(f"Merged templates from {len(shards)} shards into "
+                    f"{len(template_miner.drain.clusters)} clusters in "
+                    f"{time.time() - start_time:.2f} sec")
+
+    # NOTE(lucas): Each shard is written to its own part file, which are concatenated in order
+    part_files = [f"{out_file}.part{i}" for i, out_file in enumerate(out_files)]
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             initializer=_init_parse_worker,
+                             initargs=(persistence.state,)) as executor:
+        shard_results = list(executor.map(_parse_shard,
+                                          [shard + (part_file,) for shard, part_file
+                                           in zip(shards, part_files)]))
+    line_count = sum(shard_line_count for shard_line_count, _ in shard_results)
+
+    # NOTE(lucas): Lines that matched no merged template are parsed with the shared template
+    # miner in shard order, so every cluster ID refers to its templates and the result does not
+    # depend on how shards were scheduled
+    shard_parsed = []
+    changed_ids = set()
+    for _, unmatched in shard_results:
+        parsed = {}
+        for i, line, label in unmatched:
+            parsed[i] = parse_line(template_miner, line, frozen=True)
+            parsed[i]["label"] = label
+            if parsed[i]["change_type"] == "cluster_template_changed":
+                changed_ids.add(parsed[i]["cluster_id"])
+        shard_parsed.append(parsed)
+    template_miner.persistence_handler = persistence_handler
+    if persistence_handler is not None:
+        template_miner.save_state("merged templates from workers")
+
+    for _, out_file in log_files:
+        with open_binary(out_file, "wb") as outfile:
+            for shard, shard_out_file, part_file, parsed in zip(shards, out_files, part_files,
+                                                                shard_parsed):
+                if shard_out_file != out_file:
+                    continue
+                _write_part_file(outfile, part_file, parsed, shard, template_miner, changed_ids)
+                os.remove(part_file)
+
+    time_taken = time.time() - start_time
+    rate = line_count / time_taken if time_taken > 0 else 0
+    if logger:
+        logger.info(f"--- Done processing {len(log_files)} files in {time_taken:.2f} sec. "
+                    f"Total of {line_count} lines, rate {rate:.1f} lines/sec, "
+                    f"{len(template_miner.drain.clusters)} clusters")
+
+def load_template_index(templates_path: str = None) -> dict:
+    """
+    Load the relation templates and index them by their mined template string, so that a parsed
+    log line can be matched against every template with a single dictionary lookup.
+
+    Parameters
+    ----------
+    - `templates_path`: path to templates file. Defaults to `config/templates.json`
+
+    Returns
+    ---------
+    A dictionary mapping each `template_mined` string to the list of its relations
+    """
+    if templates_path is None:
+        templates_path = join_path("config", "templates.json")
+
+    with open(templates_path, "r", encoding="utf-8") as template_file:
+        templates = json.load(template_file)["templates"]
+
+    # NOTE(lucas): If the same template appears more than once, keep the relations of every entry
+    # so that the output is the same as matching against each template in turn
+    template_index = {}
+    for template in templates:
+        template_index.setdefault(template["template_mined"], []).extend(template["relations"])
+
+    return template_index
+
+def iter_triples(parse_results, template_index: dict, add_types: bool=False):
+    """
+    Generator over the triples extracted from parsed log lines using templates, as
+    `extract_relations_templates` does for the parse results of a file
+
+    Parameters
+    ----------
+    - `parse_results`: iterable of parse results, as written by `parse_log` or returned by
+                       `parse_line` with a "label" added
+    - `template_index`: templates indexed by `load_template_index`
+    - `add_types`: whether to add type relations for subjects and objects (train set only)
+
+    Returns
+    ---------
+    (subject, relation, object, label) tuples. Type relations have a label of None
     """
     # TODO(lucas): Replace this mapping with mappings to ontologies
     type_map = {"IP": "ip_address",
@@ -191,53 +607,64 @@ def extract_relations_templates(template_dir: str, out_path: str, label_path: st
                 "HOST": "host",
                 "SESSION": "session"}
 
+    for parse_result in parse_results:
+        relations = template_index.get(parse_result["template_mined"])
+        if relations is None:
+            continue
+
+        # If a matching template is found, get the subject, relation, and object.
+        # The template contains the index into the "params" field of the parsed log file
+        params = parse_result["params"]
+        for relation in relations:
+            sub_index = relation["subject"]
+            obj_index = relation["object"]
+            sub = str(params[sub_index][0]).lower()
+            obj = str(params[obj_index][0]).lower()
+            rel = str(relation["relation_label"]).lower()
+            yield sub, rel, obj, parse_result["label"]
+
+            # TODO(lucas): Add type relations for objects
+            # Add type relation if subject
+            sub_type = params[sub_index][1]
+            obj_type = params[obj_index][1]
+            if add_types and sub_type in type_map:
+                # TODO(lucas): replace with RDF type relation
+                yield sub, "a", type_map[sub_type].lower(), None
+            if add_types and obj_type in type_map:
+                yield params[obj_index][0].lower(), "a", type_map[obj_type].lower(), None
+
+def extract_relations_templates(template_dir: str, out_path: str, label_path: str=None,
+                                template_index: dict=None) -> None:
+    """
+    Extract relations from parsed log files using templates,
+    and write the resulting triples to a file.
+
+    Parameters
+    ----------
+    - `template_dir`: the directory containing log template files
+    - `out_file`: the file to which to write the extracted triples
+    - `labels`: whether log lines contain labels (i.e., number that indicates suspicion).
+                Only affects test/val datasets
+    - `template_index`: templates indexed by `load_template_index`. Loaded from the default
+                        templates file if not given
+    """
+    if template_index is None:
+        template_index = load_template_index()
+
     label_file = None
     if label_path:
-        label_file = open(label_path, "w", encoding="utf-8")
-
-    # TODO(lucas): Try to reduce nesting
-    with open(out_path, "w", encoding="utf-8") as outfile, \
-         open (join_path("config", "templates.json"), "r", encoding="utf-8") as template_file:
-        templates = json.load(template_file)["templates"]
+        label_file = open_text(label_path, "w")
 
+    with open_text(out_path, "w") as outfile:
         for entry in os.listdir(template_dir):
-            with open(join_path(template_dir, entry), "r", encoding="utf-8") as infile:
-                # For each line, search for a matching template
-                for parsed_line in infile:
-                    for template in templates:
-                        parse_result = json.loads(parsed_line)
-                        if template["template_mined"] == parse_result["template_mined"]:
-                            # If a matching template is found, get the subject, relation, and object
-                            # and write a triple to the output file.
-                            # The template contains the index into the "params" field of the parsed
-                            # log file
-                            for relation in template["relations"]:
-                                sub_index = relation["subject"]
-                                obj_index = relation["object"]
-                                sub = str(parse_result["params"][sub_index][0]).lower()
-                                obj = str(parse_result["params"][obj_index][0]).lower()
-                                rel = str(relation["relation_label"]).lower()
-                                if label_file:
-                                    label = parse_result["label"]
-                                    outfile.write(f"{sub}\t{rel}\t{obj}\n")
-                                    label_file.write(label + '\n')
-                                else:
-                                    outfile.write(f"{sub}\t{rel}\t{obj}\n")
-
-                                # TODO(lucas): Add type relations for objects
-                                # Add type relation if subject
-                                sub_type = parse_result["params"][sub_index][1]
-                                obj_type = parse_result["params"][obj_index][1]
-                                if file_in_dataset(infile.name, "train") and  sub_type in type_map:
-                                    # TODO(lucas): replace with RDF type relation
-                                    rel = "a"
-                                    obj = type_map[sub_type].lower()
-                                    outfile.write(f"{sub}\t{rel}\t{obj}\n")
-                                if file_in_dataset(infile.name, "train") and obj_type in type_map:
-                                    sub = parse_result["params"][obj_index][0].lower()
-                                    rel = "a"
-                                    obj = type_map[obj_type].lower()
-                                    outfile.write(f"{sub}\t{rel}\t{obj}\n")
+            entry_path = join_path(template_dir, entry)
+            with open_text(entry_path, "r") as infile:
+                add_types = file_in_dataset(entry_path, "train")
+                parse_results = (json.loads(parsed_line) for parsed_line in infile)
+                for sub, rel, obj, label in iter_triples(parse_results, template_index, add_types):
+                    outfile.write(f"{sub}\t{rel}\t{obj}\n")
+                    if label_file and label is not None:
+                        label_file.write(label + '\n')
 
     if label_file and not label_file.closed:
         label_file.close()
@@ -256,16 +683,33 @@ def generate_val_set(train_path: str, out_val_path: str, val_ratio: float):
     with open(train_path, "r", encoding="utf-8") as test_file:
         test_data = np.array(test_file.readlines())
 
-    shuffled_indices = np.random.permutation(len(test_data))
-    val_size = int(len(test_data) * val_ratio)
-    val_indices = shuffled_indices[:val_size]
-    test_indices = shuffled_indices[val_size:]
+    test_data, val_data = _split_val_set(test_data, val_ratio)
 
     with open(train_path, "w", encoding="utf-8") as test_file:
-        test_file.writelines(test_data[test_indices])
+        test_file.writelines(test_data)
 
     with open(out_val_path, "w", encoding="utf-8")  as val_file:
-        val_file.writelines(test_data[val_indices])
+        val_file.writelines(val_data)
+
+def _split_val_set(data: np.ndarray, val_ratio: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Randomly split a dataset into two pieces based on val_ratio. Internal function
+
+    Parameters
+    ----------
+    - `data`: array of dataset lines
+    - `val_ratio`: percentage of data to split off for validation data
+
+    Returns
+    ---------
+    The remaining data and the validation data
+    """
+    shuffled_indices = np.random.permutation(len(data))
+    val_size = int(len(data) * val_ratio)
+    val_indices = shuffled_indices[:val_size]
+    remaining_indices = shuffled_indices[val_size:]
+
+    return data[remaining_indices], data[val_indices]
 
 def _save_ids(path: str, mapping: dict):
     """
@@ -310,30 +754,48 @@ def _regenerate_triples_with_ids(triples_path: str, ent_ids: dict, rel_ids: dict
     with open(new_triples_path, "r", encoding="utf-8") as infile, \
          open(out_path, "w", encoding="utf-8") as outfile:
         for line in infile:
-            line = line.rstrip().split('\t')
-
-            if line[0] not in ent_ids:
-                print(f"{line[0]} does not exist in entity mapping. Discarding triple.")
-                discarded_tripes += 1
-                continue
-            if line[1] not in rel_ids:
-                print(f"{line[1]} does not exist in relation mapping. Discarding triple.")
-                discarded_tripes += 1
-                continue
-            if line[2] not in ent_ids:
-                print(f"{line[2]} does not exist in entity mapping. Discarding triple.")
+            id_line = triple_to_ids(line.rstrip().split('\t'), ent_ids, rel_ids)
+            if id_line is None:
                 discarded_tripes += 1
                 continue
 
-            # All mappings exist
-            sub = str(ent_ids[line[0]])
-            rel = str(rel_ids[line[1]])
-            obj = str(ent_ids[line[2]])
-            outfile.write(sub + '\t' + rel + '\t' + obj + '\n')
+            outfile.write(id_line)
 
     triples_filename = triples_path_root[triples_path_root.rfind(os.sep):]
     print(f"{discarded_tripes} triples discarded from {triples_filename}")
 
+def triple_to_ids(triple: list[str], ent_ids: dict, rel_ids: dict) -> str:
+    """
+    Look up the IDs of the elements of a triple, e.g. with the mappings saved by `generate_kg`
+    when generating IDs
+
+    Parameters
+    ----------
+    - `triple`: subject, relation, and object strings
+    - `ent_ids`: mapping of entity strings to IDs
+    - `rel_ids`: mapping of relation strings to IDs
+
+    Returns
+    ---------
+    The triple of IDs as a line to write to a dataset, or None if an entity or relation
+    does not exist in the mappings
+    """
+    if triple[0] not in ent_ids:
+        print(f"{triple[0]} does not exist in entity mapping. Discarding triple.")
+        return None
+    if triple[1] not in rel_ids:
+        print(f"{triple[1]} does not exist in relation mapping. Discarding triple.")
+        return None
+    if triple[2] not in ent_ids:
+        print(f"{triple[2]} does not exist in entity mapping. Discarding triple.")
+        return None
+
+    # All mappings exist
+    sub = str(ent_ids[triple[0]])
+    rel = str(rel_ids[triple[1]])
+    obj = str(ent_ids[triple[2]])
+    return sub + '\t' + rel + '\t' + obj + '\n'
+
 def _generate_ids(preprpocessed_data_dir: str, train_path: str,
                   test_path: str, val_path: str) -> None:
     """
@@ -382,31 +844,24 @@ def _generate_ids(preprpocessed_data_dir: str, train_path: str,
     _regenerate_triples_with_ids(test_path, ent_ids, rel_ids)
     _regenerate_triples_with_ids(val_path, ent_ids, rel_ids)
 
-def generate_kg(raw_data_dir: str, labels: bool=True, gen_ids: bool=False) -> None:
+def _gather_log_files(raw_data_dir: str, compression: str=None) -> list[tuple[str, str]]:
     """
-    Generate a knowledge graph from a set of log files using entity and relation extraction.
+    Gather the log files of the train/test/val sets and the paths to write their parse results to
 
     Parameters
     ----------
     - `raw_data_dir`: path to directory containing raw log data
-    - `labels`: whether the testing data should be labeled
-    """
-    # TODO(lucas): Think about converting to all lowercase. Names appear as both, so irwin and
-    # Irwin are technically two different entities.
-    # TODO(lucas): For the AIT dataset, map names to email addresses to be clear that they refer
-    # to the same person
-    logger = logging.getLogger(__name__)
-    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
-
-    # Directory to write KG data to
-    preprocessed_data_dir = os.path.join(raw_data_dir, "preprocessed")
-
-    make_dir("templates")
-    make_dir(preprocessed_data_dir)
+    - `compression`: optional format to compress the parse results with, one of {"gz", "zst"}
 
+    Returns
+    ---------
+    A list of (log file, result file) pairs, sorted by log file. Raises an error if a log file
+    cannot be opened or the results cannot be compressed, before any file is parsed
+    """
+    log_files = []
     for root, _, files in os.walk(raw_data_dir):
         for file in files:
-            filename = os.path.splitext(file)[0]
+            filename = os.path.splitext(strip_compression_suffix(file))[0]
 
             # TODO(lucas): Is there a better way to keep these files separate?
             # TODO(lucas): Map the matches below to train/test/val to be more consistent
@@ -421,18 +876,224 @@ def generate_kg(raw_data_dir: str, labels: bool=True, gen_ids: bool=False) -> No
                                              .replace("\\\\", "_") + "_"
                 result_prefix = os.path.join(match, result_prefix)
 
-                make_dir(join_path("templates", match))
-
                 result_file = join_path("templates", result_prefix + filename + "_result.jsonl")
-                parse_log(os.path.join(root, file), result_file, logger=logger, labels=labels)
+                if compression:
+                    result_file += "." + compression
+                log_files.append((os.path.join(root, file), result_file))
+
+    check_compression(compression, [in_log_file for in_log_file, _ in log_files])
+    return sorted(log_files)
+
+def _iter_parse_results(in_log_file: str, labeled: bool, out_file: str=None,
+                        template_miner: TemplateMiner=None, match_only: bool=False):
+    """
+    Generator over the parse results of a log file. Like `parse_log`, each file is parsed with a
+    fresh template miner unless `template_miner` is given.
+
+    Parameters
+    ----------
+    - `in_log_file`: the log file to parse
+    - `labeled`: whether the lines of the log file end in a label
+    - `out_file`: optional file to also write the results to
+    - `template_miner`: optional template miner to continue parsing with
+    - `match_only`: only match lines against the templates already learned by `template_miner`
+    """
+    if template_miner is None:
+        template_miner = _make_template_miner()
+    outfile = open_text(out_file, "w") if out_file else None
+    try:
+        with open_text(in_log_file, "r") as infile:
+            for line in infile:
+                line, label = split_log_line(line, labeled)
+                result = parse_line(template_miner, line, match_only=match_only)
+                result["label"] = label
+                if outfile:
+                    outfile.write(json.dumps(result) + "\n")
+                yield result
+    finally:
+        if outfile:
+            outfile.close()
+
+    if template_miner.persistence_handler is not None and not match_only:
+        template_miner.save_state("end of file")
+
+def _write_triples(path: str, lines, ent_ids: dict=None, rel_ids: dict=None) -> None:
+    """
+    Write triple lines to a dataset, optionally replacing entities and relations with their IDs.
+    Internal function
+
+    Parameters
+    ----------
+    - `path`: location to write the dataset
+    - `lines`: tab-separated triple lines
+    - `ent_ids`: optional mapping of entity strings to IDs
+    - `rel_ids`: optional mapping of relation strings to IDs
+    """
+    discarded_tripes = 0
+    with open_text(path, "w") as outfile:
+        for line in lines:
+            if ent_ids is not None:
+                line = triple_to_ids(line.rstrip().split('\t'), ent_ids, rel_ids)
+                if line is None:
+                    discarded_tripes += 1
+                    continue
+            outfile.write(line)
+
+    if ent_ids is not None:
+        triples_filename = os.path.splitext(path)[0]
+        triples_filename = triples_filename[triples_filename.rfind(os.sep):]
+        print(f"{discarded_tripes} triples discarded from {triples_filename}")
+
+def _generate_kg_streaming(raw_data_dir: str, labels: bool, gen_ids: bool,
+                           keep_templates: bool, logger: logging.Logger,
+                           template_miner: TemplateMiner=None, match_only: bool=False,
+                           compression: str=None) -> None:
+    """
+    Generate the train/test/val datasets in one pass over the raw log files. Parsed lines are sent
+    straight through relation extraction and ID generation into the final dataset files. Only the
+    test set is kept in memory, to split off the validation set.
+
+    Parameters
+    ----------
+    - `raw_data_dir`: path to directory containing raw log data
+    - `labels`: whether the testing data should be labeled
+    - `gen_ids`: whether to replace entities and relations with IDs
+    - `keep_templates`: whether to also write the parse results to the templates directory
+    - `logger`: logger to print progress messages to terminal
+    - `template_miner`: optional template miner shared between log files
+    - `match_only`: only match lines from the test set against the learned templates
+    - `compression`: optional format to compress the kept parse results with
+    """
+    preprocessed_data_dir = os.path.join(raw_data_dir, "preprocessed")
+    train_kg_file = os.path.join(preprocessed_data_dir, "train.txt")
+    test_kg_file = os.path.join(preprocessed_data_dir, "test.txt")
+    val_kg_file = os.path.join(preprocessed_data_dir, "valid.txt")
+    label_file = os.path.join(preprocessed_data_dir, "labels.txt")
+    template_index = load_template_index()
+
+    # NOTE(lucas): As in the file-based pipeline, only the train and test sets are used.
+    # Process the train set first, because IDs are assigned from it.
+    log_files = _gather_log_files(raw_data_dir, compression)
+    train_logs = [(in_log_file, result_file) for in_log_file, result_file in log_files
+                  if os.path.basename(os.path.dirname(result_file)) == "train"]
+    test_logs = [(in_log_file, result_file) for in_log_file, result_file in log_files
+                 if os.path.basename(os.path.dirname(result_file)) == "test"]
+    if keep_templates:
+        for _, result_file in train_logs + test_logs:
+            make_dir(os.path.dirname(result_file))
+
+    def triples(dataset_logs):
+        for in_log_file, result_file in dataset_logs:
+            logger.info(f"Streaming {in_log_file}")
+            add_types = file_in_dataset(result_file, "train")
+            parse_results = _iter_parse_results(in_log_file, _is_labeled(result_file, labels),
+                                                result_file if keep_templates else None,
+                                                template_miner, match_only and not add_types)
+            yield from iter_triples(parse_results, template_index, add_types)
+
+    ent_ids = {}
+    rel_ids = {}
+    with open(train_kg_file, "w", encoding="utf-8") as outfile:
+        for sub, rel, obj, _ in triples(train_logs):
+            if gen_ids:
+                # Assign IDs in order of first appearance in the train set
+                sub = ent_ids.setdefault(sub, len(ent_ids))
+                rel = rel_ids.setdefault(rel, len(rel_ids))
+                obj = ent_ids.setdefault(obj, len(ent_ids))
+            outfile.write(f"{sub}\t{rel}\t{obj}\n")
+
+    test_lines = []
+    with open(label_file, "w", encoding="utf-8") as outfile:
+        for sub, rel, obj, label in triples(test_logs):
+            test_lines.append(f"{sub}\t{rel}\t{obj}\n")
+            if label is not None:
+                outfile.write(label + '\n')
+
+    test_lines, val_lines = _split_val_set(np.array(test_lines), val_ratio=0.5)
+
+    if gen_ids:
+        _save_ids(os.path.join(preprocessed_data_dir, "entity_ids.txt"), ent_ids)
+        _save_ids(os.path.join(preprocessed_data_dir, "relation_ids.txt"), rel_ids)
+        _write_triples(test_kg_file, test_lines, ent_ids, rel_ids)
+        _write_triples(val_kg_file, val_lines, ent_ids, rel_ids)
+    else:
+        _write_triples(test_kg_file, test_lines)
+        _write_triples(val_kg_file, val_lines)
+
+def generate_kg(raw_data_dir: str, labels: bool=True, gen_ids: bool=False,
+                num_workers: int=1, stream: bool=False, keep_templates: bool=False,
+                state_path: str=None, match_only: bool=False, compression: str=None) -> None:
+    """
+    Generate a knowledge graph from a set of log files using entity and relation extraction.
+
+    Parameters
+    ----------
+    - `raw_data_dir`: path to directory containing raw log data
+    - `labels`: whether the testing data should be labeled
+    - `num_workers`: number of processes to parse log files with. If greater than 1, files are
+                     parsed in parallel with a shared template set (see `parse_logs_parallel`)
+    - `stream`: generate the datasets in one pass, without writing intermediate files.
+                Log files are parsed serially in this mode
+    - `keep_templates`: when streaming, also write the parse results to the templates directory
+    - `state_path`: path to a Drain3 snapshot file. If given, all log files are parsed with one
+                    template miner, which is warm-started from the snapshot if it exists and saved
+                    back to it, so template IDs stay stable across files and runs
+    - `match_only`: only match lines from the test/val sets against the templates learned from the
+                    train set, without changing them
+    - `compression`: optional format to compress the parse results in the templates directory
+                     with, one of {"gz", "zst"}. Log files compressed with zip, gzip or zstd are
+                     always read directly
+    """
+    # TODO(lucas): Think about converting to all lowercase. Names appear as both, so irwin and
+    # Irwin are technically two different entities.
+    # TODO(lucas): For the AIT dataset, map names to email addresses to be clear that they refer
+    # to the same person
+    logger = logging.getLogger(__name__)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+
+    # Directory to write KG data to
+    preprocessed_data_dir = os.path.join(raw_data_dir, "preprocessed")
+
+    make_dir("templates")
+    make_dir(preprocessed_data_dir)
+
+    # NOTE(lucas): Use one template miner for all files if its state is persisted or test/val
+    # lines are matched against the templates learned from the train set
+    template_miner = None
+    if state_path or match_only:
+        template_miner = load_template_miner(state_path)
+
+    if stream:
+        _generate_kg_streaming(raw_data_dir, labels, gen_ids, keep_templates, logger,
+                               template_miner, match_only, compression)
+        return
+
+    log_files = _gather_log_files(raw_data_dir, compression)
+    for _, result_file in log_files:
+        make_dir(os.path.dirname(result_file))
+
+    if num_workers > 1:
+        parse_logs_parallel(log_files, num_workers, logger=logger, labels=labels,
+                            template_miner=template_miner, match_only=match_only)
+    else:
+        # Learn templates from the train set before matching the test/val sets against them
+        if template_miner is not None:
+            log_files.sort(key=lambda log_file: not file_in_dataset(log_file[1], "train"))
+        for in_log_file, result_file in log_files:
+            file_match_only = match_only and not file_in_dataset(result_file, "train")
+            parse_log(in_log_file, result_file, logger=logger, labels=labels,
+                      template_miner=template_miner, match_only=file_match_only)
 
     # TODO(lucas): Have option to remove generated template files and templates directory
     train_kg_file = os.path.join(preprocessed_data_dir, "train.txt")
     test_kg_file = os.path.join(preprocessed_data_dir, "test.txt")
     val_kg_file = os.path.join(preprocessed_data_dir, "valid.txt")
     label_file = os.path.join(preprocessed_data_dir, "labels.txt")
-    extract_relations_templates(join_path("templates", "train"), train_kg_file)
-    extract_relations_templates(join_path("templates", "test"), test_kg_file, label_file)
+    template_index = load_template_index()
+    extract_relations_templates(join_path("templates", "train"), train_kg_file,
+                                template_index=template_index)
+    extract_relations_templates(join_path("templates", "test"), test_kg_file, label_file,
+                                template_index=template_index)
     # remove_duplicate_lines(train_kg_file)
     # remove_duplicate_lines(test_kg_file)
     generate_val_set(test_kg_file, val_kg_file, val_ratio=0.5)
@@ -0,0 +1,273 @@
+"""
+Follow growing log files and incrementally append the triples extracted from new lines to a
+dataset, rather than rebuilding the dataset from closed files with `generate_kg`.
+The follower resumes from a saved byte offset, handles log rotation, and keeps its Drain3 state
+between polls and runs.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from . import kg_generation
+
+
+def load_ids(path: str) -> dict:
+    """
+    Load a mapping of strings to IDs saved by `generate_kg`
+
+    Parameters
+    ----------
+    - `path`: path to entity_ids.txt or relation_ids.txt
+    """
+    mapping = {}
+    with open(path, "r", encoding="utf-8") as infile:
+        for line in infile:
+            id_str, string = line.rstrip('\n').split('\t', 1)
+            mapping[string] = int(id_str)
+
+    return mapping
+
+class LogFollower:
+    """
+    Follows one log file, appending the triples extracted from each new line to a triples file.
+
+    The position in the log file is saved to `<state_dir>/<log file name>.offset.json` after each
+    poll. If the log file is rotated (replaced by a new file) or truncated, the rest of the old file
+    is read before the follower starts at the beginning of the new one.
+
+    The template miner state is saved to `<state_dir>/<log file name>.drain3_state.bin` by
+    default. It is saved before the offset whenever a poll changes the templates, so a follower
+    restarted after a crash never resumes past lines whose templates were not saved. Each follower
+    rewrites its whole state file, so two learning followers must not share one. A match-only
+    follower never saves its state, so it can read the state file of a learning follower.
+
+    Parameters
+    ----------
+    - `log_path`: path to the log file to follow
+    - `triples_path`: file to append triples to (e.g., test.txt of a preprocessed dataset)
+    - `state_dir`: directory to save offsets and template miner state to
+    - `label_path`: optional file to append the label of each triple to
+    - `labels`: whether log lines end in a label
+    - `dataset`: dataset the triples belong to, one of {"train", "test", "val"}.
+                 Type relations are only added to the train set
+    - `ids_dir`: optional directory containing entity_ids.txt and relation_ids.txt. If given,
+                 triples are written with IDs, and triples with unknown entities or relations
+                 are discarded
+    - `match_only`: only match lines against the templates in the saved state instead of learning
+                    from them
+    - `state_path`: optional path to the template miner state file, instead of the default path
+                    in `state_dir`
+    """
+    def __init__(self, log_path: str, triples_path: str, state_dir: str,
+                 label_path: str=None, labels: bool=False, dataset: str="test",
+                 ids_dir: str=None, match_only: bool=False, state_path: str=None):
+        self.log_path = log_path
+        self.triples_path = triples_path
+        self.label_path = label_path
+        self.labeled = labels and dataset in ("test", "val")
+        self.add_types = dataset == "train"
+        self.match_only = match_only
+        self.logger = logging.getLogger(__name__)
+
+        os.makedirs(state_dir, exist_ok=True)
+        self.offset_path = os.path.join(state_dir, os.path.basename(log_path) + ".offset.json")
+        if state_path is None:
+            state_path = os.path.join(state_dir, os.path.basename(log_path) + ".drain3_state.bin")
+        self.template_miner = kg_generation.load_template_miner(state_path)
+        self.template_index = kg_generation.load_template_index()
+
+        self.ent_ids = None
+        self.rel_ids = None
+        if ids_dir:
+            self.ent_ids = load_ids(os.path.join(ids_dir, "entity_ids.txt"))
+            self.rel_ids = load_ids(os.path.join(ids_dir, "relation_ids.txt"))
+
+        self.log_file = None
+        self.inode = None
+        self.offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path, "r", encoding="utf-8") as infile:
+                saved = json.load(infile)
+            self.inode = saved["inode"]
+            self.offset = saved["offset"]
+
+    def _open(self) -> bool:
+        """
+        Open the log file if it exists, resuming from the saved offset if it is the same file
+        """
+        try:
+            self.log_file = open(self.log_path, "rb")
+        except FileNotFoundError:
+            return False
+
+        stat = os.fstat(self.log_file.fileno())
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.inode = stat.st_ino
+            self.offset = 0
+        self.log_file.seek(self.offset)
+        return True
+
+    def _rotated(self) -> bool:
+        """
+        Determine whether the log file has been rotated or truncated since it was opened
+        """
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            # Rotated, but the new file has not been created yet
+            return False
+
+        return stat.st_ino != self.inode or stat.st_size < self.offset
+
+    def _read_lines(self) -> list[str]:
+        """
+        Read the complete lines written to the log file since the last read
+        """
+        lines = []
+        while True:
+            line = self.log_file.readline()
+            # NOTE(lucas): A line without a newline is still being written, so leave it for the
+            # next poll
+            if not line.endswith(b"\n"):
+                self.log_file.seek(self.offset)
+                break
+            self.offset += len(line)
+            lines.append(line.decode("utf-8"))
+
+        return lines
+
+    def _save_offset(self) -> None:
+        """
+        Save the position in the log file, replacing the old offset file atomically
+        """
+        tmp_path = self.offset_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump({"inode": self.inode, "offset": self.offset}, outfile)
+        os.replace(tmp_path, self.offset_path)
+
+    def _write_triples(self, lines: list[str]) -> tuple[int, bool]:
+        """
+        Parse log lines and append the extracted triples and labels to the output files
+
+        Returns
+        ---------
+        The number of triples written and whether the templates changed
+        """
+        triple_count = 0
+        templates_changed = False
+        label_file = open(self.label_path, "a", encoding="utf-8") if self.label_path else None
+        try:
+            with open(self.triples_path, "a", encoding="utf-8") as outfile:
+                for line in lines:
+                    line, label = kg_generation.split_log_line(line, self.labeled)
+                    result = kg_generation.parse_line(self.template_miner, line,
+                                                      match_only=self.match_only)
+                    result["label"] = label
+                    templates_changed |= result["change_type"] != "none"
+                    for sub, rel, obj, label in kg_generation.iter_triples(
+                            [result], self.template_index, self.add_types):
+                        triple_line = f"{sub}\t{rel}\t{obj}\n"
+                        if self.ent_ids is not None:
+                            triple_line = kg_generation.triple_to_ids([sub, rel, obj],
+                                                                      self.ent_ids, self.rel_ids)
+                            if triple_line is None:
+                                continue
+                        outfile.write(triple_line)
+                        if label_file and label is not None:
+                            label_file.write(label + '\n')
+                        triple_count += 1
+        finally:
+            if label_file:
+                label_file.close()
+
+        return triple_count, templates_changed
+
+    def poll(self) -> int:
+        """
+        Process the lines written to the log file since the last poll
+
+        Returns
+        ---------
+        The number of lines processed
+        """
+        if self.log_file is None and not self._open():
+            return 0
+
+        lines = self._read_lines()
+        # Finish the old file before moving to the new one
+        if self._rotated():
+            self.log_file.close()
+            self.log_file = None
+            self.inode = None
+            if self._open():
+                lines += self._read_lines()
+
+        if lines:
+            triple_count, templates_changed = self._write_triples(lines)
+            self.logger.info(f"{self.log_path}: {len(lines)} lines, {triple_count} triples")
+            # NOTE(lucas): Drain3 only saves snapshots on its own interval, so save the templates
+            # learned from these lines before the offset moves past them
+            if templates_changed:
+                self.template_miner.save_state("follower poll")
+        self._save_offset()
+
+        return len(lines)
+
+    def follow(self, poll_interval: float=0.1) -> None:
+        """
+        Poll the log file until interrupted, waiting `poll_interval` seconds whenever
+        there are no new lines. New lines are processed at most `poll_interval` seconds after
+        they are written, so lower it for lower latency at the cost of more idle polls
+        """
+        try:
+            while True:
+                if self.poll() == 0:
+                    time.sleep(poll_interval)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """
+        Close the log file and save the template miner state
+        """
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        if not self.match_only:
+            self.template_miner.save_state("follower closed")
+
+
+def main():
+    # Define CLI arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", "-l", required=True, help="the log file to follow")
+    parser.add_argument("--out", "-o", required=True, help="the file to append triples to")
+    parser.add_argument("--state-dir", "-s", required=True,
+                        help="directory to save offsets and Drain3 state to")
+    parser.add_argument("--label-file", help="the file to append labels to")
+    parser.add_argument("--labels", action="store_true", help="log lines end in a label")
+    parser.add_argument("--dataset", default="test", choices=["train", "test", "val"],
+                        help="the dataset the triples belong to")
+    parser.add_argument("--ids-dir", help="directory containing entity_ids.txt and "
+                                          "relation_ids.txt to write triples with IDs")
+    parser.add_argument("--match-only", action="store_true",
+                        help="only match lines against the saved templates")
+    parser.add_argument("--state-file", help="Drain3 state file to use instead of the one in "
+                                             "the state directory")
+    parser.add_argument("--interval", type=float, default=0.1,
+                        help="seconds to wait between polls when there are no new lines")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+    follower = LogFollower(args.log, args.out, args.state_dir, label_path=args.label_file,
+                           labels=args.labels, dataset=args.dataset, ids_dir=args.ids_dir,
+                           match_only=args.match_only, state_path=args.state_file)
+    follower.follow(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Open log files and dataset files that may be compressed, based on their file extension.
+Lines are streamed straight out of zip, gzip and zstd files, so archives do not need to be unpacked
+to disk first, and output files are compressed as they are written.
+zstd support needs the optional zstandard package.
+"""
+
+import gzip
+import io
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Extensions of the compressed formats that can be opened
+COMPRESSED_SUFFIXES = (".gz", ".zst", ".zip")
+
+# Formats that output files can be compressed with
+OUTPUT_COMPRESSIONS = ("gz", "zst")
+
+
+def is_compressed(path: str) -> bool:
+    """
+    Determine whether a file is compressed, based on its extension
+
+    Parameters
+    ----------
+    - `path`: path to file
+    """
+    return path.endswith(COMPRESSED_SUFFIXES)
+
+def strip_compression_suffix(path: str) -> str:
+    """
+    Remove the compression extension of a file, if any (e.g., audit.log.gz -> audit.log)
+
+    Parameters
+    ----------
+    - `path`: path to file
+    """
+    for suffix in COMPRESSED_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+def check_compression(compression: str=None, paths: list[str]=()) -> None:
+    """
+    Check that output files can be compressed with the given format and that the given files can
+    be opened, before any of them is read or written. Without this check, a missing zstandard
+    package only fails once a worker process opens a .zst file.
+
+    Parameters
+    ----------
+    - `compression`: optional format to compress output files with, one of {"gz", "zst"}
+    - `paths`: paths to files that will be opened
+    """
+    if compression is not None and compression not in OUTPUT_COMPRESSIONS:
+        raise ValueError(f"Unsupported compression: {compression}, expected one of "
+                         f"{OUTPUT_COMPRESSIONS}")
+
+    if zstandard is None:
+        if compression == "zst":
+            raise ImportError("The zstandard package is needed to compress files with zst")
+        zst_paths = [path for path in paths if path.endswith(".zst")]
+        if zst_paths:
+            raise ImportError(f"The zstandard package is needed to open {zst_paths[0]}")
+
+def _zip_member(archive: zipfile.ZipFile, member: str=None) -> str:
+    """
+    Internal function.
+    Find the member of a zip archive to read. If not given, the archive must contain one file.
+    """
+    if member is not None:
+        return member
+
+    members = [info.filename for info in archive.infolist() if not info.is_dir()]
+    if len(members) != 1:
+        raise ValueError(f"{archive.filename} contains {len(members)} files, give the member "
+                         "to read")
+    return members[0]
+
+def open_binary(path: str, mode: str="rb", member: str=None) -> io.IOBase:
+    """
+    Open a file in binary mode, decompressing or compressing it according to its extension
+
+    Parameters
+    ----------
+    - `path`: path to file
+    - `mode`: one of {"rb", "wb", "ab"}. zip files can only be read
+    - `member`: member of a zip archive to read. Defaults to the only file in the archive
+    """
+    if mode not in ("rb", "wb", "ab"):
+        raise ValueError(f"Unsupported mode: {mode}")
+
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(f"The zstandard package is needed to open {path}")
+        # NOTE(lucas): Appending writes a new zstd frame, and concatenated frames are decompressed
+        # as one stream
+        raw = open(path, mode)
+        if mode == "rb":
+            reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True,
+                                                                closefd=True)
+            return io.BufferedReader(reader)
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+
+    if path.endswith(".zip"):
+        if mode != "rb":
+            raise ValueError(f"zip archives can only be read: {path}")
+        # NOTE(lucas): The archive file stays open until the member is closed
+        with zipfile.ZipFile(path) as archive:
+            return archive.open(_zip_member(archive, member))
+
+    return open(path, mode)
+
+def open_text(path: str, mode: str="r", member: str=None, encoding: str="utf-8") -> io.TextIOBase:
+    """
+    Open a file in text mode, decompressing or compressing it according to its extension
+
+    Parameters
+    ----------
+    - `path`: path to file
+    - `mode`: one of {"r", "w", "a"}. zip files can only be read
+    - `member`: member of a zip archive to read. Defaults to the only file in the archive
+    - `encoding`: text encoding of the file
+    """
+    if not is_compressed(path):
+        return open(path, mode, encoding=encoding)
+
+    return io.TextIOWrapper(open_binary(path, mode + "b", member), encoding=encoding)
@@ -0,0 +1,138 @@
+"""
+Benchmark relation extraction from parsed log files, comparing the hash-indexed template lookup in
+`extract_relations_templates` against the previous approach of decoding each line once per
+template and comparing it against every template in turn.
+
+Run from the repository root with
+
+    python -m benchmarks.bench_extract_relations --lines 200000 --templates 200
+
+1 CPU (Xeon), Python 3.11:
+
+    lines    templates   linear scan (lines/sec)   indexed (lines/sec)   speedup
+    20000    200                           854.1               65861.7     77.1x
+    200000   200                           793.1               62750.0     79.1x
+
+Both produce the same triples. The linear scan decodes each line once per template, so its
+rate falls as the template set grows, while the indexed lookup does not depend on it.
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from anomaly_detection.kg_generation.kg_generation import (extract_relations_templates,
+                                                           file_in_dataset, join_path,
+                                                           load_template_index)
+
+
+def extract_relations_linear(template_dir: str, out_path: str, templates_path: str) -> None:
+    """
+    Relation extraction as it was done before templates were indexed
+    """
+    type_map = {"IP": "ip_address", "UID": "user_id", "PID": "process_id", "USER": "user",
+                "PROCESS": "process", "HOST": "host", "SESSION": "session"}
+
+    with open(out_path, "w", encoding="utf-8") as outfile, \
+         open(templates_path, "r", encoding="utf-8") as template_file:
+        templates = json.load(template_file)["templates"]
+
+        for entry in os.listdir(template_dir):
+            with open(os.path.join(template_dir, entry), "r", encoding="utf-8") as infile:
+                for parsed_line in infile:
+                    for template in templates:
+                        parse_result = json.loads(parsed_line)
+                        if template["template_mined"] != parse_result["template_mined"]:
+                            continue
+                        for relation in template["relations"]:
+                            sub_index = relation["subject"]
+                            obj_index = relation["object"]
+                            sub = str(parse_result["params"][sub_index][0]).lower()
+                            obj = str(parse_result["params"][obj_index][0]).lower()
+                            rel = str(relation["relation_label"]).lower()
+                            outfile.write(f"{sub}\t{rel}\t{obj}\n")
+
+                            sub_type = parse_result["params"][sub_index][1]
+                            obj_type = parse_result["params"][obj_index][1]
+                            if file_in_dataset(infile.name, "train") and sub_type in type_map:
+                                outfile.write(f"{sub}\ta\t{type_map[sub_type]}\n")
+                            if file_in_dataset(infile.name, "train") and obj_type in type_map:
+                                sub = parse_result["params"][obj_index][0].lower()
+                                outfile.write(f"{sub}\ta\t{type_map[obj_type]}\n")
+
+
+def make_dataset(work_dir: str, num_lines: int, num_templates: int, num_files: int) -> str:
+    """
+    Write a templates file padded with synthetic templates and a directory of parsed log files
+    in the format written by `parse_log`. Returns the path to the templates file.
+    """
+    with open(join_path("config", "templates.json"), "r", encoding="utf-8") as template_file:
+        templates = json.load(template_file)["templates"]
+
+    # Pad the real AIT templates with synthetic ones that never match, as a growing template set
+    # would. Put them first, so that the linear scan cannot exit early.
+    synthetic = [{"template_mined": f"synthetic template {i} for <:USER:> from <:IP:>",
+                  "relations": [{"subject": 0, "relation_label": "has_ip", "object": 1}]}
+                 for i in range(max(num_templates - len(templates), 0))]
+    templates_path = os.path.join(work_dir, "templates.json")
+    with open(templates_path, "w", encoding="utf-8") as template_file:
+        json.dump({"templates": synthetic + templates}, template_file)
+
+    rng = random.Random(1234)
+    template_dir = os.path.join(work_dir, "train")
+    os.mkdir(template_dir)
+    for file_num in range(num_files):
+        path = os.path.join(template_dir, f"host{file_num}_auth_result.jsonl")
+        with open(path, "w", encoding="utf-8") as outfile:
+            for _ in range(num_lines // num_files):
+                template = rng.choice(templates)
+                num_params = 1 + max(max(rel["subject"], rel["object"])
+                                     for rel in template["relations"])
+                params = [[f"value{rng.randrange(1000)}", rng.choice(["USER", "IP", "NUM"])]
+                          for _ in range(num_params)]
+                result = {"change_type": "none", "cluster_id": 1, "cluster_size": 1,
+                          "template_mined": template["template_mined"], "cluster_count": 1,
+                          "params": params, "label": ""}
+                outfile.write(json.dumps(result) + "\n")
+
+    return templates_path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=200000, help="number of parsed log lines")
+    parser.add_argument("--templates", type=int, default=200, help="size of the template set")
+    parser.add_argument("--files", type=int, default=20, help="number of parsed log files")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        templates_path = make_dataset(work_dir, args.lines, args.templates, args.files)
+        template_dir = os.path.join(work_dir, "train")
+        num_lines = (args.lines // args.files) * args.files
+
+        start_time = time.perf_counter()
+        extract_relations_linear(template_dir, os.path.join(work_dir, "linear.txt"),
+                                 templates_path)
+        linear_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        template_index = load_template_index(templates_path)
+        extract_relations_templates(template_dir, os.path.join(work_dir, "indexed.txt"),
+                                    template_index=template_index)
+        indexed_time = time.perf_counter() - start_time
+
+        with open(os.path.join(work_dir, "linear.txt"), "r", encoding="utf-8") as linear, \
+             open(os.path.join(work_dir, "indexed.txt"), "r", encoding="utf-8") as indexed:
+            same_output = linear.read() == indexed.read()
+
+    print(f"{num_lines} lines, {args.templates} templates")
+    print(f"Linear scan:   {linear_time:.2f} sec, {num_lines / linear_time:.1f} lines/sec")
+    print(f"Indexed:       {indexed_time:.2f} sec, {num_lines / indexed_time:.1f} lines/sec")
+    print(f"Speedup:       {linear_time / indexed_time:.1f}x")
+    print(f"Same output:   {same_output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Benchmark training steps of the Distmult, Complex and ConvE models, comparing the default fp32
+eager path against the fast path enabled by `fast_training` (bf16 autocast and torch.compile on
+the scoring path). Each configuration runs in a fresh process, so the peak RSS of one does not hide
+the other.
+
+Run from the repository root with
+
+    python -m benchmarks.bench_training_step --entities 40000 --steps 50
+
+Defaults, 1 CPU (Xeon), torch 2.14.1 on CPU:
+
+    model      mode    steps/sec  peak RSS (MiB)
+    distmult   fp32         4.86          1187.3
+    distmult   fast         5.70          1221.8   1.17x
+    complex    fp32         1.94          1479.6
+    complex    fast         2.32          1429.2   1.19x
+    conve      fp32         3.21          1169.8
+    conve      fast         4.83          1239.6   1.50x
+
+The GNN models are not benchmarked. Their message passing stays in fp32, so their speedup is
+expected to be smaller.
+"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from anomaly_detection.kg_completion.kg_completion import KGC, sparse_targets
+
+
+def make_config(model_name: str, fast: bool) -> dict:
+    """
+    Config with the model settings of config/ait.yaml
+    """
+    return {
+        "model": model_name,
+        "fast_training": fast,
+        "cuda": False,
+        "embedding_dim": 200,
+        "embedding_shape": 20,
+        "input_drop": 0.2,
+        "hidden_drop": 0.25,
+        "feat_drop": 0.2,
+        "hidden_size": 9728,
+        "use_bias": False,
+        "label_smoothing": 0.1,
+    }
+
+
+def run_steps(model_name: str, fast: bool, args: argparse.Namespace) -> tuple[float, float]:
+    """
+    Time training steps on random batches. Returns steps/sec and peak RSS in MiB.
+    """
+    torch.manual_seed(1234)
+    cfg = make_config(model_name, fast)
+    model = KGC(cfg, args.entities, args.relations)
+    model.init()
+    model.train()
+    opt = torch.optim.Adam(model.parameters(), lr=0.0005)
+
+    e1_tensor = torch.randint(1, args.entities, (args.batch_size, 1))
+    rel_tensor = torch.randint(1, args.relations, (args.batch_size, 1))
+    # A few targets per row, padded with 0 like e2_multi1
+    e2_multi = torch.randint(1, args.entities, (args.batch_size, 4))
+    e2_multi[:, 2:] *= torch.rand(args.batch_size, 2) < 0.5
+    e2_offsets, e2_indices = sparse_targets(e2_multi)
+
+    def step():
+        opt.zero_grad()
+        logits = model(e1_tensor, rel_tensor, None, logits=True)
+        loss = model.loss(logits, e2_offsets, e2_indices)
+        loss.backward()
+        opt.step()
+
+    # Warm up, which includes compiling in fast mode
+    for _ in range(args.warmup):
+        step()
+
+    start_time = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    elapsed = time.perf_counter() - start_time
+
+    # NOTE(lucas): ru_maxrss is in KiB on Linux
+    return args.steps / elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=40000, help="number of entities")
+    parser.add_argument("--relations", type=int, default=50, help="number of relations")
+    parser.add_argument("--batch-size", type=int, default=128, help="batch size")
+    parser.add_argument("--steps", type=int, default=50, help="number of timed steps")
+    parser.add_argument("--warmup", type=int, default=5, help="number of untimed steps")
+    parser.add_argument("--models", nargs="+", default=["distmult", "complex", "conve"],
+                        help="models to benchmark")
+    args = parser.parse_args()
+
+    print(f"{args.entities} entities, batch size {args.batch_size}, {args.steps} steps")
+    print(f"{'model':<10} {'mode':<6} {'steps/sec':>10} {'peak RSS (MiB)':>15}")
+    for model_name in args.models:
+        baseline = None
+        for fast in (False, True):
+            # Use a new process per configuration so peak RSS is measured separately
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                steps_per_sec, peak_rss = executor.submit(run_steps, model_name, fast, args).result()
+
+            mode = "fast" if fast else "fp32"
+            line = f"{model_name:<10} {mode:<6} {steps_per_sec:>10.2f} {peak_rss:>15.1f}"
+            if baseline is None:
+                baseline = steps_per_sec
+            else:
+                line += f"   {steps_per_sec / baseline:.2f}x"
+            print(line)
+
+if __name__ == "__main__":
+    main()
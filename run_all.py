@@ -5,7 +5,7 @@ import numpy as np
 import ruamel.yaml
 import torch
 
-from anomaly_detection.kg_completion.kg_completion import kg_completion
+from anomaly_detection.kg_completion.sweep import run_successive_halving, run_sweep
 
 def main():
     np.random.seed(1234)
@@ -19,6 +19,7 @@ def main():
     with open(config_filename, "r", encoding="utf-8") as config_file:
         cfg = yaml.load(config_file)
 
+    configs = []
     for model in models:
         cfg["model"] = model
         if model == "gcn_distmult" or model == "gnn_distmult":
@@ -28,10 +29,9 @@ def main():
         elif model == "ggnn_complex":
             cfg["direction_option"] = "bi_fuse"
 
-        with open(config_filename, "w", encoding="utf-8") as config_file:
-            yaml.dump(cfg, config_file)
+        configs.append(dict(cfg))
 
-        kg_completion(config_filename, dataset_dir)
+    run_sweep(configs, dataset_dir)
 
     config_filename = "config/ait.yaml"
     dataset_dir = "data/AIT/preprocessed"
@@ -52,11 +52,15 @@ def main():
     with open(config_filename, "r", encoding="utf-8") as config_file:
         cfg = yaml.load(config_file)
 
+    # Stop trials that have not improved in 5 validation rounds
+    cfg["patience"] = 5
+
     # Detect whether GPU is available and use if it is
     if torch.cuda.is_available():
-        cfg["cuda"] = "true"
+        cfg["cuda"] = True
         cfg["gpu"] = torch.cuda.current_device()
 
+    configs = []
     for model in models:
         cfg["model"] = model
         for direction in directions:
@@ -66,9 +70,10 @@ def main():
                 for key, value in param_space.items():
                     cfg[key] = value[i]
 
-                with open(config_filename, "w", encoding="utf-8") as config_file:
-                    yaml.dump(cfg, config_file)
-                kg_completion(config_filename, dataset_dir)
+                configs.append(dict(cfg))
+
+    # NOTE(lucas): Trials share one GPU, so only run them in parallel on the CPU
+    run_successive_halving(configs, dataset_dir, num_workers=1 if cfg["cuda"] is True else None)
 
 if __name__ == "__main__":
     main()